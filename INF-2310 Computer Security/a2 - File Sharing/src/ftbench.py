@@ -0,0 +1,316 @@
+# Loopback benchmark of ftserv.py and ftclient.py.
+#
+# For every file size and number of concurrent clients, a fresh server is started on 127.0.0.1 with a free
+# port, and the clients are started as separate processes that all fetch the file at the same time.
+# Every client connects and fetches the file a few times (more often for small files) and measures how long
+# each handshake took. The results are printed as JSON:
+#     handshake latency percentiles, throughput in MB/s, CPU seconds per GB and peak RSS
+# for both the server and the clients. The clients discard the data, and the test files are sparse unless
+# --random is given, so the benchmark measures the protocol and not the disk.
+# Every client keeps its session tickets and known servers in a directory of its own, like separate users would.
+# A case where any client failed is reported as failed, without numbers, and the benchmark exits with status 1.
+# Server CPU and memory are read from /proc, so they are only reported on Linux.
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from ftclient import connect, recv_file_data
+from ftkex import KEX_METHODS, KnownServers
+from ftpipeline import CryptoPool
+from ftticket import TicketStore
+
+
+SIZES = ["1K", "64K", "1M", "16M", "256M", "1G", "4G"]
+CONCURRENCY = [1, 4, 16]
+# Each client fetches a file often enough to move about this many bytes, at most MAX_TRANSFERS times
+TARGET_BYTES = 32 * 1024 * 1024
+MAX_TRANSFERS = 50
+
+_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+_SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ftserv.py")
+
+
+def parse_size(text : str) -> int:
+    """
+    Number of bytes in a size like "64K", "16M" or "4G".
+    """
+
+    match = re.fullmatch(r"(\d+)([KMG]?)B?", text.strip().upper())
+    if match is None:
+        raise argparse.ArgumentTypeError(f"Not a size: {text}")
+    return int(match.group(1)) * _UNITS[match.group(2)]
+
+
+def make_file(path : str, size : int, random : bool):
+    """
+    Creates the test file, sparse unless random is set. An existing file of the right size is kept.
+    """
+
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        return
+    with open(path, "wb") as f:
+        if random:
+            for start in range(0, size, 1024 * 1024):
+                f.write(os.urandom(min(1024 * 1024, size - start)))
+        else:
+            f.truncate(size)
+
+
+def percentiles(values : list) -> dict:
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def at(p):
+        return values[min(int(p / 100 * len(values)), len(values) - 1)]
+
+    return {"p50": at(50), "p90": at(90), "p99": at(99), "max": values[-1]}
+
+
+def _self_usage() -> tuple:
+    """
+    CPU seconds and peak RSS in bytes of this process.
+    """
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return usage.ru_utime + usage.ru_stime, rss
+
+
+def _proc_usage(pid : int) -> tuple:
+    """
+    CPU seconds and peak RSS in bytes of another process, None on platforms without /proc.
+    """
+
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            status = f.read()
+    except OSError:
+        return None
+
+    # utime and stime are the 14th and 15th fields, the first two are before the split
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    rss = int(re.search(r"VmHWM:\s+(\d+) kB", status).group(1)) * 1024
+    return cpu, rss
+
+
+def run_client(host : str, port : int, client_dir : str, transfers : int, options : dict, start, results):
+    """
+    One client process: waits for start, fetches the file transfers times and puts its measurements in results.
+    Its session tickets and known servers are kept in client_dir.
+    """
+
+    try:
+        tickets = TicketStore(os.path.join(client_dir, "session_tickets.json")) if options["resume"] else None
+        known_servers = KnownServers(os.path.join(client_dir, "known_servers.json"))
+        crypto = CryptoPool(options["crypto_workers"]) if options["crypto_workers"] > 1 else None
+        cpu_before, _ = _self_usage()
+
+        start.wait()
+        handshakes = []
+        received = 0
+        begin = time.perf_counter()
+        for _ in range(transfers):
+            t = time.perf_counter()
+            s, symmetric_key, server_hello = connect(host, port, tickets, compression=options["compression"],
+                                                     kex=options["kex"], known_servers=known_servers)
+            handshakes.append(time.perf_counter() - t)
+            with s, open(os.devnull, "wb") as f:
+                received += recv_file_data(s, symmetric_key, server_hello, f, crypto)
+        elapsed = time.perf_counter() - begin
+
+        cpu, rss = _self_usage()
+        results.put({"handshakes": handshakes, "bytes": received, "seconds": elapsed, "cpu": cpu - cpu_before,
+                     "rss": rss})
+    except Exception as e:
+        results.put({"error": f"{type(e).__name__}: {e}"})
+
+
+def start_server(path : str, workdir : str, concurrency : int, server_args : list) -> tuple:
+    """
+    Starts ftserv.py serving path on 127.0.0.1 with a free port, returns (process, port).
+    """
+
+    log_path = os.path.join(workdir, "server.log")
+    log = open(log_path, "w")
+    command = [sys.executable, _SERVER_SCRIPT, path, "--host", "127.0.0.1", "--port", "0",
+               "--max-connections", str(max(concurrency, 64))] + server_args
+    # The server's output goes to a file, a pipe nobody reads would stop it once full
+    server = subprocess.Popen(command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+
+    deadline = time.monotonic() + 600
+    while time.monotonic() < deadline:
+        with open(log_path) as f:
+            match = re.search(r"listening on port (\d+)", f.read())
+        if match:
+            return server, int(match.group(1))
+        if server.poll() is not None:
+            break
+        time.sleep(0.05)
+
+    server.kill()
+    with open(log_path) as f:
+        raise RuntimeError(f"Server did not start:\n{f.read()}")
+
+
+def run_case(path : str, size : int, concurrency : int, workdir : str, options : dict, server_args : list) -> dict:
+    """
+    Starts a server for the file at path and concurrency clients, returns the measurements of the run.
+    """
+
+    transfers = max(1, min(MAX_TRANSFERS, TARGET_BYTES // max(size, 1)))
+    server, port = start_server(path, workdir, concurrency, server_args)
+    try:
+        # One connection first, so the clients find the server's identity key already known
+        known_servers = os.path.join(workdir, "known_servers.json")
+        s, _, _ = connect("127.0.0.1", port, kex=options["kex"], known_servers=KnownServers(known_servers))
+        s.close()
+
+        # Fresh for every case, the tickets of an earlier server are no use
+        clients_dir = os.path.join(workdir, "clients")
+        shutil.rmtree(clients_dir, ignore_errors=True)
+        client_dirs = [os.path.join(clients_dir, str(i)) for i in range(concurrency)]
+        for client_dir in client_dirs:
+            os.makedirs(client_dir)
+            if os.path.exists(known_servers):
+                shutil.copy(known_servers, client_dir)
+
+        server_before = _proc_usage(server.pid)
+
+        context = multiprocessing.get_context("spawn")
+        start = context.Event()
+        results = context.Queue()
+        clients = [context.Process(target=run_client, args=("127.0.0.1", port, client_dir, transfers, options,
+                                                            start, results))
+                   for client_dir in client_dirs]
+        for client in clients:
+            client.start()
+
+        # Give the processes time to import everything, so only the transfers are timed
+        time.sleep(1 + 0.05 * concurrency)
+        begin = time.perf_counter()
+        start.set()
+        measured = [results.get() for _ in clients]
+        wall = time.perf_counter() - begin
+        for client in clients:
+            client.join()
+
+        server_after = _proc_usage(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+    errors = [m["error"] for m in measured if "error" in m]
+    if errors:
+        # The clients that finished had the server to themselves for part of the run, their numbers mean nothing
+        return {"size": size, "concurrency": concurrency, "transfers_per_client": transfers, "failed": True,
+                "errors": errors}
+    total = sum(m["bytes"] for m in measured)
+    gigabytes = total / 1e9
+
+    case = {
+        "size": size,
+        "concurrency": concurrency,
+        "transfers_per_client": transfers,
+        "bytes": total,
+        "seconds": wall,
+        "throughput_mb_s": total / 1e6 / wall,
+        "transfers_per_s": sum(len(m["handshakes"]) for m in measured) / wall,
+        "per_client_mb_s": percentiles([m["bytes"] / 1e6 / m["seconds"] for m in measured]),
+        "handshake_ms": percentiles([h * 1000 for m in measured for h in m["handshakes"]]),
+        "client": {
+            "cpu_s": sum(m["cpu"] for m in measured),
+            "cpu_s_per_gb": sum(m["cpu"] for m in measured) / gigabytes if gigabytes else None,
+            "peak_rss_mb": max((m["rss"] for m in measured), default=0) / 1e6,
+        },
+        "server": None,
+        "failed": False,
+        "errors": [],
+    }
+    if server_before is not None and server_after is not None:
+        cpu = server_after[0] - server_before[0]
+        case["server"] = {
+            "cpu_s": cpu,
+            "cpu_s_per_gb": cpu / gigabytes if gigabytes else None,
+            "peak_rss_mb": server_after[1] / 1e6,
+        }
+    return case
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback benchmark of the encrypted file transfer")
+    parser.add_argument("--sizes", nargs="+", type=parse_size, default=[parse_size(s) for s in SIZES],
+                        help="file sizes to test, like 1K 16M 4G")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=CONCURRENCY,
+                        help="numbers of clients fetching the file at the same time")
+    parser.add_argument("--workdir", default=None,
+                        help="where the test files, keys and server log are kept (default: a temporary directory)")
+    parser.add_argument("--random", action="store_true",
+                        help="fill the test files with random data instead of leaving them sparse")
+    parser.add_argument("--resume", action="store_true",
+                        help="let the clients resume sessions with tickets instead of doing the full key exchange")
+    parser.add_argument("--kex", nargs="+", choices=KEX_METHODS, default=KEX_METHODS,
+                        help="key exchange methods the clients offer")
+    parser.add_argument("--no-compression", action="store_true", help="clients refuse compression")
+    parser.add_argument("--crypto-workers", type=int, default=1, help="decryption threads per client")
+    parser.add_argument("--server-args", default="", help='extra arguments for ftserv.py, e.g. "--compress zlib"')
+    parser.add_argument("--output", default=None, help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    options = {"resume": args.resume, "kex": args.kex, "compression": not args.no_compression,
+               "crypto_workers": args.crypto_workers}
+    server_args = shlex.split(args.server_args)
+
+    with tempfile.TemporaryDirectory(prefix="ftbench-") as tmp:
+        workdir = args.workdir or tmp
+        os.makedirs(workdir, exist_ok=True)
+
+        cases = []
+        for size in args.sizes:
+            path = os.path.join(workdir, f"data-{size}.bin")
+            make_file(path, size, args.random)
+            for concurrency in args.concurrency:
+                case = run_case(path, size, concurrency, workdir, options, server_args)
+                cases.append(case)
+                if case["failed"]:
+                    print(f"{size:>12} bytes x {concurrency:>3} clients: FAILED, {len(case['errors'])} clients: "
+                          f"{case['errors'][0]}", file=sys.stderr)
+                    continue
+                server_cpu = case["server"]["cpu_s_per_gb"] if case["server"] else None
+                print(f"{size:>12} bytes x {concurrency:>3} clients: {case['throughput_mb_s']:9.1f} MB/s, "
+                      f"handshake p50 {case['handshake_ms'].get('p50', 0):6.2f} ms, "
+                      f"server {server_cpu if server_cpu is not None else float('nan'):6.2f} CPU s/GB", file=sys.stderr)
+
+    report = {
+        "python": sys.version.split()[0],
+        "cpus": os.cpu_count(),
+        "options": dict(options, random=args.random, server_args=server_args),
+        "cases": cases,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if any(case["failed"] for case in cases):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+# Encrypt-once cache of served files.
+#
+# A file is encrypted once under its own random content key, and the result is stored exactly as it goes on
+# the wire: the frames of an encrypted stream (see ftstream.py). Serving the file again only sends the small
+# content key to the client, encrypted under the session key, and then hands the cache file to
+# socket.sendfile, so the kernel copies it to the socket without the data passing through Python.
+#
+# Entries are keyed by the SHA-256 of the plaintext from the catalog, so a changed file gets a new entry and
+# the old one ages out. The cache is bounded in bytes and evicts the least recently used entries.
+# Every client of a file receives the same ciphertext, so an eavesdropper can tell that two transfers carried
+# the same file (but not what it is). The content keys are stored in the cache directory, which must be kept
+# as secret as the server's private key.
+
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict, namedtuple
+
+from Crypto.Random import get_random_bytes
+
+from ftstream import CHUNK_SIZE, CONTENT, TAG_SIZE, ChunkSealer, send_stream
+from ftframe import HEADER
+
+
+CACHE_SIZE = 1024 * 1024 * 1024
+
+# file is the cache file, already open, so evicting the entry cannot take it away before it is sent
+CachedFile = namedtuple("CachedFile", ["key", "file", "size"])
+
+# Names of the files the cache writes itself, "<sha256>.ct" and "<sha256>.ct.tmp"
+_CACHE_FILE = re.compile(r"[0-9a-f]{64}\.ct(\.tmp)?")
+
+
+class _FileSink:
+    """
+    Lets send_stream write its frames to a file instead of a socket.
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def sendall(self, data):
+        self.f.write(data)
+
+
+class _HashingReader:
+    """
+    Reads a file for send_stream and hashes what it reads, to check it is still the file the catalog indexed.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def readinto(self, buffer):
+        n = self.f.readinto(buffer)
+        self.hash.update(buffer[:n])
+        return n
+
+
+def encrypted_size(size : int, chunk_size : int = CHUNK_SIZE) -> int:
+    """
+    Bytes on the wire for a file of size bytes: every chunk plus the empty final one a full last chunk gets.
+    """
+
+    chunks = size // chunk_size + 1
+    return size + chunks * (HEADER.size + 1 + TAG_SIZE)
+
+
+class CiphertextCache:
+    """
+    Encrypted copies of served files in a directory, at most max_bytes in total.
+    Safe to use from several threads, a file requested by several clients at once is only encrypted once.
+    """
+
+    INDEX = "index.json"
+
+    def __init__(self, directory : str, max_bytes : int = CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._building = {}
+        # sha256 -> {"key": hex content key, "size": bytes of ciphertext}, least recently used first
+        self._entries = OrderedDict()
+
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.INDEX)
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    saved = json.load(f)
+                for sha256, entry in saved:
+                    if os.path.exists(self._path(sha256)):
+                        self._entries[sha256] = entry
+            except (OSError, ValueError):
+                self._entries.clear()
+
+        # Leftovers of interrupted writes and evictions. The directory may hold other files too, they are left alone.
+        for name in os.listdir(directory):
+            if _CACHE_FILE.fullmatch(name) and not (name.endswith(".ct") and name[:-3] in self._entries):
+                os.remove(os.path.join(directory, name))
+
+    @property
+    def used(self) -> int:
+        return sum(entry["size"] for entry in self._entries.values())
+
+    def _path(self, sha256 : str) -> str:
+        return os.path.join(self.directory, sha256 + ".ct")
+
+    def _cached(self, sha256 : str) -> CachedFile:
+        entry = self._entries.get(sha256)
+        if entry is None:
+            return None
+        # Opened while holding the lock, so _evict cannot remove the file between the lookup and the open
+        f = open(self._path(sha256), 'rb')
+        self._entries.move_to_end(sha256)
+        return CachedFile(bytes.fromhex(entry["key"]), f, entry["size"])
+
+    def lookup(self, info, path : str) -> CachedFile:
+        """
+        The cached encrypted copy of the catalog entry info, encrypting the file at path first if it is not cached.
+        Returns None for a file that does not fit in the cache, or that changed since it was indexed.
+        The file of the CachedFile is open, send_cached closes it.
+        """
+
+        if encrypted_size(info.size) > self.max_bytes:
+            return None
+
+        with self._lock:
+            cached = self._cached(info.sha256)
+            if cached is not None:
+                self.hits += 1
+                return cached
+            build_lock = self._building.setdefault(info.sha256, threading.Lock())
+
+        with build_lock:
+            with self._lock:
+                cached = self._cached(info.sha256)
+                if cached is not None:
+                    self.hits += 1
+                    return cached
+
+            key = get_random_bytes(32)
+            tmp = self._path(info.sha256) + ".tmp"
+            with open(path, 'rb') as f, open(tmp, 'wb') as out:
+                reader = _HashingReader(f)
+                plain_size = send_stream(_FileSink(out), ChunkSealer(key, CONTENT), reader)
+                size = out.tell()
+            # A file rewritten since it was indexed, even with the same size, is not cached under the old hash
+            if plain_size != info.size or reader.hash.hexdigest() != info.sha256:
+                os.remove(tmp)
+                with self._lock:
+                    self._building.pop(info.sha256, None)
+                return None
+            os.replace(tmp, self._path(info.sha256))
+
+            with self._lock:
+                self.misses += 1
+                self._building.pop(info.sha256, None)
+                self._entries[info.sha256] = {"key": key.hex(), "size": size}
+                self._evict()
+                self._save()
+                return self._cached(info.sha256)
+
+    def _evict(self):
+        used = self.used
+        while used > self.max_bytes and len(self._entries) > 1:
+            sha256, entry = self._entries.popitem(last=False)
+            used -= entry["size"]
+            # Every client that got the entry from lookup already has the file open and can still send it,
+            # the data goes away when the last of them closes it
+            os.remove(self._path(sha256))
+
+    def _save(self):
+        path = os.path.join(self.directory, self.INDEX)
+        fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(list(self._entries.items()), f)
+        os.replace(path + ".tmp", path)
+
+
+def send_cached(sock, cached : CachedFile) -> int:
+    """
+    Sends a cached encrypted file, with sendfile where the platform has it, and closes it.
+    """
+
+    with cached.file as f:
+        return sock.sendfile(f, 0, cached.size)
@@ -0,0 +1,147 @@
+# In-memory index of the files ftserv.py serves.
+#
+# The index maps a name (the path relative to the served directory, with "/" separators) to the size,
+# modification time and SHA-256 of the file. It is built once at startup and then refreshed by a background
+# thread that rescans the tree every few seconds. A rescan only stats the files and rehashes the ones whose
+# size or modification time changed, so it stays cheap for a large unchanged tree.
+# Requests are answered from the index alone and never walk the file system, and a client can only
+# ask for names that are in the index, so it cannot reach files outside the served directory.
+
+import hashlib
+import os
+import threading
+import time
+from collections import namedtuple
+
+
+FileInfo = namedtuple("FileInfo", ["name", "size", "mtime", "sha256"])
+
+SCAN_INTERVAL = 5.0
+_HASH_BLOCK = 1024 * 1024
+
+
+def file_hash(path : str) -> str:
+    """
+    SHA-256 of the file's content as a hex string.
+    """
+
+    h = hashlib.sha256()
+    buffer = bytearray(_HASH_BLOCK)
+    view = memoryview(buffer)
+    with open(path, "rb") as f:
+        while True:
+            n = f.readinto(buffer)
+            if n == 0:
+                return h.hexdigest()
+            h.update(view[:n])
+
+
+class Catalog:
+    """
+    Index of a directory tree, or of a single file when root is a file.
+    Readers always see a complete index: a rescan builds a new dict and swaps it in.
+    """
+
+    def __init__(self, root : str):
+        self.root = os.path.abspath(root)
+        self.single_file = os.path.isfile(self.root)
+        self._entries = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self.scan()
+
+    @property
+    def default(self) -> str:
+        """
+        Name of the file sent to a client that does not ask for one, None when serving a directory.
+        """
+
+        return os.path.basename(self.root) if self.single_file else None
+
+    def _walk(self):
+        if self.single_file:
+            yield os.path.basename(self.root), os.stat(self.root)
+            return
+
+        stack = [("", self.root)]
+        while stack:
+            prefix, directory = stack.pop()
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        name = prefix + entry.name
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((name + "/", entry.path))
+                        elif entry.is_file(follow_symlinks=False):
+                            yield name, entry.stat(follow_symlinks=False)
+            except OSError:
+                # A directory removed or made unreadable during the scan is left out until the next one
+                continue
+
+    def scan(self) -> int:
+        """
+        Brings the index up to date with the file system, returns the number of files that were (re)hashed.
+        """
+
+        old = self._entries
+        entries = {}
+        hashed = 0
+        for name, st in self._walk():
+            info = old.get(name)
+            if info is None or info.size != st.st_size or info.mtime != st.st_mtime_ns:
+                try:
+                    info = FileInfo(name, st.st_size, st.st_mtime_ns, file_hash(self.path(name)))
+                except OSError:
+                    continue
+                hashed += 1
+            entries[name] = info
+
+        self._entries = entries
+        return hashed
+
+    def path(self, name : str) -> str:
+        """
+        Where the file with the given index name is on disk.
+        """
+
+        if self.single_file:
+            return self.root
+        return os.path.join(self.root, *name.split("/"))
+
+    def get(self, name : str) -> FileInfo:
+        """
+        Index entry of a file, None if there is no such file.
+        """
+
+        return self._entries.get(name)
+
+    def list(self, prefix : str = "") -> list:
+        """
+        Index entries of every file whose name starts with prefix, sorted by name.
+        """
+
+        return sorted((info for name, info in self._entries.items() if name.startswith(prefix)),
+                      key=lambda info: info.name)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def start(self, interval : float = SCAN_INTERVAL):
+        """
+        Rescans the tree every interval seconds in a background thread.
+        """
+
+        def run():
+            while not self._stop.wait(interval):
+                start = time.perf_counter()
+                hashed = self.scan()
+                if hashed:
+                    print(f"Catalog updated, {hashed} files hashed in {time.perf_counter() - start:.2f}s")
+
+        self._thread = threading.Thread(target=run, name="catalog-scan", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
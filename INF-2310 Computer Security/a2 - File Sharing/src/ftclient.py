@@ -1,124 +1,457 @@
 # Sources:
 # Socket logic: https://pythonprogramming.net/pickle-objects-sockets-tutorial-python-3/
 # RSA logic: https://pycryptodome.readthedocs.io/en/latest/src/public_key/rsa.html
-# AES logic: aes-intro.py
+# AES logic: aes-intro.py, https://pycryptodome.readthedocs.io/en/latest/src/cipher/modern.html#gcm-mode
 
+import argparse
+import json
+import os
 import socket
-import pickle
-import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from Crypto.Cipher import AES as aes
 from Crypto.Random import get_random_bytes
-from Crypto.Util.Padding import pad, unpad
 
 from Crypto.PublicKey import RSA as rsa
 from Crypto.Cipher import PKCS1_OAEP
 
+from ftcompress import METHODS, recv_compressed_stream
+from ftdelta import apply_delta, available, make_signature
+from ftframe import send_frame, recv_frame
+from ftkex import KEX_METHODS, RSA, X25519, KnownServers, derive_master_key, new_share, verify_handshake
+from ftpipeline import CryptoPool, default_workers
+from ftrange import PIECE_SIZE, Manifest, RangeWriter, preallocate
+from ftstream import (CHUNK_SIZE, ChunkOpener, ChunkSealer, CLIENT_TO_SERVER, CONTENT, CONTENT_KEY, MAX_CHUNK_SIZE,
+                      NEW_TICKET, SERVER_TO_CLIENT, StreamReader, StreamWriter, recv_stream)
+from ftticket import RANDOM_SIZE, TicketStore, derive_session_key
 
-HEADERSIZE = 10
-RECV_SIZE = 16
 
+TICKET_FILE = "session_tickets.json"
 
-def receive_file(hostname, tcp_port, save_path):
+
+def connect(hostname, tcp_port, tickets : TicketStore = None, byte_range : tuple = None, name : str = None,
+            session : bool = False, compression : bool = True, kex : list = KEX_METHODS,
+            known_servers : KnownServers = None) -> tuple:
     """
-    Will receive a file and store it.
-    Recieves the file from the given port and store it at the given path.
+    Connects to the server and runs the handshake, with a session ticket from tickets if there is one.
+    name picks a file when the server serves a directory, byte_range = (offset, length) asks for part
+    of the file instead of all of it. With session set no file is sent, the client sends requests instead.
+    compression tells the server it may compress the file data, server_hello["compression"] says if it does.
+    kex are the key exchange methods the client accepts (see ftkex.py), the identity key of a server
+    that uses X25519 is checked against known_servers (default: known_servers.json).
+    Returns (socket, symmetric key, server hello), the encrypted file follows on the socket.
     """
 
+    server = f"{hostname}:{tcp_port}"
+    saved = tickets.get(server) if tickets else None
+    if known_servers is None:
+        known_servers = KnownServers.shared()
+
     # Now the server knows about us
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.connect((hostname, tcp_port))
 
-    full_msg = b""
-
-    # Step 1: Server task
-
-    ### Step 2: RECV -> Server Public key ###
-    full_msg = recv_data(s)
-    full_msg = full_msg.decode('utf-8')
-    public_key = rsa.import_key(full_msg)
-
-    ### Step 3: SEND -> Encrypted Symmetric key ###
-    symmetric_key = get_random_bytes(32)
+    ### Step 0: SEND -> Client hello, RECV -> Server hello ###
+    client_random = get_random_bytes(RANDOM_SIZE)
+    hello = {"random": client_random.hex(), "ticket": saved[0].hex() if saved else None}
+    if byte_range is not None:
+        hello["range"] = list(byte_range)
+    if name is not None:
+        hello["name"] = name
+    if session:
+        hello["session"] = True
+    if compression:
+        hello["compression"] = sorted(METHODS)
+    hello["kex"] = list(kex)
+    if X25519 in kex:
+        share_key, share = new_share()
+        hello["share"] = share.hex()
+    client_hello = json.dumps(hello).encode()
+    send_frame(s, client_hello)
+
+    server_hello_data = bytes(recv_frame(s, max_size=4096))
+    server_hello = json.loads(server_hello_data)
+    if "error" in server_hello:
+        s.close()
+        if server_hello["error"] == "No such file":
+            raise FileNotFoundError(f"{server_hello['error']}: {name}")
+        raise ConnectionError(server_hello["error"])
+    server_random = bytes.fromhex(server_hello["random"])
+
+    # Servers from before the X25519 exchange do not say which method they use, they only know RSA
+    method = server_hello.get("kex", RSA)
+    if method not in kex:
+        raise ValueError(f"Server picked the key exchange method {method}, which the client did not offer")
+
+    if server_hello["resumed"]:
+        if saved is None:
+            raise ValueError("Server resumed a session the client never asked for")
+        # The server accepted the ticket, steps 1 to 4 are skipped
+        master_key = saved[1]
+
+    elif method == X25519:
+        # Step 1: Server task
+
+        ### Step 2: RECV -> Server identity key and signature of both hellos ###
+        identity = verify_handshake(bytes(recv_frame(s, max_size=4096)), client_hello, server_hello_data)
+        known_servers.check(server, identity)
+
+        # Both shares were in the hellos, the master key follows from them without another message
+        master_key = derive_master_key(share_key, bytes.fromhex(server_hello["share"]), client_random, server_random)
+
+    else:
+        # The RSA key is not signed, a server known to have an identity key must prove it with X25519
+        if known_servers.known(server):
+            s.close()
+            raise ValueError(f"{server} has an identity key in {known_servers.path} but picked the unsigned RSA "
+                             "key exchange, refusing it")
+
+        # Step 1: Server task
+
+        ### Step 2: RECV -> Server Public key ###
+        public_key = rsa.import_key(bytes(recv_frame(s)))
+
+        ### Step 3: SEND -> Encrypted Symmetric key ###
+        master_key = get_random_bytes(32)
+
+        # Encrypt the Symmetric key using the given Public key
+        rsa_cipher = PKCS1_OAEP.new(public_key)
+        encrypted_symmetric_key = rsa_cipher.encrypt(master_key)
+
+        # Send encrypted Symmetric key
+        send_frame(s, encrypted_symmetric_key)
+
+        # Step 4: Server task
+
+    # The key for this connection, derived the same way on both sides
+    symmetric_key = derive_session_key(master_key, client_random, server_random)
+
+    ### RECV -> New session ticket ###
+    frame = recv_frame(s, max_size=4096)
+    message, _ = ChunkOpener(symmetric_key, NEW_TICKET).open(frame)
+    new_ticket = json.loads(message)
+    if tickets is not None:
+        tickets.put(server, bytes.fromhex(new_ticket["ticket"]), master_key, new_ticket["lifetime"])
+
+    return s, symmetric_key, server_hello
+
+
+def receive_file(hostname, tcp_port, save_path, ticket_path=TICKET_FILE, name=None, compression=True,
+                 crypto_workers=1, kex=KEX_METHODS):
+    """
+    Will receive a file and store it.
+    Recieves the file from the given port and store it at the given path.
 
-    # Encrypt the Symmetric key using the given Public key
-    rsa_cipher = PKCS1_OAEP.new(public_key)
-    encrypted_symmetric_key = rsa_cipher.encrypt(symmetric_key)
+    A session ticket from an earlier connection to the same server is read from ticket_path,
+    so the key exchange can be skipped, and the new ticket is stored there. None disables tickets.
+    With more than one crypto worker, the chunks are decrypted on several cores at once.
+    """
 
-    # Send encrypted Symmetric key
-    data = pickle.dumps(encrypted_symmetric_key)
-    send_data(s, data)
+    tickets = TicketStore(ticket_path) if ticket_path else None
+    s, symmetric_key, server_hello = connect(hostname, tcp_port, tickets, name=name, compression=compression,
+                                             kex=kex)
 
-    # Step 4: Server task
     # Step 5: Server task
 
     ### Step 6: RECV -> Encrypted file ###
-    with open(save_path, 'wb') as f:
-
-        # Receive the encrypted file and initialization vector (iv)
-        full_msg = recv_data(s)
-        full_msg = pickle.loads(full_msg)
-        iv = full_msg[:aes.block_size]
-        encrypted_file = full_msg[aes.block_size:]
-
-        # Decrypt the file using the symmetric key and initialization vector
-        aes_decipher = aes.new(symmetric_key, aes.MODE_CBC, iv=iv)
-        file = aes_decipher.decrypt(encrypted_file)
-        file = unpad(file, aes.block_size)
+    with s, open(save_path, 'wb') as f:
+        recv_file_data(s, symmetric_key, server_hello, f, CryptoPool(crypto_workers) if crypto_workers > 1 else None)
 
-        f.write(file)
+    print("File received successfully" + (" (resumed session)" if server_hello["resumed"] else ""))
 
-    print("File received successfully")
 
+def recv_file_data(s : socket.socket, symmetric_key : bytes, server_hello : dict, f, crypto : CryptoPool = None) -> int:
+    """
+    Receives the file that follows the handshake of connect and writes it to f, returns its size.
+    """
 
-def send_data(socket : socket.socket, data : bytes):
+    # Receive, verify and decrypt the file one chunk at a time,
+    # every chunk is written as soon as it has been verified
+    opener = ChunkOpener(symmetric_key, SERVER_TO_CLIENT)
+    if server_hello.get("cached"):
+        # A file from the server's cache is encrypted under its own content key, which comes first
+        content_key, _ = ChunkOpener(symmetric_key, CONTENT_KEY).open(recv_frame(s, max_size=4096))
+        opener = ChunkOpener(content_key, CONTENT)
+    if server_hello.get("compression"):
+        return recv_compressed_stream(s, opener, f)
+    if crypto is not None:
+        return crypto.recv_stream(s, opener, f)
+    return recv_stream(s, opener, f)
+
+
+def _receive_piece(hostname, tcp_port, tickets : TicketStore, name : str, compression : bool, kex : list,
+                   known_servers : KnownServers, fd : int, offset : int, length : int):
     """
-    Helper function to send data.
+    Fetches one byte range over its own connection and writes it at its offset in the output file.
     """
 
-    # Create a "Header" at the start of the message to tell the receiver how large the message is in bytes
-    msg = bytes(f"{len(data):<{HEADERSIZE}}", 'utf-8') + data
-    
-    # Send message
-    print(f"Data sent from client: \n{msg}\n")
-    socket.send(msg)
+    s, symmetric_key, server_hello = connect(hostname, tcp_port, tickets, (offset, length), name,
+                                             compression=compression, kex=kex, known_servers=known_servers)
+    with s:
+        # A range that covers the whole file may come from the server's cache, recv_file_data handles that
+        received = recv_file_data(s, symmetric_key, server_hello, RangeWriter(fd, offset))
+
+    if received != length:
+        raise ValueError(f"Range at {offset} has {received} bytes instead of {length}, the file changed on the server")
 
+    # The data must be on disk before the manifest says the piece is done
+    os.fsync(fd)
 
-def recv_data(socket : socket.socket) -> bytes:
+
+def receive_file_ranges(hostname, tcp_port, save_path, connections=4, piece_size=PIECE_SIZE,
+                        ticket_path=TICKET_FILE, name=None, compression=True, kex=KEX_METHODS):
     """
-    Helper function to recieve data
+    Will receive a file and store it, over several connections at the same time.
+    The file is split into pieces of piece_size bytes, each fetched with a byte range request over its own
+    connection and written straight to its place in the output file. The completed pieces are recorded in
+    save_path + ".manifest", so running it again after an interruption only fetches the missing pieces.
     """
 
-    full_msg = b""
-    new_msg = True
-
-    while True:
-        # Receive data in upredictable bytes at a time
-        data = socket.recv(RECV_SIZE)
+    tickets = TicketStore(ticket_path) if ticket_path else None
+    known_servers = KnownServers.shared()
+
+    # An empty range tells us the size of the file, and gets the other connections a session ticket
+    s, _, server_hello = connect(hostname, tcp_port, tickets, (0, 0), name, kex=kex, known_servers=known_servers)
+    s.close()
+    size = server_hello["size"]
+
+    manifest = Manifest(save_path + ".manifest", size, server_hello["mtime"], piece_size)
+    if not os.path.exists(save_path) or os.path.getsize(save_path) != size:
+        manifest.done.clear()
+
+    fd = os.open(save_path, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        if not manifest.resumed:
+            preallocate(fd, size)
+
+        pieces = manifest.pieces()
+        if manifest.resumed:
+            print(f"Resuming, {len(pieces)} of {len(pieces) + len(manifest.done)} pieces left")
+
+        with ThreadPoolExecutor(max_workers=connections) as pool:
+            futures = {
+                pool.submit(_receive_piece, hostname, tcp_port, tickets, name, compression, kex, known_servers, fd,
+                            offset, length): index
+                for index, offset, length in pieces
+            }
+            for future in as_completed(futures):
+                future.result()
+                manifest.complete(futures[future])
+    finally:
+        os.close(fd)
+
+    manifest.remove()
+    print("File received successfully")
 
-        # Check if this is the first received data
-        if new_msg:
-            # Read header to find the size of the entire message in bytes
-            msg_len = int(data[:HEADERSIZE])
-            new_msg = False
 
-        full_msg += data
+class Session:
+    """
+    One connection over which files are listed, looked up and fetched by name,
+    for a server that serves a directory.
 
-        # Check if recieved full message
-        if len(full_msg) - HEADERSIZE == msg_len:
-            print(f"Data received in client: \n{full_msg}\n")
-            return full_msg[HEADERSIZE:]
+    Requests are pipelined: up to window requests are sent before the answer to the first one is read,
+    so fetching many small files does not cost a round trip per file.
+    """
 
+    def __init__(self, hostname, tcp_port, ticket_path=TICKET_FILE, window=32, compression=True, crypto_workers=1,
+                 kex=KEX_METHODS):
+        tickets = TicketStore(ticket_path) if ticket_path else None
+        self.socket, symmetric_key, server_hello = connect(hostname, tcp_port, tickets, session=True,
+                                                           compression=compression, kex=kex)
+        self.compressed = bool(server_hello.get("compression"))
+        self.crypto = CryptoPool(crypto_workers) if crypto_workers > 1 else None
+        self.sealer = ChunkSealer(symmetric_key, CLIENT_TO_SERVER)
+        self.opener = ChunkOpener(symmetric_key, SERVER_TO_CLIENT)
+        self.window = window
+
+    def _send(self, request : dict):
+        send_frame(self.socket, self.sealer.seal(json.dumps(request).encode(), final=True))
+
+    def _recv(self) -> dict:
+        message, _ = self.opener.open(recv_frame(self.socket, max_size=MAX_CHUNK_SIZE))
+        response = json.loads(message)
+        if not response["ok"]:
+            raise FileNotFoundError(response["error"])
+        return response
+
+    def list(self, prefix : str = "") -> list:
+        """
+        Every served file whose name starts with prefix, as {"name", "size", "mtime", "sha256"}.
+        """
+
+        self._send({"op": "list", "prefix": prefix})
+        return self._recv()["files"]
+
+    def stat(self, name : str) -> dict:
+        self._send({"op": "stat", "name": name})
+        return self._recv()["file"]
+
+    def get(self, name : str, save_path : str) -> dict:
+        return self.get_many([(name, save_path)])[0]
+
+    def get_many(self, files) -> list:
+        """
+        Fetches every (name, save path) pair, returns the file entries in the same order.
+        """
+
+        files = iter(files)
+        pending = deque()
+        results = []
+
+        def fill():
+            while len(pending) < self.window:
+                item = next(files, None)
+                if item is None:
+                    return
+                self._send({"op": "get", "name": item[0]})
+                pending.append(item)
+
+        fill()
+        while pending:
+            name, save_path = pending.popleft()
+            # Keep the window full, so the server has the next request while this file is streamed
+            fill()
+
+            response = self._recv()
+            with open(save_path, 'wb') as f:
+                if "content_key" in response:
+                    # The file comes from the server's cache, encrypted under its own content key
+                    received = recv_stream(self.socket, ChunkOpener(bytes.fromhex(response["content_key"]), CONTENT), f)
+                elif self.compressed:
+                    received = recv_compressed_stream(self.socket, self.opener, f)
+                elif self.crypto is not None and response["length"] > CHUNK_SIZE:
+                    received = self.crypto.recv_stream(self.socket, self.opener, f)
+                else:
+                    received = recv_stream(self.socket, self.opener, f)
+            if received != response["length"]:
+                raise ValueError(f"{name} has {received} bytes instead of {response['length']}")
+            results.append(response["file"])
+
+        return results
+
+    def sync(self, name : str, save_path : str) -> dict:
+        """
+        Brings the copy at save_path up to date with the served file. When there is a copy, only the blocks
+        that changed are sent (see ftdelta.py), otherwise the whole file is fetched.
+        Returns the file entry, with "received" set to the bytes of file data that were sent.
+        """
+
+        if not os.path.isfile(save_path) or not available():
+            info = self.get(name, save_path)
+            return dict(info, received=info["size"])
+
+        block_size, blocks, signature, sha256 = make_signature(save_path)
+        self._send({"op": "delta", "name": name, "sha256": sha256, "block_size": block_size, "blocks": blocks})
+        writer = StreamWriter(self.socket, self.sealer)
+        writer.write(signature)
+        writer.close()
+
+        response = self._recv()
+        info = response["file"]
+        if response["unchanged"]:
+            return dict(info, received=0)
+
+        tmp = save_path + ".delta"
+        try:
+            new_sha256, received = apply_delta(StreamReader(self.socket, self.opener), save_path, tmp, block_size)
+            if new_sha256 != info["sha256"]:
+                raise ValueError(f"{name} does not match the server's SHA-256 after the delta")
+            os.replace(tmp, save_path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return dict(info, received=received)
+
+    def close(self):
+        try:
+            self._send({"op": "bye"})
+        finally:
+            self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def local_path(directory : str, name : str) -> str:
+    """
+    Where a served file is stored under directory, refusing names that would end up outside it.
+    """
 
-def main():
-    # Check if the correct number of arguments is provided
-    if len(sys.argv) != 2:
-        print("Usage: python ftclient.py <hostname of the server>")
-        return
+    parts = name.split("/")
+    if name.startswith("/") or any(part in ("", ".", "..") for part in parts):
+        raise ValueError(f"Refusing to store {name!r}")
+    return os.path.join(directory, *parts)
 
-    arg = sys.argv[1]
 
-    receive_file(arg, 12345, "receivedData.txt")
+def main():
+    parser = argparse.ArgumentParser(description="Encrypted file transfer client")
+    parser.add_argument("hostname", help="hostname of the server")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--output", default="receivedData.txt", help="where to store the received file")
+    parser.add_argument("--name", default=None, help="file to fetch when the server serves a directory")
+    parser.add_argument("--ticket-file", default=TICKET_FILE, help="where session tickets are kept")
+    parser.add_argument("--no-resume", action="store_true", help="always do the full key exchange")
+    parser.add_argument("--kex", nargs="+", choices=KEX_METHODS, default=KEX_METHODS,
+                        help="key exchange methods to offer, the server picks one")
+    parser.add_argument("--no-compression", action="store_true", help="do not let the server compress the file data")
+    parser.add_argument("--crypto-workers", type=int, default=default_workers(),
+                        help="threads decrypting the chunks of a file in parallel, 1 decrypts in the receiving thread")
+    parser.add_argument("--connections", type=int, default=1,
+                        help="fetch the file as byte ranges over this many connections, resumable if interrupted")
+    parser.add_argument("--piece-size", type=int, default=PIECE_SIZE, help="bytes per range in parallel mode")
+    parser.add_argument("--list", nargs="?", const="", metavar="PREFIX",
+                        help="list the served files (whose names start with PREFIX)")
+    parser.add_argument("--stat", metavar="NAME", help="show size, mtime and SHA-256 of a served file")
+    parser.add_argument("--get", nargs="+", metavar="NAME", help="fetch these files over one connection")
+    parser.add_argument("--get-all", nargs="?", const="", metavar="PREFIX",
+                        help="fetch every served file (whose name starts with PREFIX) over one connection")
+    parser.add_argument("--sync", nargs="+", metavar="NAME",
+                        help="update these files in --directory, sending only the blocks that changed")
+    parser.add_argument("--directory", default="received", help="where --get, --get-all and --sync store the files")
+    args = parser.parse_args()
+
+    ticket_path = None if args.no_resume else args.ticket_file
+    compression = not args.no_compression
+
+    if args.list is not None or args.stat or args.get or args.get_all is not None or args.sync:
+        with Session(args.hostname, args.port, ticket_path, compression=compression,
+                     crypto_workers=args.crypto_workers, kex=args.kex) as session:
+            if args.list is not None:
+                for f in session.list(args.list):
+                    print(f"{f['size']:>14} {f['sha256'][:16]} {f['name']}")
+            if args.stat:
+                print(json.dumps(session.stat(args.stat), indent=2))
+
+            names = list(args.get or [])
+            if args.get_all is not None:
+                names += [f["name"] for f in session.list(args.get_all)]
+            if names:
+                files = [(name, local_path(args.directory, name)) for name in names]
+                for _, path in files:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                start = time.perf_counter()
+                received = session.get_many(files)
+                size = sum(f["size"] for f in received)
+                print(f"Received {len(received)} files, {size} bytes in {time.perf_counter() - start:.2f}s")
+
+            for name in args.sync or []:
+                path = local_path(args.directory, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                start = time.perf_counter()
+                info = session.sync(name, path)
+                print(f"Synced {name}, {info['received']} of {info['size']} bytes sent "
+                      f"in {time.perf_counter() - start:.2f}s")
+
+    elif args.connections > 1:
+        receive_file_ranges(args.hostname, args.port, args.output, args.connections, args.piece_size, ticket_path,
+                            args.name, compression, args.kex)
+    else:
+        receive_file(args.hostname, args.port, args.output, ticket_path, args.name, compression, args.crypto_workers,
+                     args.kex)
 
 
 if __name__ == "__main__":
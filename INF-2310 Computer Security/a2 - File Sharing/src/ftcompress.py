@@ -0,0 +1,172 @@
+# Optional compression of the file data before it is encrypted.
+#
+# Every chunk is compressed on its own, so the stream stays a stream and the receiver never needs more than
+# one chunk in memory. A chunk is only compressed when that saves enough bytes and the compression workers
+# together are faster than the link, otherwise compressing would make the transfer slower instead of faster.
+# How well a chunk compresses is predicted by a trial compression of a sample with zlib's fastest level.
+# How fast the chosen method compresses is measured on the chunks it compresses, since a trial on a small
+# sample would mostly measure the setup cost of the compressor.
+# The codec of every chunk is its first plaintext byte, inside the encryption:
+#     codec (1 byte) | data, raw or compressed
+# Chunks are compressed in a thread pool a few chunks ahead of the one being sent. zlib and lzma release
+# the GIL, so compression overlaps with encryption and network I/O.
+
+import lzma
+import os
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from ftframe import send_frame, recv_frame
+from ftstream import CHUNK_SIZE, MAX_CHUNK_SIZE, TAG_SIZE, ChunkOpener, ChunkSealer
+
+
+RAW = 0
+ZLIB = 1
+LZMA = 2
+METHODS = {"zlib": ZLIB, "lzma": LZMA}
+
+SAMPLE_SIZE = 64 * 1024
+# A chunk is sent raw when compression would save less than this fraction of it
+MIN_SAVING = 0.05
+# Link speed in bytes per second the decision assumes, 100 Mbit/s
+LINK_SPEED = 100 * 1000 * 1000 // 8
+# When compression is too slow for the link, one chunk in this many is still compressed to keep the speed current
+PROBE_EVERY = 16
+
+
+def _compress(codec : int, data, level : int) -> bytes:
+    if codec == ZLIB:
+        return zlib.compress(data, level)
+    return lzma.compress(data, preset=level)
+
+
+class Compressor:
+    """
+    Compresses chunks with one method in a pool of worker threads, shared by all connections.
+    """
+
+    def __init__(self, method : str = "zlib", level : int = None, link_speed : float = LINK_SPEED,
+                 workers : int = None):
+        self.method = method
+        self.codec = METHODS[method]
+        # zlib's default level, and lzma's fastest preset since lzma is slow already
+        self.level = level if level is not None else (6 if self.codec == ZLIB else 1)
+        self.link_speed = link_speed
+        self.workers = min(workers or os.cpu_count() or 1, os.cpu_count() or 1)
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="compress")
+        # Bytes per second of CPU time one worker compresses, None until the first chunk is compressed
+        self.speed = None
+        self._lock = threading.Lock()
+        self._skipped = 0
+
+    def pays_off(self, data) -> bool:
+        """
+        Whether compressing data makes the transfer faster.
+        With the workers compressing in parallel and ahead of the sender, the transfer runs at the speed of
+        the slower of the two, so compression pays off when it saves bytes and is faster than the link.
+        """
+
+        sample = data[:SAMPLE_SIZE]
+        if len(sample) < 512:
+            return False
+
+        saving = 1 - len(zlib.compress(sample, 1)) / len(sample)
+        if saving < MIN_SAVING:
+            return False
+
+        if self.speed is None or self.workers * self.speed > self.link_speed:
+            return True
+        with self._lock:
+            self._skipped += 1
+            return self._skipped % PROBE_EVERY == 0
+
+    def compress_chunk(self, data) -> bytes:
+        """
+        The chunk as codec byte and data, compressed if that pays off.
+        """
+
+        if self.pays_off(data):
+            start = time.thread_time()
+            body = _compress(self.codec, data, self.level)
+            speed = len(data) / max(time.thread_time() - start, 1e-6)
+            with self._lock:
+                self.speed = speed if self.speed is None else 0.8 * self.speed + 0.2 * speed
+
+            if len(body) < len(data):
+                return bytes((self.codec,)) + body
+        return bytes((RAW,)) + bytes(data)
+
+
+def send_compressed_stream(sock, sealer : ChunkSealer, f, compressor : Compressor, chunk_size : int = CHUNK_SIZE,
+                           limit : int = None) -> int:
+    """
+    Like send_stream, but every chunk is compressed first when that pays off.
+    Up to two chunks per worker are read and compressed ahead, they are sent in order.
+    Returns the number of file bytes sent.
+    """
+
+    window = 2 * compressor.workers
+    pending = deque()
+    total = 0
+    final = False
+
+    while True:
+        while not final and len(pending) < window:
+            want = chunk_size if limit is None else min(chunk_size, limit - total)
+            data = f.read(want)
+            total += len(data)
+            # A short read means end of file, a full chunk at the very end is followed by an empty final chunk
+            final = len(data) < want or total == limit
+            pending.append((compressor.pool.submit(compressor.compress_chunk, data), final))
+
+        future, last = pending.popleft()
+        send_frame(sock, sealer.seal(future.result(), last))
+        if last:
+            return total
+
+
+def _decompress(codec : int, body) -> bytes:
+    if codec == RAW:
+        return body
+    if codec == ZLIB:
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(body, MAX_CHUNK_SIZE)
+        done = decompressor.eof and not decompressor.unconsumed_tail
+    elif codec == LZMA:
+        decompressor = lzma.LZMADecompressor()
+        data = decompressor.decompress(body, MAX_CHUNK_SIZE)
+        done = decompressor.eof
+    else:
+        raise ValueError(f"Unknown codec {codec}")
+
+    # A chunk that decompresses to more than the largest chunk is refused instead of filling the memory
+    if not done:
+        raise ValueError("Compressed chunk is damaged or too large")
+    return data
+
+
+def recv_compressed_stream(sock, opener : ChunkOpener, f) -> int:
+    """
+    Receives a stream sent by send_compressed_stream, decompressing every chunk after it is verified.
+    Returns the number of bytes written.
+    """
+
+    frame_buffer = bytearray(CHUNK_SIZE + 2 + TAG_SIZE)
+
+    total = 0
+    while True:
+        frame = recv_frame(sock, frame_buffer, max_size=MAX_CHUNK_SIZE + 2 + TAG_SIZE)
+        if len(frame) > len(frame_buffer):
+            frame_buffer = frame.obj
+
+        plain, final = opener.open(frame)
+        if not plain:
+            raise ValueError("Chunk without codec")
+        data = _decompress(plain[0], memoryview(plain)[1:])
+        f.write(data)
+        total += len(data)
+        if final:
+            return total
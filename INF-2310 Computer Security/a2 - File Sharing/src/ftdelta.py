@@ -0,0 +1,300 @@
+# Block-level delta transfer of a file the client already has an older copy of, in the style of rsync.
+#
+# The client splits its copy into blocks and sends a signature: for every full block a weak checksum that can
+# be rolled along the file one byte at a time, and a strong hash. The server slides a window over its version
+# of the file and looks for windows whose weak checksum is in the signature; the strong hash confirms a match.
+# Matching blocks are sent as references to the client's blocks, everything in between as literal data:
+#     b"C" | first block (4 bytes) | count (4 bytes)     copy count blocks from the client's copy
+#     b"L" | length (4 bytes) | data                     literal data
+# Both the signature and the delta go over the session as encrypted streams (see ftstream.py).
+# The client builds the new file next to the old one from the two, checks its SHA-256 against the catalog,
+# and replaces the old copy with it.
+#
+# The checksums are computed with numpy, for every window of a segment of the file at once. numpy is only
+# imported when a delta is made, the rest of the program works without it.
+
+import hashlib
+import os
+import struct
+
+from ftstream import CHUNK_SIZE
+
+
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+# Bytes of the file the server checks at once, the arrays for them take about 40 times as much memory
+SEGMENT_SIZE = 1024 * 1024
+STRONG_SIZE = 16
+# Largest signature the server accepts, enough for a 512 GiB file with the largest blocks
+MAX_BLOCKS = 4 * 1024 * 1024
+
+_ENTRY = struct.Struct(f"!I{STRONG_SIZE}s")
+ENTRY_SIZE = _ENTRY.size
+_COPY = struct.Struct("!II")
+_LITERAL = struct.Struct("!I")
+
+
+def available() -> bool:
+    """
+    Whether deltas can be made here, that is whether numpy is installed.
+    """
+
+    try:
+        import numpy
+    except ImportError:
+        return False
+    return True
+
+
+def block_size_for(size : int) -> int:
+    """
+    Block size for a file of size bytes: the power of two nearest to its square root, as rsync does,
+    which keeps both the signature and the data sent for a changed block small.
+    """
+
+    block_size = MIN_BLOCK_SIZE
+    while block_size < MAX_BLOCK_SIZE and block_size * block_size < size:
+        block_size *= 2
+    return block_size
+
+
+def strong_hash(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=STRONG_SIZE).digest()
+
+
+def _weak_blocks(np, blocks):
+    """
+    Weak checksum of every row of a 2D array of bytes: the sum of the bytes in the low 16 bits,
+    and the sum of the bytes weighted by their distance to the end of the block in the high 16 bits.
+    """
+
+    block_size = blocks.shape[1]
+    x = blocks.astype(np.int64)
+    a = x.sum(axis=1)
+    b = (x * np.arange(block_size, 0, -1, dtype=np.int64)).sum(axis=1)
+    return ((a & 0xFFFF) | ((b & 0xFFFF) << 16)).astype(np.uint32)
+
+
+def _weak_windows(np, data, block_size : int):
+    """
+    Weak checksum of every window of block_size bytes in data, the same as _weak_blocks gives for a block.
+    Computed from prefix sums, so every window costs the same whatever the block size.
+    """
+
+    x = np.frombuffer(data, dtype=np.uint8).astype(np.int64)
+    s1 = np.zeros(len(x) + 1, dtype=np.int64)
+    np.cumsum(x, out=s1[1:])
+    s2 = np.zeros(len(x) + 1, dtype=np.int64)
+    np.cumsum(x * np.arange(len(x), dtype=np.int64), out=s2[1:])
+
+    start = np.arange(len(x) - block_size + 1, dtype=np.int64)
+    a = s1[block_size:] - s1[:-block_size]
+    b = (start + block_size) * a - (s2[block_size:] - s2[:-block_size])
+    return ((a & 0xFFFF) | ((b & 0xFFFF) << 16)).astype(np.uint32)
+
+
+def make_signature(path : str, block_size : int = None) -> tuple:
+    """
+    Signature of the file at path as (block size, number of blocks, signature bytes, SHA-256 of the file).
+    Only full blocks are in the signature, a short last block is sent as literal data when it is used.
+    """
+
+    import numpy as np
+
+    if block_size is None:
+        block_size = block_size_for(os.path.getsize(path))
+
+    whole = hashlib.sha256()
+    entries = bytearray()
+    blocks = 0
+    batch = max(CHUNK_SIZE // block_size, 1) * block_size
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(batch)
+            if not data:
+                break
+            whole.update(data)
+
+            full = len(data) // block_size
+            if full == 0:
+                continue
+            weak = _weak_blocks(np, np.frombuffer(data, dtype=np.uint8, count=full * block_size).reshape(full, block_size))
+            view = memoryview(data)
+            for i in range(full):
+                entries += _ENTRY.pack(int(weak[i]), strong_hash(view[i * block_size:(i + 1) * block_size]))
+            blocks += full
+
+    return block_size, blocks, bytes(entries), whole.hexdigest()
+
+
+def parse_signature(data : bytes, blocks : int) -> tuple:
+    """
+    The weak checksums of a signature as a dict from checksum to block indexes, and the strong hashes as a list.
+    """
+
+    if len(data) != blocks * _ENTRY.size:
+        raise ValueError("Signature does not match its block count")
+
+    weak = {}
+    strong = []
+    for index, (checksum, digest) in enumerate(_ENTRY.iter_unpack(data)):
+        weak.setdefault(checksum, []).append(index)
+        strong.append(digest)
+    return weak, strong
+
+
+class _DeltaWriter:
+    """
+    Encodes the delta records, joining consecutive block references into one.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.run = None
+        self.literal_bytes = 0
+        self.copied_blocks = 0
+
+    def copy(self, index : int):
+        self.copied_blocks += 1
+        if self.run is not None and self.run[0] + self.run[1] == index:
+            self.run[1] += 1
+            return
+        self._flush()
+        self.run = [index, 1]
+
+    def literal(self, data):
+        if not data:
+            return
+        self._flush()
+        view = memoryview(data)
+        for start in range(0, len(view), CHUNK_SIZE):
+            piece = view[start:start + CHUNK_SIZE]
+            self.out.write(b"L" + _LITERAL.pack(len(piece)))
+            self.out.write(piece)
+        self.literal_bytes += len(view)
+
+    def _flush(self):
+        if self.run is not None:
+            self.out.write(b"C" + _COPY.pack(*self.run))
+            self.run = None
+
+    def close(self):
+        self._flush()
+
+
+def make_delta(path : str, block_size : int, signature : tuple, out) -> tuple:
+    """
+    Writes the delta that turns the client's copy described by signature (from parse_signature) into
+    the file at path to the file-like out. Returns (literal bytes, copied blocks).
+    """
+
+    import numpy as np
+
+    weak, strong = signature
+    known = np.array(sorted(weak), dtype=np.uint32)
+    # Table indexed by the top 24 bits of a checksum, a quick filter before the exact lookup in known
+    table = np.zeros(1 << 24, dtype=bool)
+    table[known >> 8] = True
+    writer = _DeltaWriter(out)
+
+    def match(window, checksum : int) -> int:
+        digest = strong_hash(window)
+        for index in weak[checksum]:
+            if strong[index] == digest:
+                return index
+        return None
+
+    # buffer holds the file from offset base, nothing before scan can start a match any more
+    buffer = bytearray()
+    base = 0
+    scan = 0
+    expected = 0
+    eof = False
+    with open(path, 'rb') as f:
+        while not eof:
+            data = f.read(SEGMENT_SIZE)
+            eof = not data
+            buffer += data
+            end = base + len(buffer)
+            view = memoryview(buffer)
+
+            # Unchanged data follows the blocks of the old copy in order, those are found by the strong hash alone
+            while scan + block_size <= end and expected < len(strong) and \
+                    strong_hash(view[scan - base:scan - base + block_size]) == strong[expected]:
+                writer.copy(expected)
+                expected += 1
+                scan += block_size
+
+            if end - scan >= block_size:
+                checksums = _weak_windows(np, view[scan - base:], block_size)
+                candidates = np.flatnonzero(table[checksums >> 8])
+                candidates = candidates[np.isin(checksums[candidates], known)]
+                literal_start = scan
+                for i in candidates.tolist():
+                    start = literal_start + i
+                    if start < scan:
+                        continue
+                    index = match(view[start - base:start - base + block_size], int(checksums[i]))
+                    if index is not None:
+                        writer.literal(view[scan - base:start - base])
+                        writer.copy(index)
+                        expected = index + 1
+                        scan = start + block_size
+                # A window that starts before the last block_size - 1 bytes has been checked
+                literal_end = max(scan, end - block_size + 1)
+                writer.literal(view[scan - base:literal_end - base])
+                scan = literal_end
+
+            if eof:
+                writer.literal(view[scan - base:])
+                scan = end
+
+            view.release()
+            del buffer[:scan - base]
+            base = scan
+
+    writer.close()
+    return writer.literal_bytes, writer.copied_blocks
+
+
+def apply_delta(reader, old_path : str, new_path : str, block_size : int) -> str:
+    """
+    Builds the new file at new_path from the delta read from reader (a StreamReader) and the client's
+    copy at old_path. Returns the SHA-256 of the new file and the number of literal bytes that were received.
+    """
+
+    h = hashlib.sha256()
+    literal_bytes = 0
+    fd = os.open(new_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    with open(old_path, 'rb') as old, os.fdopen(fd, 'wb') as out:
+        while True:
+            kind = reader.read(1)
+            if not kind:
+                break
+
+            if kind == b"C":
+                first, count = _COPY.unpack(reader.read_exact(_COPY.size))
+                old.seek(first * block_size)
+                remaining = count * block_size
+                while remaining:
+                    data = old.read(min(remaining, CHUNK_SIZE))
+                    if not data:
+                        raise ValueError("Delta refers to a block past the end of the old copy")
+                    out.write(data)
+                    h.update(data)
+                    remaining -= len(data)
+            elif kind == b"L":
+                length, = _LITERAL.unpack(reader.read_exact(_LITERAL.size))
+                if length > CHUNK_SIZE:
+                    raise ValueError("Literal record is too large")
+                data = reader.read_exact(length)
+                out.write(data)
+                h.update(data)
+                literal_bytes += length
+            else:
+                raise ValueError(f"Unknown delta record {kind!r}")
+
+        out.flush()
+        os.fsync(out.fileno())
+
+    return h.hexdigest(), literal_bytes
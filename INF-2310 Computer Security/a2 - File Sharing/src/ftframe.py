@@ -0,0 +1,59 @@
+# Framing shared by ftserv.py and ftclient.py.
+# Every message is sent as a frame: an 8 byte big-endian length header followed by the payload.
+
+import socket
+import struct
+
+
+HEADER = struct.Struct("!Q")
+
+# Payloads up to this size are joined with their header and sent with one call,
+# larger ones are sent after the header without being copied.
+SMALL_FRAME = 64 * 1024
+
+
+def send_frame(sock : socket.socket, data):
+    """
+    Sends one frame.
+    """
+
+    header = HEADER.pack(len(data))
+    if len(data) <= SMALL_FRAME:
+        sock.sendall(header + bytes(data))
+    else:
+        sock.sendall(header)
+        sock.sendall(data)
+
+
+def recv_exact_into(sock : socket.socket, view : memoryview):
+    """
+    Fills the whole view with data from the socket, reading straight into it.
+    """
+
+    while view:
+        n = sock.recv_into(view)
+        if n == 0:
+            raise ConnectionError("Connection closed in the middle of a frame")
+        view = view[n:]
+
+
+def recv_frame(sock : socket.socket, buffer : bytearray = None, max_size : int = None) -> memoryview:
+    """
+    Receives one frame and returns a view of its payload.
+    The payload is read into the given buffer if it is large enough, otherwise into a new one,
+    so a caller receiving many frames can reuse a single buffer.
+    """
+
+    header = bytearray(HEADER.size)
+    recv_exact_into(sock, memoryview(header))
+    (size,) = HEADER.unpack(header)
+
+    if max_size is not None and size > max_size:
+        raise ValueError(f"Frame of {size} bytes is larger than the allowed {max_size} bytes")
+
+    if buffer is None or len(buffer) < size:
+        buffer = bytearray(size)
+
+    view = memoryview(buffer)[:size]
+    recv_exact_into(sock, view)
+    return view
@@ -0,0 +1,165 @@
+# Key exchange with ephemeral X25519 keys, the fast alternative to the RSA handshake.
+#
+# The client lists the methods it supports in its hello, together with a fresh X25519 public key (its share).
+# A server that picks X25519 answers with its own share in the server hello, and then sends its long-term
+# Ed25519 identity key with a signature of both hellos:
+#     identity key (32 bytes) | signature (64 bytes)
+# Both sides compute the same X25519 secret from their own private key and the other's share, and derive the
+# master key from it with HKDF. The rest of the handshake (tickets, session keys) is the same as after RSA.
+#
+# The identity key is only used to sign, so the server does no RSA work at all, and the hellos carry the shares,
+# so the exchange takes no extra round trip. The ephemeral keys are thrown away after the handshake: a stolen
+# identity key does not decrypt earlier sessions, as a stolen RSA key does.
+# The client remembers the identity key of every server it has talked to (known_servers.json) and refuses
+# a server that shows a different one later, like ssh does. The RSA exchange is not signed, so a client
+# refuses it from a server whose identity key it knows: otherwise a man-in-the-middle could remove X25519 from
+# the client hello and answer with an RSA key of its own.
+
+import hashlib
+import os
+import threading
+
+from Crypto.Hash import SHA256
+from Crypto.Protocol.DH import import_x25519_public_key, key_agreement
+from Crypto.Protocol.KDF import HKDF
+from Crypto.PublicKey import ECC
+from Crypto.Signature import eddsa
+
+import ftstate
+
+
+X25519 = "x25519"
+RSA = "rsa"
+# In order of preference
+KEX_METHODS = [X25519, RSA]
+
+IDENTITY_FILE = "identitykey.pem"
+KNOWN_SERVERS_FILE = "known_servers.json"
+
+SHARE_SIZE = 32
+IDENTITY_SIZE = 32
+SIGNATURE_SIZE = 64
+
+
+def load_identity(path : str = IDENTITY_FILE):
+    """
+    The server's Ed25519 identity key, generated and saved to path the first time.
+    """
+
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return ECC.import_key(f.read())
+
+    print("Generating new identity key")
+    key = ECC.generate(curve="Ed25519")
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(key.export_key(format="PEM"))
+    return key
+
+
+def new_share() -> tuple:
+    """
+    A fresh X25519 key pair for one handshake, as (private key, public key bytes to send).
+    """
+
+    private_key = ECC.generate(curve="Curve25519")
+    return private_key, private_key.public_key().export_key(format="raw")
+
+
+def derive_master_key(private_key, peer_share : bytes, client_random : bytes, server_random : bytes) -> bytes:
+    """
+    Master key from our X25519 private key and the other side's share.
+    Raises ValueError for a share that is not a valid public key.
+    """
+
+    if len(peer_share) != SHARE_SIZE:
+        raise ValueError("Key share has the wrong size")
+
+    def kdf(secret):
+        return HKDF(secret, 32, client_random + server_random, SHA256, context=b"ft x25519 master key")
+
+    return key_agreement(kdf=kdf, eph_priv=private_key, eph_pub=import_x25519_public_key(peer_share))
+
+
+def _transcript(client_hello : bytes, server_hello : bytes) -> bytes:
+    return (b"ft handshake\0" + hashlib.sha256(client_hello).digest() + hashlib.sha256(server_hello).digest())
+
+
+def sign_handshake(identity, client_hello : bytes, server_hello : bytes) -> bytes:
+    """
+    The frame that proves the server hello comes from the owner of identity: its public key and a signature
+    of both hellos exactly as they were sent, shares and negotiated options included.
+    """
+
+    signature = eddsa.new(identity, "rfc8032").sign(_transcript(client_hello, server_hello))
+    return identity.public_key().export_key(format="raw") + signature
+
+
+def verify_handshake(frame : bytes, client_hello : bytes, server_hello : bytes) -> bytes:
+    """
+    Checks a frame made by sign_handshake, returns the server's identity key.
+    Raises ValueError if the signature does not match.
+    """
+
+    if len(frame) != IDENTITY_SIZE + SIGNATURE_SIZE:
+        raise ValueError("Handshake signature has the wrong size")
+    identity = frame[:IDENTITY_SIZE]
+    eddsa.new(eddsa.import_public_key(identity), "rfc8032").verify(_transcript(client_hello, server_hello),
+                                                                   frame[IDENTITY_SIZE:])
+    return identity
+
+
+class KnownServers:
+    """
+    The identity keys of the servers the client has talked to, kept in a JSON file.
+    The first key a server shows is trusted, after that only that key is accepted.
+    Safe to use from several threads, and several clients may share the file (see ftstate.py).
+    KnownServers.shared() gives the instance of a file that the whole process shares.
+    """
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, path : str = KNOWN_SERVERS_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._servers = ftstate.load(path)
+
+    @classmethod
+    def shared(cls, path : str = KNOWN_SERVERS_FILE):
+        """
+        The KnownServers of the file at path, one instance for every connection of the process.
+        """
+
+        with cls._shared_lock:
+            key = os.path.abspath(path)
+            if key not in cls._shared:
+                cls._shared[key] = cls(path)
+            return cls._shared[key]
+
+    def known(self, server : str) -> bool:
+        """
+        Whether server has shown an identity key before.
+        """
+
+        with self._lock:
+            return server in self._servers
+
+    def check(self, server : str, identity : bytes):
+        """
+        Raises ValueError if server has shown a different identity key before, remembers the key otherwise.
+        """
+
+        def pin(servers):
+            # Another client may have pinned the server since the file was read
+            known = servers.setdefault(server, identity.hex())
+            if known != identity.hex():
+                raise ValueError(f"The identity key of {server} has changed, remove it from {self.path} "
+                                 "if that is expected")
+
+        with self._lock:
+            if server in self._servers:
+                pin(self._servers)
+            else:
+                self._servers = ftstate.update(self.path, pin, indent=2)
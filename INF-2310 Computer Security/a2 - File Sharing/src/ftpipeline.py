@@ -0,0 +1,208 @@
+# Parallel versions of send_stream and recv_stream.
+#
+# The chunks of a stream are encrypted independently (the nonce only depends on the chunk's position), so they
+# can be encrypted and decrypted on several cores at once. A transfer runs in three stages:
+#     reader thread  ->  pool of crypto workers  ->  writer (the calling thread)
+# The reader reads the file (or receives frames from the socket) and hands every chunk to the pool, the writer
+# takes the results in chunk order and sends them (or writes them to the file). The queue between the stages
+# is bounded and the chunk buffers are recycled, so a slow writer stops the reader instead of using more memory.
+# AES in pycryptodome runs in C without holding the GIL, so the workers really run in parallel.
+# The produced stream is the same as that of send_stream, either side can use either version.
+
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ftframe import send_frame, recv_frame
+from ftstream import CHUNK_SIZE, FLAG_FINAL, MAX_CHUNK_SIZE, TAG_SIZE, ChunkOpener, ChunkSealer
+
+
+_POLL = 0.1
+
+
+def _put(q : queue.Queue, item, abort : threading.Event) -> bool:
+    """
+    Blocking put that gives up when abort is set, so a stage never waits for one that has stopped.
+    """
+
+    while not abort.is_set():
+        try:
+            q.put(item, timeout=_POLL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q : queue.Queue, abort : threading.Event):
+    while not abort.is_set():
+        try:
+            return q.get(timeout=_POLL)
+        except queue.Empty:
+            continue
+    return None
+
+
+def _run_pipeline(read, write, make_buffer, depth : int):
+    """
+    Runs read(put, get_buffer) in a reader thread and write(job, release_buffer) for every job it puts,
+    in order, in this thread. At most depth + 1 buffers are made, and only as many as the stream needs.
+    An exception in either stage stops both and is raised here.
+    """
+
+    jobs = queue.Queue(depth)
+    buffers = queue.Queue()
+    made = [0]
+    abort = threading.Event()
+    failure = []
+
+    def get_buffer():
+        try:
+            return buffers.get_nowait()
+        except queue.Empty:
+            if made[0] <= depth:
+                made[0] += 1
+                return make_buffer()
+            return _get(buffers, abort)
+
+    def reader():
+        try:
+            read(lambda job: _put(jobs, job, abort), get_buffer)
+        except BaseException as e:
+            failure.append(e)
+            _put(jobs, None, abort)
+
+    thread = threading.Thread(target=reader, name="stream-reader", daemon=True)
+    thread.start()
+    try:
+        while True:
+            job = _get(jobs, abort)
+            if job is None:
+                raise failure[0]
+            if write(job, buffers.put):
+                break
+    except BaseException:
+        # The reader may be blocked on the socket, it stops when the caller closes it
+        abort.set()
+        raise
+
+    # The reader has returned after the final chunk
+    thread.join()
+
+
+def send_stream_parallel(sock, sealer : ChunkSealer, f, pool, depth : int, chunk_size : int = CHUNK_SIZE,
+                         limit : int = None) -> int:
+    """
+    Sends the same stream as send_stream, encrypting up to depth chunks at once in pool.
+    Returns the number of bytes sent, and leaves the sealer's counter after the last chunk.
+    """
+
+    first = sealer.counter
+    sent = [0, 0]
+
+    def read(put, get_buffer):
+        total = 0
+        index = 0
+        while True:
+            buffer = get_buffer()
+            if buffer is None:
+                return
+            plain, sealed = buffer
+
+            want = chunk_size if limit is None else min(chunk_size, limit - total)
+            n = f.readinto(memoryview(plain)[:want])
+            total += n
+            # A short read means end of file, a full chunk at the very end is followed by an empty final chunk
+            final = n < want or total == limit
+
+            future = pool.submit(sealer.seal_chunk, first + index, memoryview(plain)[:n], memoryview(sealed), final)
+            if not put((future, buffer, n, final)):
+                return
+            index += 1
+            if final:
+                return
+
+    def write(job, release_buffer):
+        future, buffer, n, final = job
+        size = future.result()
+        send_frame(sock, memoryview(buffer[1])[:size])
+        release_buffer(buffer)
+        sent[0] += n
+        sent[1] += 1
+        return final
+
+    _run_pipeline(read, write, lambda: (bytearray(chunk_size), bytearray(chunk_size + 1 + TAG_SIZE)), depth)
+    sealer.counter = first + sent[1]
+    return sent[0]
+
+
+def recv_stream_parallel(sock, opener : ChunkOpener, f, pool, depth : int) -> int:
+    """
+    Receives a stream like recv_stream, decrypting and verifying up to depth chunks at once in pool.
+    The reader stops right after the final chunk, so frames that follow it stay on the socket.
+    Returns the number of bytes written, and leaves the opener's counter after the last chunk.
+    """
+
+    first = opener.counter
+    written = [0, 0]
+
+    def read(put, get_buffer):
+        index = 0
+        while True:
+            buffer = get_buffer()
+            if buffer is None:
+                return
+            frame_buffer, plain = buffer
+
+            frame = recv_frame(sock, frame_buffer, max_size=MAX_CHUNK_SIZE + 1 + TAG_SIZE)
+            if len(frame) - 1 - TAG_SIZE > len(plain):
+                plain = bytearray(len(frame) - 1 - TAG_SIZE)
+
+            # The flag is authenticated by the worker, a forged one makes the chunk fail verification
+            final = len(frame) > 0 and frame[0] == FLAG_FINAL
+            future = pool.submit(opener.open_chunk, first + index, frame, memoryview(plain))
+            if not put((future, buffer, plain)):
+                return
+            index += 1
+            if final:
+                return
+
+    def write(job, release_buffer):
+        future, buffer, plain = job
+        size, final = future.result()
+        f.write(memoryview(plain)[:size])
+        release_buffer(buffer)
+        written[0] += size
+        written[1] += 1
+        return final
+
+    _run_pipeline(read, write, lambda: (bytearray(CHUNK_SIZE + 1 + TAG_SIZE), bytearray(CHUNK_SIZE)), depth)
+    opener.counter = first + written[1]
+    return written[0]
+
+
+class CryptoPool:
+    """
+    Crypto workers shared by all transfers of a process, so many connections do not start a pool each.
+    """
+
+    def __init__(self, workers : int):
+        self.workers = workers
+        # Two chunks per worker in flight keep every worker busy while the writer sends the oldest one
+        self.depth = 2 * workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="crypto")
+
+    def send_stream(self, sock, sealer : ChunkSealer, f, chunk_size : int = CHUNK_SIZE, limit : int = None) -> int:
+        return send_stream_parallel(sock, sealer, f, self.executor, self.depth, chunk_size, limit)
+
+    def recv_stream(self, sock, opener : ChunkOpener, f) -> int:
+        return recv_stream_parallel(sock, opener, f, self.executor, self.depth)
+
+
+def default_workers() -> int:
+    """
+    Crypto workers to use when none are given: one per core, at most 8.
+    """
+
+    return min(os.cpu_count() or 1, 8)
@@ -0,0 +1,109 @@
+# Helpers for downloading a file as byte ranges over several connections.
+#
+# The output file is allocated at its full size up front, and every range is written straight to its
+# offset with os.pwrite, so the ranges can arrive in any order. The file is split into pieces of a fixed
+# size, and a small JSON manifest next to the output records which pieces are complete.
+# An interrupted download then only fetches the pieces that are missing.
+
+import json
+import os
+import threading
+
+
+PIECE_SIZE = 8 * 1024 * 1024
+
+
+def preallocate(fd : int, size : int):
+    """
+    Gives the open file its final size, reserving the disk blocks where the platform supports it.
+    """
+
+    os.ftruncate(fd, size)
+    if hasattr(os, "posix_fallocate") and size > 0:
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            # Not every file system supports it, the file is then sparse until the pieces are written
+            pass
+
+
+class RangeWriter:
+    """
+    File-like object for recv_stream that writes consecutive data from a start offset of a shared
+    file descriptor. Uses pwrite, so several writers can use the same descriptor from different threads.
+    """
+
+    def __init__(self, fd : int, offset : int):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data) -> int:
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(self.fd, view, self.offset)
+            self.offset += n
+            view = view[n:]
+        return len(data)
+
+
+class Manifest:
+    """
+    Record of the completed pieces of one download, kept in a JSON file next to the output.
+    The size and modification time of the server's file are stored with it,
+    a manifest for a different version of the file is ignored.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, path : str, size : int, mtime : int, piece_size : int = PIECE_SIZE):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.piece_size = piece_size
+        self.done = set()
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    saved = json.load(f)
+                if (saved["size"], saved["mtime"], saved["piece_size"]) == (size, mtime, piece_size):
+                    self.done = set(saved["done"])
+            except (OSError, ValueError, KeyError):
+                pass
+
+    @property
+    def resumed(self) -> bool:
+        return bool(self.done)
+
+    def pieces(self) -> list:
+        """
+        (index, offset, length) of every piece that is not complete yet.
+        """
+
+        count = max((self.size + self.piece_size - 1) // self.piece_size, 1)
+        missing = []
+        for i in range(count):
+            if i not in self.done:
+                offset = i * self.piece_size
+                missing.append((i, offset, min(self.piece_size, self.size - offset)))
+        return missing
+
+    def complete(self, index : int):
+        """
+        Marks a piece as complete. The caller must have made its data durable first.
+        """
+
+        with self._lock:
+            self.done.add(index)
+            self._save()
+
+    def _save(self):
+        data = {"size": self.size, "mtime": self.mtime, "piece_size": self.piece_size, "done": sorted(self.done)}
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,24 +1,37 @@
 # Sources:
 # Socket logic: https://pythonprogramming.net/pickle-objects-sockets-tutorial-python-3/
 # RSA logic: https://pycryptodome.readthedocs.io/en/latest/src/public_key/rsa.html
-# AES logic: aes-intro.py
+# AES logic: aes-intro.py, https://pycryptodome.readthedocs.io/en/latest/src/cipher/modern.html#gcm-mode
 
 
+import argparse
+import json
+import signal
 import socket
-import pickle
 import sys
 import os
-
-from Crypto.Cipher import AES as aes
-from Crypto.Random import get_random_bytes
-from Crypto.Util.Padding import pad, unpad
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from Crypto.PublicKey import RSA as rsa
 from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Random import get_random_bytes
+
+from ftcache import CACHE_SIZE, CiphertextCache, send_cached
+from ftcatalog import SCAN_INTERVAL, Catalog
+from ftcompress import LINK_SPEED, METHODS, Compressor, send_compressed_stream
+from ftdelta import ENTRY_SIZE, MAX_BLOCK_SIZE, MAX_BLOCKS, MIN_BLOCK_SIZE, available, make_delta, parse_signature
+from ftframe import send_frame, recv_frame
+from ftkex import KEX_METHODS, RSA, X25519, derive_master_key, load_identity, new_share, sign_handshake
+from ftpipeline import CryptoPool, default_workers
+from ftstream import (CHUNK_SIZE, ChunkOpener, ChunkSealer, CLIENT_TO_SERVER, CONTENT_KEY, NEW_TICKET,
+                      SERVER_TO_CLIENT, StreamReader, StreamWriter, send_stream)
+from ftticket import RANDOM_SIZE, TICKET_LIFETIME, TicketKeys, derive_session_key
 
 
-HEADERSIZE = 10
-RECV_SIZE = 16
+MAX_HELLO_SIZE = 4096
+MAX_REQUEST_SIZE = 64 * 1024
 
 
 def generate_keys():
@@ -64,111 +77,415 @@ def generate_keys():
     return private_key, public_key
 
 
-def send_file(tcp_port, file_path):
+class RSAKeys:
     """
-    Will send a file.
-    Listens on the given TCP port,
-    and sends the given file when a connection is established.
+    The server's RSA key pair, imported or generated by generate_keys the first time a client needs it.
+    Clients that use X25519 never do, so the server does not spend seconds generating a key at startup.
     """
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.bind((socket.gethostname(), tcp_port))
-    s.listen(5)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = None
 
-    private_key, public_key = generate_keys()
+    def get(self) -> tuple:
+        """
+        Returns (private key, public key).
+        """
 
-    print(f"Server has hostname {socket.gethostname()}")
-    print(f"Server listening on port {tcp_port}")
+        with self._lock:
+            if self._keys is None:
+                self._keys = generate_keys()
+            return self._keys
 
-    while True:
-        # now our endpoint knows about the OTHER endpoint.
-        client_socket, address = s.accept()
-        print(f"Connection from {address} has been established.")
 
-        full_msg = b""
+def handle_client(client_socket : socket.socket, address, rsa_keys : RSAKeys, identity, kex_methods : list,
+                  ticket_keys : TicketKeys, catalog : Catalog, cache : CiphertextCache = None,
+                  compressor : Compressor = None, crypto : CryptoPool = None) -> bool:
+    """
+    Runs the whole exchange with one client: handshake and file transfer, or a session of requests.
+    Called in a worker thread, so the key exchange and AES work of one client never holds up the others.
+    The key exchange is the first of kex_methods the client supports (see ftkex.py), identity is the
+    Ed25519 key the server signs the X25519 exchange with.
+    Returns True if the client resumed an earlier session with a ticket and the key exchange was skipped.
+    """
+
+    ### Step 0: RECV -> Client hello, SEND -> Server hello ###
+    # The client sends its random and, if it has one, a session ticket from an earlier connection
+    client_hello = bytes(recv_frame(client_socket, max_size=MAX_HELLO_SIZE))
+    hello = json.loads(client_hello)
+    client_random = bytes.fromhex(hello["random"])
+    if len(client_random) != RANDOM_SIZE:
+        raise ValueError("Client random has the wrong size")
+    server_random = get_random_bytes(RANDOM_SIZE)
+
+    resumed = None
+    if hello.get("ticket"):
+        resumed = ticket_keys.open(bytes.fromhex(hello["ticket"]))
+
+    # File data is compressed before it is encrypted if the server is set up for it and the client accepts it
+    if compressor is not None and compressor.method not in hello.get("compression", ()):
+        compressor = None
+
+    server_hello = {"random": server_random.hex(), "resumed": resumed is not None}
+
+    # Clients from before the X25519 exchange only know RSA and do not send a list
+    offered = hello.get("kex", [RSA])
+    kex = next((method for method in kex_methods if method in offered), None)
+    if kex is None:
+        server_hello["error"] = "No common key exchange method"
+        send_frame(client_socket, json.dumps(server_hello).encode())
+        raise ValueError(f"Client only offers the key exchange methods {offered}")
+    server_hello["kex"] = kex
+    if kex == X25519 and resumed is None:
+        share_key, share = new_share()
+        server_hello["share"] = share.hex()
+
+    # A session client sends requests after the handshake, any other client gets one file right away:
+    # the one it names, or the served file when the server serves a single file.
+    # It may ask for a byte range [offset, offset + length) instead of the whole file, the size and
+    # modification time tell it whether the file changed since its earlier ranges
+    session = bool(hello.get("session"))
+    if not session:
+        info = catalog.get(hello.get("name") or catalog.default)
+        if info is None:
+            server_hello["error"] = "No such file"
+            send_frame(client_socket, json.dumps(server_hello).encode())
+            raise FileNotFoundError(f"Client asked for {hello.get('name')}, which is not served")
+        offset, length = parse_range(hello.get("range"), info.size)
+        cached = lookup_cache(cache, catalog, info, offset, length)
+        server_hello.update(size=info.size, mtime=info.mtime, cached=cached is not None)
+        if cached is not None:
+            # The cached copy is already encrypted, so it cannot be compressed any more
+            compressor = None
+
+    server_hello["compression"] = compressor.method if compressor is not None else None
+
+    server_hello = json.dumps(server_hello).encode()
+    send_frame(client_socket, server_hello)
+
+    if resumed is not None:
+        # The ticket holds the master key of the earlier session, steps 1 to 4 are skipped
+        master_key, issued_at = resumed
+
+    elif kex == X25519:
+        ### Step 1: SEND -> Identity key and signature of both hellos ###
+        send_frame(client_socket, sign_handshake(identity, client_hello, server_hello))
+
+        # Both shares were in the hellos, the master key follows from them without another message
+        master_key = derive_master_key(share_key, bytes.fromhex(hello["share"]), client_random, server_random)
+        issued_at = None
+
+    else:
+        private_key, public_key = rsa_keys.get()
 
         ### Step 1: SEND -> Server's Public key ###
         data = public_key.export_key()
-        send_data(client_socket, data)
+        send_frame(client_socket, data)
 
         # Step 2: Client task
         # Step 3: Client task
 
         ### Step 4: RECV -> Encrypted Symmetric key ###
-        full_msg = recv_data(client_socket)
-        encrypted_symmetric_key = pickle.loads(full_msg)
+        encrypted_symmetric_key = bytes(recv_frame(client_socket, max_size=4096))
 
         # Decrypt the Symmetric key using the private key
         rsa_decipher = PKCS1_OAEP.new(private_key)
-        symmetric_key = rsa_decipher.decrypt(encrypted_symmetric_key)
-
+        master_key = rsa_decipher.decrypt(encrypted_symmetric_key)
+        issued_at = None
+
+    # Every connection gets its own key, so a master key used again never reuses a nonce
+    symmetric_key = derive_session_key(master_key, client_random, server_random)
+
+    ### SEND -> New session ticket, encrypted with the Symmetric key ###
+    # A resumed session gets a ticket under the newest ticket key, but keeps the expiry of its old one
+    ticket = ticket_keys.issue(master_key, issued_at)
+    lifetime = ticket_keys.lifetime if issued_at is None else ticket_keys.lifetime - (time.time() - issued_at)
+    message = json.dumps({"ticket": ticket.hex(), "lifetime": lifetime}).encode()
+    send_frame(client_socket, ChunkSealer(symmetric_key, NEW_TICKET).seal(message, final=True))
+
+    sealer = ChunkSealer(symmetric_key, SERVER_TO_CLIENT)
+    if session:
+        serve_requests(client_socket, symmetric_key, sealer, catalog, cache, compressor, crypto)
+    elif cached is not None:
+        ### Step 5: SEND -> Content key encrypted with the Symmetric key, and the cached encrypted file ###
+        send_frame(client_socket, ChunkSealer(symmetric_key, CONTENT_KEY).seal(cached.key, final=True))
+        send_cached(client_socket, cached)
+    else:
         ### Step 5: SEND -> Encrypted file using the Symmetric key ###
-        # Open file and treat it as a binary file
-        with open(file_path, 'rb') as f:
-            
-            file = f.read()
+        send_range(client_socket, sealer, catalog.path(info.name), offset, length, compressor, crypto)
+
+    return resumed is not None
+
+
+def parse_range(byte_range, size : int) -> tuple:
+    """
+    Checks a requested [offset, length] range against the file size, returns (offset, length).
+    No range means the whole file, length None means up to the end of the file.
+    """
+
+    offset, length = byte_range or (0, None)
+    if not 0 <= offset <= size or (length is not None and length < 0):
+        raise ValueError(f"Invalid range {offset}, {length} for a file of {size} bytes")
+
+    if length is None or offset + length > size:
+        length = size - offset
+    return offset, length
+
+
+def send_range(client_socket : socket.socket, sealer : ChunkSealer, path : str, offset : int, length : int,
+               compressor : Compressor = None, crypto : CryptoPool = None) -> int:
+    """
+    Sends length bytes of the file from offset as an encrypted stream, compressed first if a compressor is given.
+    With a crypto pool the chunks are encrypted on several cores at once.
+    """
 
-            # Encrypt the file
-            # Generate the initialization vector (iv) used during the encryption and decryption process
-            iv = get_random_bytes(aes.block_size) 
-            aes_cipher = aes.new(symmetric_key, aes.MODE_CBC, iv=iv)
-            ciphertext = aes_cipher.encrypt(pad(file, aes.block_size))
-        
-            # Send the initialization vector and cipher text
-            data = pickle.dumps(iv + ciphertext)
-            send_data(client_socket, data)
+    # Open file and treat it as a binary file
+    with open(path, 'rb') as f:
+        f.seek(offset)
 
-        print("File sent successfully")
+        # Encrypt and send the file (or the requested range) one chunk at a time,
+        # each chunk is authenticated with AES-GCM under a nonce derived from its position
+        if compressor is not None:
+            return send_compressed_stream(client_socket, sealer, f, compressor, limit=length)
+        # A file of one chunk has nothing to encrypt in parallel
+        if crypto is not None and length > CHUNK_SIZE:
+            return crypto.send_stream(client_socket, sealer, f, limit=length)
+        return send_stream(client_socket, sealer, f, limit=length)
 
 
-def send_data(socket : socket.socket, data : bytes):
+def lookup_cache(cache : CiphertextCache, catalog : Catalog, info, offset : int, length : int):
     """
-    Helper function to send data.
+    The cached encrypted copy of a file when the whole file is requested and a cache is in use, otherwise None.
     """
 
-    # Create a "Header" at the start of the message to tell the receiver how large the message is in bytes
-    msg = bytes(f"{len(data):<{HEADERSIZE}}", 'utf-8') + data
-    
-    print(f"Data sent from serever: \n{msg}\n")
-    # Send message
-    socket.send(msg)
+    if cache is None or offset != 0 or length != info.size:
+        return None
+    return cache.lookup(info, catalog.path(info.name))
 
 
-def recv_data(socket : socket.socket) -> bytes:
+def serve_requests(client_socket : socket.socket, symmetric_key : bytes, sealer : ChunkSealer, catalog : Catalog,
+                   cache : CiphertextCache = None, compressor : Compressor = None, crypto : CryptoPool = None):
     """
-    Helper function to recieve data
+    Answers the requests of a session client until it says bye.
+
+    Every request and every response is one encrypted JSON message, the response to "get" is followed by
+    the file as an encrypted stream. Requests are answered in order, so the client can send the next ones
+    without waiting for the answers, and the server never waits for a round trip between two files.
+        {"op": "list", "prefix": ...}             -> {"ok": true, "files": [file, ...]}
+        {"op": "stat", "name": ...}               -> {"ok": true, "file": file}
+        {"op": "get", "name": ..., "range": ...}  -> {"ok": true, "file": file, "offset": ..., "length": ...}
+                                                     and "content_key" if the file comes from the cache
+        {"op": "delta", "name": ..., "sha256": ..., "block_size": ..., "blocks": ...}
+                                                  -> {"ok": true, "file": file, "unchanged": ...}
+        {"op": "bye"}
+    where file is {"name", "size", "mtime", "sha256"}. A failed request gets {"ok": false, "error": ...}.
+    A "delta" request is followed by the signature of the client's copy as an encrypted stream, and the
+    response by the delta that turns the copy into the served file, unless the copy is unchanged (see ftdelta.py).
     """
-    
-    full_msg = b""
-    new_msg = True
+
+    opener = ChunkOpener(symmetric_key, CLIENT_TO_SERVER)
+    frame_buffer = bytearray(MAX_REQUEST_SIZE)
 
     while True:
-        # Receive data in upredictable bytes at a time
-        data = socket.recv(RECV_SIZE)
+        message, _ = opener.open(recv_frame(client_socket, frame_buffer, max_size=MAX_REQUEST_SIZE))
+        request = json.loads(message)
+        op = request.get("op")
+        if op == "bye":
+            return
+
+        info = None
+        signature = None
+        if op == "delta":
+            signature = read_signature(client_socket, opener, request)
+
+        if op == "list":
+            response = {"ok": True, "files": [entry._asdict() for entry in catalog.list(request.get("prefix", ""))]}
+        elif op in ("stat", "get", "delta"):
+            info = catalog.get(request.get("name"))
+            if info is None:
+                response = {"ok": False, "error": f"No such file: {request.get('name')}"}
+            else:
+                response = {"ok": True, "file": info._asdict()}
+        else:
+            response = {"ok": False, "error": f"Unknown request: {op}"}
+
+        if op == "get" and info is not None:
+            try:
+                offset, length = parse_range(request.get("range"), info.size)
+                response.update(offset=offset, length=length)
+                cached = lookup_cache(cache, catalog, info, offset, length)
+                if cached is not None:
+                    # The response is encrypted with the Symmetric key, so the content key is too
+                    response["content_key"] = cached.key.hex()
+            except (ValueError, TypeError) as e:
+                response = {"ok": False, "error": str(e)}
+
+        if op == "delta" and info is not None:
+            response["unchanged"] = request.get("sha256") == info.sha256
+            if not available():
+                response = {"ok": False, "error": "This server cannot make deltas, numpy is not installed"}
+
+        send_frame(client_socket, sealer.seal(json.dumps(response).encode(), final=True))
+
+        if op == "get" and response["ok"]:
+            if "content_key" in response:
+                send_cached(client_socket, cached)
+            else:
+                send_range(client_socket, sealer, catalog.path(info.name), offset, length, compressor, crypto)
+
+        if op == "delta" and response["ok"] and not response["unchanged"]:
+            writer = StreamWriter(client_socket, sealer)
+            make_delta(catalog.path(info.name), request["block_size"], parse_signature(signature, request["blocks"]),
+                       writer)
+            writer.close()
+
+
+def read_signature(client_socket : socket.socket, opener : ChunkOpener, request : dict) -> bytes:
+    """
+    Receives the signature stream that follows a delta request.
+    A request with an impossible signature ends the session, since its stream cannot be skipped safely.
+    """
 
-        # Check if this is the first received data
-        if new_msg:
-            # Read header to find the size of the entire message in bytes
-            msg_len = int(data[:HEADERSIZE])
-            new_msg = False
+    block_size = request.get("block_size")
+    blocks = request.get("blocks")
+    if not isinstance(block_size, int) or not MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE:
+        raise ValueError(f"Bad delta block size {block_size!r}")
+    if not isinstance(blocks, int) or not 0 <= blocks <= MAX_BLOCKS:
+        raise ValueError(f"Bad delta block count {blocks!r}")
 
-        full_msg += data
+    reader = StreamReader(client_socket, opener)
+    signature = reader.read(blocks * ENTRY_SIZE + 1)
+    if len(signature) != blocks * ENTRY_SIZE or not reader.done:
+        raise ValueError("Signature does not match its block count")
+    return signature
 
-        # Check if recieved full message
-        if len(full_msg) - HEADERSIZE == msg_len:
-            print(f"Data received in server: \n{full_msg}\n")
-            return full_msg[HEADERSIZE:]
 
+def _serve_client(slots : threading.BoundedSemaphore, client_socket : socket.socket, address, *args):
+    """
+    Worker thread wrapper: handles one client, then closes the socket and frees its connection slot.
+    """
 
-def main():
-    # Check if the correct number of arguments is provided
-    if len(sys.argv) != 2:
-        print("Usage: python ftserv.py <path/to/file>")
-        return
+    try:
+        resumed = handle_client(client_socket, address, *args)
+        print(f"Served {address}" + (" (resumed session)" if resumed else ""))
+    except socket.timeout:
+        print(f"Connection from {address} timed out")
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Connection from {address} failed: {e}")
+    finally:
+        client_socket.close()
+        slots.release()
+
+
+def send_file(tcp_port, file_path, host=None, max_connections=64, timeout=30.0,
+              ticket_lifetime=TICKET_LIFETIME, ticket_rotate=None, scan_interval=SCAN_INTERVAL, cache_dir=None,
+              cache_size=CACHE_SIZE, compression=None, link_speed=LINK_SPEED, crypto_workers=1,
+              kex_methods=KEX_METHODS):
+    """
+    Will send a file.
+    Listens on the given TCP port,
+    and sends the given file to every client that connects.
+    When file_path is a directory, the files in it and its subdirectories are served by name,
+    from an index that is rescanned every scan_interval seconds (see ftcatalog.py).
+    With a cache_dir, whole files are encrypted once and then served from there with sendfile,
+    keeping at most cache_size bytes (see ftcache.py).
+    compression ("zlib" or "lzma") compresses the file data before it is encrypted, for the chunks where that
+    makes sending over a link of link_speed bytes per second faster (see ftcompress.py).
+    With more than one crypto worker, the chunks of a file are encrypted in parallel (see ftpipeline.py).
+
+    Up to max_connections clients are served at the same time, each in its own worker thread.
+    When all slots are taken the server stops accepting, so new clients wait in the listen backlog
+    instead of piling up in the server. A client that does not send or receive anything
+    for timeout seconds is disconnected.
+
+    The key exchange is the first of kex_methods ("x25519", "rsa") the client supports.
+    Clients get a session ticket valid for ticket_lifetime seconds, which lets them skip it next time.
+    The ticket key is replaced every ticket_rotate seconds (default: ticket_lifetime),
+    and on SIGHUP where the platform has it.
+    """
+
+    if host is None:
+        host = socket.gethostname()
 
-    arg = sys.argv[1]
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((host, tcp_port))
+    s.listen(max(max_connections, 128))
 
-    send_file(12345, arg)
+    identity = load_identity()
+    rsa_keys = RSAKeys()
+
+    start = time.perf_counter()
+    catalog = Catalog(file_path)
+    print(f"Indexed {len(catalog)} files in {time.perf_counter() - start:.2f}s")
+    if not catalog.single_file:
+        catalog.start(scan_interval)
+
+    cache = None
+    if cache_dir is not None:
+        cache = CiphertextCache(cache_dir, cache_size)
+        print(f"Ciphertext cache in {cache_dir}, {cache.used} of {cache_size} bytes used")
+
+    compressor = Compressor(compression, link_speed=link_speed) if compression else None
+    crypto = CryptoPool(crypto_workers) if crypto_workers > 1 else None
+
+    ticket_keys = TicketKeys(ticket_lifetime, ticket_rotate)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: ticket_keys.rotate())
+
+    print(f"Server has hostname {host}")
+    print(f"Server listening on port {s.getsockname()[1]}")
+    sys.stdout.flush()
+
+    slots = threading.BoundedSemaphore(max_connections)
+
+    with ThreadPoolExecutor(max_workers=max_connections) as pool:
+        while True:
+            # Wait for a free slot before accepting the next client
+            slots.acquire()
+
+            # now our endpoint knows about the OTHER endpoint.
+            client_socket, address = s.accept()
+            client_socket.settimeout(timeout)
+            print(f"Connection from {address} has been established.")
+
+            pool.submit(_serve_client, slots, client_socket, address, rsa_keys, identity, kex_methods,
+                        ticket_keys, catalog, cache, compressor, crypto)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encrypted file transfer server")
+    parser.add_argument("file", help="path/to/file, or a directory to serve all files in it")
+    parser.add_argument("--host", default=None, help="address to listen on (default: the hostname)")
+    parser.add_argument("--port", type=int, default=12345, help="0 picks a free port")
+    parser.add_argument("--max-connections", type=int, default=64,
+                        help="clients served at the same time")
+    parser.add_argument("--timeout", type=float, default=30.0,
+                        help="seconds a client may stay idle before it is disconnected")
+    parser.add_argument("--ticket-lifetime", type=float, default=TICKET_LIFETIME,
+                        help="seconds a session ticket lets a client skip the key exchange")
+    parser.add_argument("--ticket-rotate", type=float, default=None,
+                        help="seconds between ticket key rotations (default: the ticket lifetime)")
+    parser.add_argument("--scan-interval", type=float, default=SCAN_INTERVAL,
+                        help="seconds between rescans of a served directory")
+    parser.add_argument("--cache-dir", default=None,
+                        help="encrypt each file once and serve the cached ciphertext from this directory")
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE // (1024 * 1024),
+                        help="largest size of the ciphertext cache in MiB")
+    parser.add_argument("--compress", choices=sorted(METHODS), default=None,
+                        help="compress the file data before encrypting it, where that pays off")
+    parser.add_argument("--link-mbps", type=float, default=LINK_SPEED * 8 / 1e6,
+                        help="link speed in Mbit/s assumed when deciding whether compression pays off")
+    parser.add_argument("--crypto-workers", type=int, default=default_workers(),
+                        help="threads encrypting the chunks of a file in parallel, 1 encrypts in the sending thread")
+    parser.add_argument("--kex", nargs="+", choices=KEX_METHODS, default=KEX_METHODS,
+                        help="key exchange methods to accept, in order of preference")
+    args = parser.parse_args()
+
+    send_file(args.port, args.file, args.host, args.max_connections, args.timeout,
+              args.ticket_lifetime, args.ticket_rotate, args.scan_interval, args.cache_dir,
+              args.cache_size * 1024 * 1024, args.compress, args.link_mbps * 1e6 / 8,
+              args.crypto_workers, args.kex)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,68 @@
+# Small JSON files the client keeps between runs, like its session tickets and the servers it knows.
+#
+# Several clients, in one process or in several, may change the same file at once. A change is made while
+# holding an exclusive lock on "<file>.lock": the file is read again, the change is applied to what is in it,
+# and the result is written to a temporary file of its own and renamed over the file. No client then loses
+# the entries another one wrote, and a reader always finds either the old or the new file, never half of one.
+# Without fcntl (Windows) only the rename protects the file.
+
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+@contextmanager
+def locked(path : str):
+    """
+    Holds an exclusive lock for the file at path, shared with every other process that uses this module.
+    """
+
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(path + ".lock", os.O_WRONLY | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def load(path : str) -> dict:
+    """
+    The dict in the JSON file at path, empty if there is no such file or it cannot be read.
+    """
+
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def update(path : str, change, indent : int = None) -> dict:
+    """
+    Calls change(data) on the dict in the JSON file at path and writes it back, returns the new dict.
+    The file is only readable by its owner.
+    """
+
+    with locked(path):
+        data = load(path)
+        change(data)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".",
+                                   suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, indent=indent)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+    return data
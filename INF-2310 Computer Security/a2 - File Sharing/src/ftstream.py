@@ -0,0 +1,225 @@
+# Streaming authenticated encryption of a file in fixed size chunks.
+#
+# Every chunk is encrypted on its own with AES-GCM and sent as one frame:
+#     flag (1 byte) | ciphertext | tag (16 bytes)
+# The nonce is a 4 byte direction prefix followed by the 8 byte chunk counter, so it is never reused
+# under one key and chunks cannot be reordered or replayed. The flag marks the last chunk and is
+# authenticated as associated data, so a truncated stream is detected as well.
+
+import struct
+
+from Crypto.Cipher import AES as aes
+
+from ftframe import send_frame, recv_frame
+
+
+CHUNK_SIZE = 1024 * 1024
+TAG_SIZE = 16
+# Largest chunk a receiver accepts, so a bad length header cannot make it allocate gigabytes
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+
+SERVER_TO_CLIENT = b"\x00\x00\x00\x01"
+CLIENT_TO_SERVER = b"\x00\x00\x00\x02"
+# Sealed session ticket sent by the server after the handshake, see ftticket.py
+NEW_TICKET = b"\x00\x00\x00\x03"
+# Content key of a cached file, sealed under the session key, and the cached stream itself, see ftcache.py
+CONTENT_KEY = b"\x00\x00\x00\x04"
+CONTENT = b"\x00\x00\x00\x05"
+
+FLAG_MORE = 0
+FLAG_FINAL = 1
+
+_NONCE = struct.Struct("!4sQ")
+
+
+class ChunkSealer:
+    """
+    Encrypts consecutive chunks under one key.
+    """
+
+    def __init__(self, key : bytes, prefix : bytes):
+        self.key = key
+        self.prefix = prefix
+        self.counter = 0
+
+    def seal_into(self, data, out : memoryview, final : bool) -> int:
+        """
+        Encrypts data into out as flag | ciphertext | tag and returns the number of bytes written.
+        out must hold len(data) + 1 + TAG_SIZE bytes.
+        """
+
+        size = self.seal_chunk(self.counter, data, out, final)
+        self.counter += 1
+        return size
+
+    def seal_chunk(self, counter : int, data, out : memoryview, final : bool) -> int:
+        """
+        Like seal_into, for the chunk at position counter, without touching the sealer's own counter.
+        Chunks do not depend on each other, so several threads can seal different chunks at the same time.
+        """
+
+        flag = FLAG_FINAL if final else FLAG_MORE
+        cipher = aes.new(self.key, aes.MODE_GCM, nonce=_NONCE.pack(self.prefix, counter))
+
+        size = len(data)
+        out[0] = flag
+        cipher.update(bytes((flag,)))
+        cipher.encrypt(data, output=out[1:1 + size])
+        out[1 + size:1 + size + TAG_SIZE] = cipher.digest()
+        return 1 + size + TAG_SIZE
+
+    def seal(self, data, final : bool) -> bytes:
+        out = bytearray(len(data) + 1 + TAG_SIZE)
+        self.seal_into(data, memoryview(out), final)
+        return bytes(out)
+
+
+class ChunkOpener:
+    """
+    Decrypts and verifies consecutive chunks under one key.
+    """
+
+    def __init__(self, key : bytes, prefix : bytes):
+        self.key = key
+        self.prefix = prefix
+        self.counter = 0
+
+    def open_into(self, frame : memoryview, out : memoryview) -> tuple:
+        """
+        Decrypts a frame into out, returns (plaintext size, final).
+        Raises ValueError if the chunk was modified, reordered or replayed.
+        """
+
+        result = self.open_chunk(self.counter, frame, out)
+        self.counter += 1
+        return result
+
+    def open_chunk(self, counter : int, frame : memoryview, out : memoryview) -> tuple:
+        """
+        Like open_into, for the chunk at position counter, without touching the opener's own counter.
+        """
+
+        if len(frame) < 1 + TAG_SIZE:
+            raise ValueError("Chunk is too short")
+
+        flag = frame[0]
+        size = len(frame) - 1 - TAG_SIZE
+        cipher = aes.new(self.key, aes.MODE_GCM, nonce=_NONCE.pack(self.prefix, counter))
+
+        cipher.update(bytes((flag,)))
+        cipher.decrypt(frame[1:1 + size], output=out[:size])
+        cipher.verify(frame[1 + size:])
+        return size, flag == FLAG_FINAL
+
+    def open(self, frame) -> tuple:
+        frame = memoryview(frame)
+        out = bytearray(max(len(frame) - 1 - TAG_SIZE, 0))
+        size, final = self.open_into(frame, memoryview(out))
+        return bytes(out), final
+
+
+def send_stream(sock, sealer : ChunkSealer, f, chunk_size : int = CHUNK_SIZE, limit : int = None) -> int:
+    """
+    Reads the open file f chunk by chunk from its current position, encrypts and sends every chunk as it is read.
+    At most limit bytes are sent if it is given, otherwise everything up to the end of the file.
+    Only two chunk sized buffers are used, whatever the size of the file. Returns the number of bytes sent.
+    """
+
+    plain = bytearray(chunk_size)
+    plain_view = memoryview(plain)
+    sealed = bytearray(chunk_size + 1 + TAG_SIZE)
+    sealed_view = memoryview(sealed)
+
+    total = 0
+    while True:
+        want = chunk_size if limit is None else min(chunk_size, limit - total)
+        n = f.readinto(plain_view[:want])
+        total += n
+        # A short read means end of file, a full chunk at the very end is followed by an empty final chunk
+        final = n < want or total == limit
+        size = sealer.seal_into(plain_view[:n], sealed_view, final)
+        send_frame(sock, sealed_view[:size])
+        if final:
+            return total
+
+
+def recv_stream(sock, opener : ChunkOpener, f) -> int:
+    """
+    Receives an encrypted stream and writes every chunk to the open file f as soon as it is verified.
+    Returns the number of bytes written.
+    """
+
+    frame_buffer = bytearray(CHUNK_SIZE + 1 + TAG_SIZE)
+    plain = bytearray(CHUNK_SIZE)
+
+    total = 0
+    while True:
+        frame = recv_frame(sock, frame_buffer, max_size=MAX_CHUNK_SIZE + 1 + TAG_SIZE)
+        if len(frame) > len(frame_buffer):
+            frame_buffer = frame.obj
+        if len(frame) - 1 - TAG_SIZE > len(plain):
+            plain = bytearray(len(frame) - 1 - TAG_SIZE)
+
+        size, final = opener.open_into(frame, memoryview(plain))
+        f.write(memoryview(plain)[:size])
+        total += size
+        if final:
+            return total
+
+
+class StreamWriter:
+    """
+    File-like object that sends what is written to it as an encrypted stream,
+    for data that is produced piece by piece instead of read from a file. close() sends the final chunk.
+    """
+
+    def __init__(self, sock, sealer : ChunkSealer, chunk_size : int = CHUNK_SIZE):
+        self.sock = sock
+        self.sealer = sealer
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.total = 0
+
+    def write(self, data) -> int:
+        self.buffer += data
+        self.total += len(data)
+        while len(self.buffer) > self.chunk_size:
+            send_frame(self.sock, self.sealer.seal(memoryview(self.buffer)[:self.chunk_size], final=False))
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def close(self):
+        send_frame(self.sock, self.sealer.seal(self.buffer, final=True))
+        self.buffer = bytearray()
+
+
+class StreamReader:
+    """
+    File-like object that reads an encrypted stream from the socket, the counterpart of StreamWriter.
+    read() returns b"" after the final chunk.
+    """
+
+    def __init__(self, sock, opener : ChunkOpener):
+        self.sock = sock
+        self.opener = opener
+        self.buffer = bytearray()
+        self.done = False
+
+    def read(self, n : int) -> bytes:
+        """
+        Returns n bytes, fewer only at the end of the stream.
+        """
+
+        while len(self.buffer) < n and not self.done:
+            data, self.done = self.opener.open(recv_frame(self.sock, max_size=MAX_CHUNK_SIZE + 1 + TAG_SIZE))
+            self.buffer += data
+
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    def read_exact(self, n : int) -> bytes:
+        data = self.read(n)
+        if len(data) != n:
+            raise ValueError("Stream ended in the middle of a record")
+        return data
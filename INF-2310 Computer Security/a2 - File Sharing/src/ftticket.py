@@ -0,0 +1,179 @@
+# Session tickets, so a returning client can skip the key exchange.
+#
+# After a full handshake the server hands the client a ticket: the master key of the session and the time
+# of the handshake, encrypted with AES-GCM under a ticket key only the server knows. The server keeps no
+# state per client. A client that presents the ticket later proves it knows the master key by being able
+# to decrypt the stream, which is sent under a key derived from the master key and fresh randoms from both
+# sides, so no key and nonce pair is ever used twice even though the master key is.
+#
+#     ticket = key id (4 bytes) | nonce (12 bytes) | AES-GCM(issued at (8 bytes) | master key (32 bytes)) | tag (16 bytes)
+
+import struct
+import threading
+import time
+
+from Crypto.Cipher import AES as aes
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Random import get_random_bytes
+
+import ftstate
+
+
+RANDOM_SIZE = 32
+TICKET_LIFETIME = 3600
+
+_KEY_ID_SIZE = 4
+_NONCE_SIZE = 12
+_TAG_SIZE = 16
+_CONTENT = struct.Struct("!Q32s")
+
+
+def derive_session_key(master_key : bytes, client_random : bytes, server_random : bytes) -> bytes:
+    """
+    Key used for one connection, derived from the master key and the randoms both sides sent in their hello.
+    """
+
+    return HKDF(master_key, 32, client_random + server_random, SHA256, context=b"ft session key")
+
+
+class TicketKeys:
+    """
+    The server side ticket keys.
+
+    New tickets are always encrypted under the newest key. A key is replaced after rotate_every seconds,
+    or whenever rotate() is called, and is kept for lifetime seconds after that so tickets it encrypted
+    stay valid until they expire. Tickets older than lifetime seconds are rejected.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, lifetime : float = TICKET_LIFETIME, rotate_every : float = None):
+        self.lifetime = lifetime
+        self.rotate_every = rotate_every if rotate_every is not None else lifetime
+        self._lock = threading.Lock()
+        # key id -> (key, time it was created, time it was replaced or None)
+        self._keys = {}
+        self._current = None
+        self.rotate()
+
+    def rotate(self):
+        """
+        Starts encrypting new tickets under a fresh key and forgets keys whose tickets have all expired.
+        """
+
+        now = time.time()
+        with self._lock:
+            if self._current is not None:
+                key, created, _ = self._keys[self._current]
+                self._keys[self._current] = (key, created, now)
+
+            key_id = get_random_bytes(_KEY_ID_SIZE)
+            while key_id in self._keys:
+                key_id = get_random_bytes(_KEY_ID_SIZE)
+            self._keys[key_id] = (get_random_bytes(32), now, None)
+            self._current = key_id
+
+            for old_id, (_, _, replaced) in list(self._keys.items()):
+                if replaced is not None and now - replaced > self.lifetime:
+                    del self._keys[old_id]
+
+    def _current_key(self) -> tuple:
+        key_id = self._current
+        key, created, _ = self._keys[key_id]
+        if time.time() - created > self.rotate_every:
+            self.rotate()
+            key_id = self._current
+            key = self._keys[key_id][0]
+        return key_id, key
+
+    def issue(self, master_key : bytes, issued_at : float = None) -> bytes:
+        """
+        Encrypts a ticket for master_key. issued_at is the time of the full handshake,
+        a resumed session passes on the time from its old ticket so resuming never extends the lifetime.
+        """
+
+        if issued_at is None:
+            issued_at = time.time()
+
+        key_id, key = self._current_key()
+        nonce = get_random_bytes(_NONCE_SIZE)
+        cipher = aes.new(key, aes.MODE_GCM, nonce=nonce)
+        cipher.update(key_id)
+        ciphertext, tag = cipher.encrypt_and_digest(_CONTENT.pack(int(issued_at), master_key))
+        return key_id + nonce + ciphertext + tag
+
+    def open(self, ticket : bytes) -> tuple:
+        """
+        Returns (master key, issued at) of a valid ticket,
+        or None if the ticket is malformed, forged, expired or its key has been forgotten.
+        """
+
+        if len(ticket) != _KEY_ID_SIZE + _NONCE_SIZE + _CONTENT.size + _TAG_SIZE:
+            return None
+
+        key_id = ticket[:_KEY_ID_SIZE]
+        nonce = ticket[_KEY_ID_SIZE:_KEY_ID_SIZE + _NONCE_SIZE]
+        ciphertext = ticket[_KEY_ID_SIZE + _NONCE_SIZE:-_TAG_SIZE]
+        tag = ticket[-_TAG_SIZE:]
+
+        entry = self._keys.get(key_id)
+        if entry is None:
+            return None
+
+        cipher = aes.new(entry[0], aes.MODE_GCM, nonce=nonce)
+        cipher.update(key_id)
+        try:
+            content = cipher.decrypt_and_verify(ciphertext, tag)
+        except ValueError:
+            return None
+
+        issued_at, master_key = _CONTENT.unpack(content)
+        if time.time() - issued_at > self.lifetime:
+            return None
+        return master_key, issued_at
+
+
+class TicketStore:
+    """
+    The client side tickets, one per server, kept in a JSON file so they outlive the client process.
+    The file holds the master keys, so it is as secret as the server's private key file.
+    Safe to use from several threads, and several clients may share the file (see ftstate.py).
+    """
+
+    def __init__(self, path : str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._tickets = ftstate.load(path)
+
+    def get(self, server : str) -> tuple:
+        """
+        Returns (ticket, master key) for the server, or None if there is none or it has expired.
+        """
+
+        entry = self._tickets.get(server)
+        if entry is None or time.time() > entry["expires"]:
+            return None
+        return bytes.fromhex(entry["ticket"]), bytes.fromhex(entry["master_key"])
+
+    def put(self, server : str, ticket : bytes, master_key : bytes, lifetime : float):
+        entry = {"ticket": ticket.hex(), "master_key": master_key.hex(), "expires": time.time() + lifetime}
+
+        def change(tickets):
+            tickets[server] = entry
+        self._update(change)
+
+    def forget(self, server : str):
+        def change(tickets):
+            tickets.pop(server, None)
+        self._update(change)
+
+    def _update(self, change):
+        # Applied to the file as it is now, so the tickets other clients saved meanwhile are kept
+        def update(tickets):
+            change(tickets)
+            now = time.time()
+            for server in [k for k, v in tickets.items() if v["expires"] <= now]:
+                del tickets[server]
+
+        with self._lock:
+            self._tickets = ftstate.update(self.path, update)
@@ -1,8 +1,11 @@
-import identity.web
-import requests
 import os
-from flask import Flask, redirect, render_template, request, session, url_for
-from flask_session import Session
+import httpx
+from flask import Flask, jsonify, redirect, render_template, request, session, stream_template, url_for
+from directory import PAGE_SIZE, SELECT, DirectoryMirror
+from graph import CACHE_TTL, GraphClient
+from graph_async import AsyncGraphClient
+from sessions import StoreSessionInterface, make_store
+from tokencache import CachedAuth, TokenStore
 import OpenSSL.SSL
 import subprocess
 import tempfile
@@ -54,16 +57,29 @@ REDIRECT_PATH = "/getAToken"
 app = Flask(__name__)
 
 app.config['SECRET_KEY'] = SESSION_SECRET
-app.config['SESSION_TYPE'] = 'filesystem'
 app.config['TESTING'] = True
 app.config['DEBUG'] = True
-Session(app)
+# Sessions are kept on the server in the store SESSION_STORE names, an SQLite database by default (see sessions.py)
+app.session_interface = StoreSessionInterface(make_store())
+
+# Token caches of the users, shared by every worker process of the app (see tokencache.py)
+token_store = TokenStore()
 
 # The auth object provide methods for interacting with the Microsoft OpenID service.
-auth = identity.web.Auth(session=session,
-                         authority=AUTHORITY,
-                         client_id=CLIENT_ID,
-                         client_credential=CLIENT_SECRET)
+auth = CachedAuth(token_store=token_store,
+                  session=session,
+                  authority=AUTHORITY,
+                  client_id=CLIENT_ID,
+                  client_credential=CLIENT_SECRET)
+
+# All Graph calls share one pooled client, so they reuse open connections instead of making new ones
+graph = GraphClient()
+
+# Pages that need several Graph resources fetch them concurrently with this one, its calls count in /stats too
+agraph = AsyncGraphClient(graph=graph)
+
+# Local copies of the tenants' user directories, synced in the background (see directory.py)
+mirror = DirectoryMirror(graph)
 
 @app.route("/login")
 def login():
@@ -107,13 +123,46 @@ def get_profile():
     if "error" in token:
         return redirect(url_for("login"))
 
-    result = requests.get(
-        'https://graph.microsoft.com/v1.0/me',
-        headers={'Authorization': 'Bearer ' + token['access_token']},
-        timeout=30,
-    )
+    # The manager, groups and whether there is a photo are fetched concurrently while the profile is read,
+    # so the page waits as long as the slowest call. All of them are cached per user, "oid" is the user's id.
+    # The photo itself is only fetched by the browser, from /profile/photo.
+    user = auth.get_user()
+    extras = agraph.submit(agraph.gather(token['access_token'], user["oid"], {
+        "manager": '/me/manager', "groups": '/me/memberOf', "photo": '/me/photo'}, scope=user["oid"]))
+
+    result = graph.get('/me', token['access_token'], scope=user["oid"])
+
+    return render_template('profile.html', user=result.json(), result=None, **profile_extras(extras.result()))
+
+
+def profile_extras(responses):
+    """
+    Template arguments for what the profile page shows besides the profile, from the Graph responses.
+    """
+
+    manager, groups, photo = responses["manager"], responses["groups"], responses["photo"]
+    return {
+        "manager": manager.json() if manager.status_code == 200 else None,
+        "groups": [group for group in groups.json().get("value", []) if group.get("displayName")]
+                  if groups.status_code == 200 else [],
+        # Not every user has a photo, Graph answers 404 then
+        "photo": photo.status_code == 200,
+    }
+
 
-    return render_template('profile.html', user=result.json(), result=None)
+@app.route("/profile/photo")
+def get_photo():
+
+    token = auth.get_token_for_user(SCOPES)
+    if "error" in token:
+        return redirect(url_for("login"))
+
+    # Cached per user like the profile, and the browser keeps it as long as the cache does
+    photo = graph.get('/me/photo/$value', token['access_token'], scope=auth.get_user()["oid"])
+    if photo.status_code != 200:
+        return "", 404
+    return photo.content, 200, {"Content-Type": photo.headers.get("Content-Type", "image/jpeg"),
+                                "Cache-Control": f"private, max-age={int(CACHE_TTL)}"}
 
 @app.route("/profile", methods=["POST"])
 def post_profile():
@@ -126,20 +175,28 @@ def post_profile():
     user = auth.get_user()
     user["oid"]
 
-    result = requests.patch(
-        'https://graph.microsoft.com/v1.0/users/' + request.form.get("id"),
-        json=request.form.to_dict(),
-        headers={'Authorization': 'Bearer ' + token['access_token'],
-                 'Content-Type': 'application/json'},
-        timeout=30,
-    )
-
-    # TODO: add credentials to the http request.
-    profile = requests.get(
-        'https://graph.microsoft.com/v1.0/me',
-        headers={'Authorization': 'Bearer ' + token['access_token']},
-        timeout=30,
-    )
+    # The update and the new profile in one round trip, a $batch where the GET waits for the PATCH
+    try:
+        responses = agraph.run(agraph.batch(token['access_token'], user["oid"], [
+            {"id": "update", "method": "PATCH", "url": '/users/' + request.form.get("id"),
+             "headers": {"Content-Type": "application/json"}, "body": request.form.to_dict()},
+            {"id": "profile", "method": "GET", "url": '/me', "dependsOn": ["update"]},
+        ]))
+        result, profile = responses["update"], responses["profile"]
+    except (httpx.HTTPError, ValueError, KeyError):
+        # The $batch itself failed (no connection, or 5xx or 429 after the retries), the update is sent by
+        # itself instead. Setting the same fields again is harmless if the batch did get through.
+        result = graph.patch('/users/' + request.form.get("id"), token['access_token'], json=request.form.to_dict())
+        profile = None
+
+    if result.ok:
+        # The cached profile and the local user directory are out of date now
+        graph.invalidate(user["oid"], '/me')
+        mirror.wake()
+
+    # A failed update leaves the profile as it was, it is then read by itself
+    if profile is None or not profile.ok:
+        profile = graph.get('/me', token['access_token'], scope=user["oid"])
     return render_template('profile.html',
                            user=profile.json(),
                            result=result)
@@ -153,12 +210,30 @@ def get_users():
     if "error" in token:
         return redirect(url_for("login"))
 
-    result = requests.get(
-        'https://graph.microsoft.com/v1.0/users',
-        headers={'Authorization': 'Bearer ' + token['access_token']},
-        timeout=30,
-    )
-    return render_template('users.html', result=result.json())
+    # Every user in the tenant sees the same list, so it is kept once per tenant ("tid")
+    directory = mirror.tenant(auth.get_user()["tid"], token['access_token'])
+    prefix = request.args.get("q", "")
+
+    if directory.ready:
+        page = request.args.get("page", 1, type=int)
+        users, pages = directory.page(page, PAGE_SIZE, prefix)
+        return render_template('users.html', users=users, page=min(max(page, 1), pages), pages=pages, q=prefix,
+                               total=len(directory))
+
+    # The local copy is still being made, meanwhile the list is streamed from Graph page by page,
+    # so the browser shows the first users while the rest are fetched
+    users = graph.iter_values('/users', token['access_token'], params={"$select": SELECT, "$top": 999})
+    if prefix:
+        users = (user for user in users if (user.get("displayName") or "").casefold().startswith(prefix.casefold()))
+    return stream_template('users.html', users=users, page=None, pages=None, q=prefix, total=None)
+
+
+@app.route("/stats")
+def get_stats():
+    # Time spent in Graph calls per endpoint and token cache use, for logged in users
+    if not auth.get_user():
+        return redirect(url_for("login"))
+    return jsonify(graph=graph.stats(), token_cache=token_store.stats())
 
 
 if __name__ == "__main__":
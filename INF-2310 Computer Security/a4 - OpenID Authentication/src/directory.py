@@ -0,0 +1,166 @@
+# Local copy of the user directory of every tenant that uses the app, kept up to date with Graph delta queries.
+#
+# The first sync of a tenant pages through /users/delta, which lists every user, and ends with a delta link.
+# Later syncs call the delta link, which returns only the users that were added, changed or removed since,
+# and a new delta link. A background thread syncs every tenant every few seconds, so /users can show any page
+# of even a very large directory from memory, without a Graph call.
+# The app only has delegated permissions, so a sync uses the access token of the tenant's most recent visitor
+# of /users. When that token has expired the copy stays as it is until the next visitor brings a new one.
+
+import bisect
+import logging
+import threading
+import time
+
+import requests
+
+
+SYNC_INTERVAL = 30.0
+PAGE_SIZE = 50
+# Only what the user list shows is fetched
+SELECT = "id,displayName"
+# Asks Graph for the largest pages it allows, fewer round trips for a large tenant
+PAGE_HEADERS = {"Prefer": "odata.maxpagesize=999"}
+
+logger = logging.getLogger(__name__)
+
+
+class TenantDirectory:
+    """
+    The users of one tenant. Readers always see a complete copy: a sync builds new structures and swaps them in.
+    """
+
+    def __init__(self, tenant):
+        self.tenant = tenant
+        self.token = None
+        self.delta_link = None
+        self.synced_at = None
+        # (order, users): the (name for sorting, id) of every user, sorted, and id -> user.
+        # One tuple, so a reader never gets the order of one sync with the users of another
+        self._copy = ([], {})
+
+    @property
+    def ready(self):
+        """
+        Whether the first sync has finished.
+        """
+
+        return self.delta_link is not None
+
+    def __len__(self):
+        return len(self._copy[0])
+
+    def page(self, number, size=PAGE_SIZE, prefix=""):
+        """
+        Page number (from 1) of the users whose name starts with prefix, sorted by name, and the number of pages.
+        """
+
+        order, users = self._copy
+        if prefix:
+            key = prefix.casefold()
+            start = bisect.bisect_left(order, (key, ""))
+            end = bisect.bisect_left(order, (key + "\U0010ffff", ""))
+        else:
+            start, end = 0, len(order)
+
+        pages = max((end - start + size - 1) // size, 1)
+        number = min(max(number, 1), pages)
+        first = start + (number - 1) * size
+        return [users[user_id] for _, user_id in order[first:min(first + size, end)]], pages
+
+    def apply(self, changes, full):
+        """
+        Brings the copy up to date with the users from a sync. A full sync replaces the copy,
+        otherwise changes are added to it, and users marked "@removed" are taken out.
+        """
+
+        users = {} if full else dict(self._copy[1])
+        for user in changes:
+            if "@removed" in user:
+                users.pop(user["id"], None)
+            else:
+                # An updated user may only come with the properties that changed
+                old = users.get(user["id"], {"displayName": ""})
+                users[user["id"]] = {"id": user["id"], "displayName": user.get("displayName", old["displayName"]) or ""}
+
+        self._copy = (sorted((user["displayName"].casefold(), user_id) for user_id, user in users.items()), users)
+
+
+class DirectoryMirror:
+    """
+    The TenantDirectory of every tenant, and the thread that syncs them.
+    """
+
+    def __init__(self, graph, interval=SYNC_INTERVAL):
+        self.graph = graph
+        self.interval = interval
+        self._tenants = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def tenant(self, tenant, token):
+        """
+        The directory of a tenant, remembering token for its syncs. The first call for a tenant starts its sync.
+        """
+
+        with self._lock:
+            directory = self._tenants.get(tenant)
+            if directory is None:
+                directory = self._tenants[tenant] = TenantDirectory(tenant)
+                self._wake.set()
+            directory.token = token
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="directory-sync", daemon=True)
+                self._thread.start()
+        return directory
+
+    def wake(self):
+        """
+        Syncs now instead of at the next interval, e.g. after the app changed a user.
+        """
+
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            with self._lock:
+                tenants = list(self._tenants.values())
+            for directory in tenants:
+                try:
+                    self.sync(directory)
+                except (requests.RequestException, ValueError) as e:
+                    logger.warning("Directory sync of tenant %s failed: %s", directory.tenant, e)
+
+    def sync(self, directory):
+        """
+        One sync of a tenant's directory, from its delta link or from the start.
+        The changes are only applied when every page has been fetched, a failed sync is simply tried again.
+        """
+
+        full = directory.delta_link is None
+        if full:
+            url, params = "/users/delta", {"$select": SELECT}
+        else:
+            url, params = directory.delta_link, None
+
+        start = time.perf_counter()
+        changes = []
+        delta_link = None
+        for page in self.graph.iter_pages(url, directory.token, params, PAGE_HEADERS):
+            changes.extend(page.get("value", []))
+            delta_link = page.get("@odata.deltaLink", delta_link)
+        if delta_link is None:
+            raise ValueError("Delta query ended without a delta link")
+
+        # Nothing changed since the last sync, most of the time: the copy is kept as it is
+        if changes or full:
+            directory.apply(changes, full)
+        directory.delta_link = delta_link
+        directory.synced_at = time.time()
+        if changes:
+            logger.info("Synced %d changes of tenant %s in %.2fs, %d users", len(changes), directory.tenant,
+                        time.perf_counter() - start, len(directory))
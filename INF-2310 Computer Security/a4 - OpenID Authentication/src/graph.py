@@ -0,0 +1,253 @@
+# Client for the Microsoft Graph API, shared by every request the app handles.
+#
+# All calls go through one requests.Session, which keeps its connections to Graph open between calls,
+# so a page view reuses a TLS connection instead of making a new one every time.
+# Calls that are throttled (429) or fail on the server side (5xx) are retried with exponential backoff,
+# waiting as long as Graph asks for in Retry-After. Every call is timed, and the times are summed up per
+# endpoint in stats().
+# GET responses can be kept in a ResponseCache under a scope: the user for their own profile, the tenant for
+# the user directory, which every user of the tenant sees the same. A cached response is used without asking
+# Graph for ttl seconds; after that it is revalidated with its ETag if it has one, so an unchanged resource
+# costs a small 304 response instead of the whole body.
+# The GRAPH_URL environment variable points the client at another server, e.g. mock_graph.py for local testing.
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+GRAPH_URL = os.environ.get("GRAPH_URL", "https://graph.microsoft.com/v1.0")
+
+# Connections kept open to Graph, at least as many as the server has threads handling requests
+POOL_SIZE = 32
+RETRIES = 3
+# Retries wait 0.5, 1, 2 ... seconds, unless Graph sends Retry-After
+BACKOFF = 0.5
+# Seconds to connect, and to wait for the response
+TIMEOUT = (5, 30)
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# Seconds a cached response is used without asking Graph
+CACHE_TTL = float(os.environ.get("GRAPH_CACHE_TTL", 60))
+# Bytes of response bodies the cache keeps at most
+CACHE_SIZE = 16 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    GET responses by (scope, path), at most max_bytes of bodies, least recently used dropped first.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, ttl=CACHE_TTL, max_bytes=CACHE_SIZE):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._lock = threading.Lock()
+        # (scope, path) -> (response, time it was fetched or revalidated)
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """
+        Returns (response, fresh) for a cached response, fresh when it is younger than the ttl, or None.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0], time.monotonic() - entry[1] < self.ttl
+
+    def put(self, key, response):
+        size = len(response.content)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.used -= len(old[0].content)
+            self._entries[key] = (response, time.monotonic())
+            self.used += size
+            while self.used > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.used -= len(evicted.content)
+
+    def invalidate(self, scope, path):
+        with self._lock:
+            entry = self._entries.pop((scope, path), None)
+            if entry is not None:
+                self.used -= len(entry[0].content)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.used, "hits": self.hits, "misses": self.misses,
+                    "revalidated": self.revalidated}
+
+
+class GraphClient:
+    """
+    Pooled, keep-alive client for Graph. One instance is shared by all threads of the app.
+    The access token is given per call, since every user has their own.
+    """
+
+    def __init__(self, base_url=GRAPH_URL, pool_size=POOL_SIZE, retries=RETRIES, backoff=BACKOFF, timeout=TIMEOUT,
+                 cache=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.cache = cache if cache is not None else ResponseCache()
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUS,
+            # The PATCH requests of the app set fields to given values, so sending one again is harmless
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"PATCH"},
+            respect_retry_after_header=True,
+            # After the last retry the error response is returned, not raised
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._lock = threading.Lock()
+        # endpoint -> {"calls", "errors", "retries", "seconds", "max_seconds"}
+        self._stats = {}
+
+    def request(self, method, path, token, **kwargs):
+        """
+        Sends a request to the Graph path (e.g. "/me") with the user's access token, returns the response.
+        path may also be a whole URL, like the @odata.nextLink of a paged response.
+        """
+
+        headers = kwargs.pop("headers", {})
+        headers["Authorization"] = "Bearer " + token
+        kwargs.setdefault("timeout", self.timeout)
+
+        if path.startswith(("https://", "http://")):
+            url = path
+            # Counted under the path below the base URL, "/users" for ".../v1.0/users?$skiptoken=..."
+            path = urlsplit(url).path[len(urlsplit(self.base_url).path):]
+        else:
+            url = self.base_url + path
+
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, headers=headers, **kwargs)
+        except requests.RequestException:
+            self.record(method, path, time.perf_counter() - start, None, 0)
+            raise
+        elapsed = time.perf_counter() - start
+
+        retries = response.raw.retries
+        retried = len(retries.history) if retries is not None else 0
+        self.record(method, path, elapsed, response.status_code, retried)
+        logger.info("%s %s %s in %.1f ms (%d retries)", method, path, response.status_code, elapsed * 1000, retried)
+        return response
+
+    def get(self, path, token, scope=None, **kwargs):
+        """
+        GET request. With a scope the response is cached under (scope, path): the scope must name everyone
+        who may see the same response, e.g. the user's id for "/me", or the tenant id for "/users".
+        """
+
+        if scope is None:
+            return self.request("GET", path, token, **kwargs)
+
+        key = (scope, path)
+        cached = self.cache.get(key)
+        if cached is not None and cached[1]:
+            self.cache.hits += 1
+            return cached[0]
+
+        etag = cached[0].headers.get("ETag") if cached is not None else None
+        if etag is not None:
+            kwargs["headers"] = dict(kwargs.get("headers", {}), **{"If-None-Match": etag})
+        response = self.request("GET", path, token, **kwargs)
+
+        if response.status_code == 304 and cached is not None:
+            # Unchanged, the cached body is good for another ttl
+            self.cache.revalidated += 1
+            self.cache.put(key, cached[0])
+            return cached[0]
+
+        self.cache.misses += 1
+        if response.status_code == 200:
+            self.cache.put(key, response)
+        return response
+
+    def iter_pages(self, path, token, params=None, headers=None):
+        """
+        Every page of a collection, following @odata.nextLink. The last page of a delta query
+        carries @odata.deltaLink instead. Raises requests.HTTPError if a page fails.
+        """
+
+        url = path
+        while url is not None:
+            response = self.request("GET", url, token, params=params, headers=dict(headers or {}))
+            response.raise_for_status()
+            page = response.json()
+            yield page
+            # The next link holds the query already
+            url = page.get("@odata.nextLink")
+            params = None
+
+    def iter_values(self, path, token, params=None, headers=None):
+        """
+        The items of a collection one at a time, fetching the next page when the previous one is used up.
+        """
+
+        for page in self.iter_pages(path, token, params, headers):
+            yield from page.get("value", [])
+
+    def invalidate(self, scope, path):
+        """
+        Drops a cached response, after a change that makes it out of date.
+        """
+
+        self.cache.invalidate(scope, path)
+
+    def patch(self, path, token, json, **kwargs):
+        return self.request("PATCH", path, token, json=json, **kwargs)
+
+    def record(self, method, path, elapsed, status, retried):
+        """
+        Adds a call to the stats of its endpoint, status None for a call that got no response.
+        """
+
+        # "/users/<id>" and "/users" are counted together, the ids would make a new endpoint for every user
+        endpoint = method + " /" + path.strip("/").split("/")[0].split("?")[0]
+        with self._lock:
+            entry = self._stats.setdefault(endpoint, {"calls": 0, "errors": 0, "retries": 0, "seconds": 0.0,
+                                                      "max_seconds": 0.0})
+            entry["calls"] += 1
+            entry["retries"] += retried
+            entry["seconds"] += elapsed
+            entry["max_seconds"] = max(entry["max_seconds"], elapsed)
+            if status is None or status >= 400:
+                entry["errors"] += 1
+
+    def stats(self):
+        """
+        Calls, errors, retries and time spent per endpoint, with the average time of a call.
+        """
+
+        with self._lock:
+            stats = {endpoint: dict(entry, avg_ms=entry["seconds"] / entry["calls"] * 1000)
+                     for endpoint, entry in self._stats.items()}
+        stats["cache"] = self.cache.stats()
+        return stats
@@ -0,0 +1,274 @@
+# Asynchronous client for Microsoft Graph, for pages that need several Graph resources at once.
+#
+# The client runs an asyncio event loop in a thread of its own, with an httpx.AsyncClient that keeps its
+# connections to Graph open. The app's views stay ordinary functions: they hand coroutines to the loop with
+# run() or submit() and wait for the result, so a page that needs the photo, the manager and the groups waits
+# as long as the slowest of them instead of the sum of all.
+#   - gather() sends independent requests concurrently.
+#   - batch() combines up to 20 requests into one Graph $batch round trip, and requests may depend on each
+#     other with dependsOn, e.g. a GET that must see the result of a PATCH.
+# Every user may have at most PER_USER calls to Graph going at the same time, so one page with many resources
+# cannot use up the connections, or Graph's throttling limits, of everyone else.
+# Throttled (429) and failed (5xx) calls, including the requests inside a batch, are retried like in graph.py.
+# GETs with a scope use the ResponseCache of the GraphClient the client is given, like GraphClient.get.
+
+import asyncio
+import base64
+import json
+import threading
+import time
+import weakref
+
+import httpx
+
+from graph import BACKOFF, GRAPH_URL, POOL_SIZE, RETRIES, RETRY_STATUS, TIMEOUT
+
+
+# Graph calls one user may have going at the same time
+PER_USER = 4
+# Requests Graph accepts in one $batch
+BATCH_SIZE = 20
+
+
+class BatchResponse:
+    """
+    The response to one request of a $batch, with the parts of requests.Response the app uses.
+    """
+
+    def __init__(self, response):
+        self.id = response["id"]
+        self.status_code = response["status"]
+        self.headers = response.get("headers", {})
+        self.body = response.get("body")
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def content(self):
+        # A body that is not JSON, like a photo, comes base64 encoded
+        if isinstance(self.body, str) and not self.headers.get("Content-Type", "").startswith("application/json"):
+            return base64.b64decode(self.body)
+        return b"" if self.body is None else str(self.body).encode()
+
+    @property
+    def text(self):
+        return self.body if isinstance(self.body, str) else json.dumps(self.body)
+
+    def json(self):
+        return self.body
+
+
+class AsyncGraphClient:
+    """
+    Client for Graph with its own event loop thread. One instance is shared by all threads of the app.
+    Calls made with a user count against that user's limit of PER_USER concurrent calls, calls without one
+    share a limit.
+    Stats of the calls are added to graph, a GraphClient, if one is given.
+    """
+
+    def __init__(self, base_url=GRAPH_URL, per_user=PER_USER, pool_size=POOL_SIZE, retries=RETRIES, backoff=BACKOFF,
+                 timeout=TIMEOUT, graph=None):
+        self.base_url = base_url.rstrip("/")
+        self.per_user = per_user
+        self.retries = retries
+        self.backoff = backoff
+        self.graph = graph
+
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="graph-async", daemon=True).start()
+        self._client = self.run(self._make_client(pool_size, timeout))
+        # user -> semaphore, a semaphore goes away once no call of its user is waiting for it
+        self._semaphores = weakref.WeakValueDictionary()
+
+    @staticmethod
+    async def _make_client(pool_size, timeout):
+        # Made on the loop that uses it
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        return httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(timeout[1], connect=timeout[0]))
+
+    def submit(self, coroutine):
+        """
+        Starts a coroutine on the client's loop, returns a concurrent.futures.Future of its result.
+        """
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def run(self, coroutine):
+        """
+        Runs a coroutine on the client's loop and waits for its result.
+        """
+
+        return self.submit(coroutine).result()
+
+    def _semaphore(self, user):
+        # Only used on the loop's thread
+        semaphore = self._semaphores.get(user)
+        if semaphore is None:
+            semaphore = self._semaphores[user] = asyncio.Semaphore(self.per_user)
+        return semaphore
+
+    async def request(self, method, path, token, user=None, **kwargs):
+        """
+        Sends a request to the Graph path (e.g. "/me") with the user's access token, returns the httpx.Response.
+        """
+
+        headers = kwargs.pop("headers", {})
+        headers["Authorization"] = "Bearer " + token
+        url = path if path.startswith(("https://", "http://")) else self.base_url + path
+
+        semaphore = self._semaphore(user)
+        start = time.perf_counter()
+        retried = 0
+        async with semaphore:
+            while True:
+                try:
+                    response = await self._client.request(method, url, headers=headers, **kwargs)
+                except httpx.HTTPError:
+                    self._record(method, path, time.perf_counter() - start, None, retried)
+                    raise
+                if response.status_code not in RETRY_STATUS or retried == self.retries:
+                    break
+                await asyncio.sleep(self._delay(response.headers, retried))
+                retried += 1
+
+        self._record(method, path, time.perf_counter() - start, response.status_code, retried)
+        return response
+
+    async def get(self, path, token, user=None, scope=None):
+        """
+        GET request. With a scope, and a graph to take the cache from, the response is cached under
+        (scope, path) in the same ResponseCache as GraphClient.get, and revalidated with its ETag.
+        """
+
+        cache = self.graph.cache if self.graph is not None else None
+        if scope is None or cache is None:
+            return await self.request("GET", path, token, user)
+
+        key = (scope, path)
+        cached = cache.get(key)
+        if cached is not None and cached[1]:
+            cache.hits += 1
+            return cached[0]
+
+        etag = cached[0].headers.get("ETag") if cached is not None else None
+        headers = {"If-None-Match": etag} if etag is not None else {}
+        response = await self.request("GET", path, token, user, headers=headers)
+
+        if response.status_code == 304 and cached is not None:
+            cache.revalidated += 1
+            cache.put(key, cached[0])
+            return cached[0]
+
+        cache.misses += 1
+        if response.status_code == 200:
+            cache.put(key, response)
+        return response
+
+    async def gather(self, token, user, paths, scope=None):
+        """
+        GETs every path of the dict paths concurrently, returns the responses under the same keys.
+        With a scope the responses are cached, see get.
+        """
+
+        responses = await asyncio.gather(*(self.get(path, token, user, scope) for path in paths.values()))
+        return dict(zip(paths, responses))
+
+    async def batch(self, token, user, requests):
+        """
+        Sends requests, dicts with "id", "method", "url" and optionally "body", "headers" and "dependsOn",
+        as $batch requests of up to 20, returns a BatchResponse by id. Requests that depend on each other
+        go in the same $batch, so more than 20 of them in one chain raises ValueError.
+        The $batch requests are sent concurrently.
+        """
+
+        results = {}
+        pending = list(requests)
+        for attempt in range(self.retries + 1):
+            chunks = self._chunks(pending)
+            replies = await asyncio.gather(*(self._send_batch(token, user, chunk) for chunk in chunks))
+
+            retry = set()
+            retry_after = 0.0
+            for reply in replies:
+                for response in reply:
+                    if response["status"] in RETRY_STATUS and attempt < self.retries:
+                        retry.add(response["id"])
+                        retry_after = max(retry_after, self._delay(response.get("headers", {}), attempt))
+                    else:
+                        results[response["id"]] = BatchResponse(response)
+            # A request that failed with 424 because a request it depends on failed is retried with that one
+            changed = True
+            while changed:
+                changed = False
+                for request in pending:
+                    result = results.get(request["id"])
+                    if result is not None and result.status_code == 424 \
+                            and retry.intersection(request.get("dependsOn", ())):
+                        retry.add(request["id"])
+                        del results[request["id"]]
+                        changed = True
+            if not retry:
+                break
+
+            # Requests that succeeded are not sent again, so they cannot be depended on any more
+            pending = [dict(request, dependsOn=[d for d in request.get("dependsOn", ()) if d in retry])
+                       for request in pending if request["id"] in retry]
+            for request in pending:
+                if not request["dependsOn"]:
+                    del request["dependsOn"]
+            await asyncio.sleep(retry_after)
+
+        return results
+
+    async def _send_batch(self, token, user, chunk):
+        response = await self.request("POST", "/$batch", token, user, json={"requests": chunk})
+        response.raise_for_status()
+        return response.json()["responses"]
+
+    @staticmethod
+    def _chunks(requests):
+        """
+        Splits requests into lists of at most BATCH_SIZE, keeping requests that depend on each other together.
+        """
+
+        # Groups of requests connected by dependsOn, found with union-find
+        parent = {request["id"]: request["id"] for request in requests}
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for request in requests:
+            for dependency in request.get("dependsOn", ()):
+                parent[find(request["id"])] = find(dependency)
+
+        groups = {}
+        for request in requests:
+            groups.setdefault(find(request["id"]), []).append(request)
+
+        chunks = []
+        for group in sorted(groups.values(), key=len, reverse=True):
+            if len(group) > BATCH_SIZE:
+                raise ValueError(f"{len(group)} requests depend on each other, a $batch takes at most {BATCH_SIZE}")
+            for chunk in chunks:
+                if len(chunk) + len(group) <= BATCH_SIZE:
+                    chunk.extend(group)
+                    break
+            else:
+                chunks.append(list(group))
+        return chunks
+
+    def _delay(self, headers, attempt):
+        # As long as Graph asks for, otherwise exponential backoff
+        retry_after = headers.get("Retry-After")
+        if retry_after is not None and str(retry_after).isdigit():
+            return float(retry_after)
+        return self.backoff * 2 ** attempt
+
+    def _record(self, method, path, elapsed, status, retried):
+        if self.graph is not None:
+            self.graph.record(method, path, elapsed, status, retried)
@@ -0,0 +1,205 @@
+# Local stand-in for the parts of Microsoft Graph the app uses, for testing without Azure.
+#
+# Run <python mock_graph.py>, and start the app with GRAPH_URL=http://localhost:5567/v1.0.
+# Any bearer token is accepted. With --fail-every N every Nth request is answered with 429 or 503,
+# to see the client's retries at work, and --delay adds latency to every response.
+# Responses carry an ETag, and a request with a matching If-None-Match gets 304 Not Modified.
+# /users is paged with $top and @odata.nextLink and honours $select, /users/delta answers delta queries.
+# --users N makes a tenant of N users, to try a large directory.
+# /$batch runs the requests of a JSON batch one after the other, honouring dependsOn, without the --delay
+# of each one, like Graph, where a batch costs about one round trip.
+
+import argparse
+import base64
+import hashlib
+import json
+import time
+import uuid
+
+from flask import Flask, Response, abort, jsonify, request
+from werkzeug.serving import WSGIRequestHandler
+
+
+app = Flask(__name__)
+
+ME = "00000000-0000-0000-0000-000000000001"
+users = {}
+# id -> version of the directory in which the user last changed, for delta queries
+versions = {}
+directory = {"version": 0}
+
+# The test user's photo, a 1x1 PNG
+PHOTO = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==")
+GROUPS = [{"@odata.type": "#microsoft.graph.group", "id": str(uuid.UUID(int=1000 + i)), "displayName": name}
+          for i, name in enumerate(["INF-2310", "Students", "UiT"])]
+
+settings = {"fail_every": 0, "delay": 0.0}
+counter = {"requests": 0}
+
+
+def make_users(count):
+    users.clear()
+    users[ME] = {"id": ME, "displayName": "Test User", "mobilePhone": "12345678", "mail": "test@example.com"}
+    for i in range(2, count + 1):
+        user_id = str(uuid.UUID(int=i))
+        users[user_id] = {"id": user_id, "displayName": f"User {i}", "mobilePhone": None,
+                          "mail": f"user{i}@example.com"}
+    versions.update((user_id, 0) for user_id in users)
+
+
+make_users(20)
+
+
+@app.before_request
+def check_request():
+    if not request.headers.get("Authorization", "").startswith("Bearer "):
+        return jsonify(error={"code": "InvalidAuthenticationToken"}), 401
+
+    # The requests inside a batch do not wait again
+    if not request.headers.get("X-Mock-Batch"):
+        time.sleep(settings["delay"])
+    counter["requests"] += 1
+    if settings["fail_every"] and counter["requests"] % settings["fail_every"] == 0:
+        if counter["requests"] // settings["fail_every"] % 2:
+            return jsonify(error={"code": "TooManyRequests"}), 429, {"Retry-After": "1"}
+        return jsonify(error={"code": "serviceNotAvailable"}), 503
+
+
+def with_etag(data):
+    body = json.dumps(data)
+    etag = '"' + hashlib.sha256(body.encode()).hexdigest()[:16] + '"'
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status=304, headers={"ETag": etag})
+    return Response(body, mimetype="application/json", headers={"ETag": etag})
+
+
+@app.route("/v1.0/me")
+def me():
+    return with_etag(users[ME])
+
+
+@app.route("/v1.0/me/manager")
+def manager():
+    return with_etag(users[str(uuid.UUID(int=2))])
+
+
+@app.route("/v1.0/me/memberOf")
+def member_of():
+    return with_etag({"value": GROUPS})
+
+
+@app.route("/v1.0/me/photo")
+def photo_metadata():
+    return with_etag({"id": "1X1", "height": 1, "width": 1, "@odata.mediaContentType": "image/png"})
+
+
+@app.route("/v1.0/me/photo/$value")
+def photo():
+    return Response(PHOTO, mimetype="image/png")
+
+
+@app.route("/v1.0/$batch", methods=["POST"])
+def batch():
+    requests = request.get_json(force=True)["requests"]
+    if len(requests) > 20:
+        return jsonify(error={"code": "BadRequest", "message": "At most 20 requests in a batch"}), 400
+
+    client = app.test_client()
+    statuses = {}
+    responses = []
+    for sub in requests:
+        if any(statuses.get(d, 424) >= 400 for d in sub.get("dependsOn", [])):
+            statuses[sub["id"]] = 424
+            responses.append({"id": sub["id"], "status": 424, "body": {"error": {"code": "FailedDependency"}}})
+            continue
+
+        headers = dict(sub.get("headers", {}), **{"Authorization": request.headers["Authorization"],
+                                                  "X-Mock-Batch": "1"})
+        kwargs = {"json": sub["body"]} if "body" in sub else {}
+        reply = client.open("/v1.0" + sub["url"], method=sub["method"], headers=headers, **kwargs)
+        statuses[sub["id"]] = reply.status_code
+        body = None
+        if reply.data:
+            body = reply.get_json() if reply.is_json else base64.b64encode(reply.data).decode()
+        responses.append({"id": sub["id"], "status": reply.status_code, "body": body,
+                          "headers": {name: value for name, value in reply.headers.items()
+                                      if name in ("Content-Type", "ETag", "Retry-After")}})
+    return jsonify(responses=responses)
+
+
+def select(user):
+    fields = request.args.get("$select")
+    if not fields:
+        return user
+    return {name: user.get(name) for name in ["id"] + fields.split(",")}
+
+
+def paged(items, extra_args, page_size):
+    """
+    One page of items from $skiptoken, with a nextLink to the next page if there is one.
+    """
+
+    skip = int(request.args.get("$skiptoken", 0))
+    page = {"value": [select(user) for user in items[skip:skip + page_size]]}
+    if skip + page_size < len(items):
+        args = dict(extra_args, **{"$skiptoken": skip + page_size})
+        page["@odata.nextLink"] = request.base_url + "?" + "&".join(f"{k}={v}" for k, v in args.items())
+    return page
+
+
+@app.route("/v1.0/users")
+def list_users():
+    top = min(int(request.args.get("$top", 100)), 999)
+    args = {"$top": top}
+    if "$select" in request.args:
+        args["$select"] = request.args["$select"]
+    return with_etag(paged(list(users.values()), args, top))
+
+
+@app.route("/v1.0/users/delta")
+def users_delta():
+    # The version the caller has seen, and the version this round of pages ends at
+    since = int(request.args.get("$deltatoken", -1))
+    until = int(request.args.get("until", directory["version"]))
+    changed = [user for user_id, user in users.items() if since < versions[user_id] <= until or since < 0]
+
+    prefer = request.headers.get("Prefer", "")
+    page_size = int(prefer.split("=")[1]) if prefer.startswith("odata.maxpagesize=") else 200
+    args = {"$deltatoken": since, "until": until}
+    if "$select" in request.args:
+        args["$select"] = request.args["$select"]
+
+    page = paged(changed, args, page_size)
+    if "@odata.nextLink" not in page:
+        page["@odata.deltaLink"] = request.base_url + f"?$deltatoken={until}" + \
+            (f"&$select={request.args['$select']}" if "$select" in request.args else "")
+    return jsonify(page)
+
+
+@app.route("/v1.0/users/<user_id>", methods=["GET", "PATCH"])
+def user(user_id):
+    if user_id not in users:
+        abort(404)
+    if request.method == "PATCH":
+        changes = request.get_json(force=True)
+        changes.pop("id", None)
+        users[user_id].update(changes)
+        directory["version"] += 1
+        versions[user_id] = directory["version"]
+        return "", 204
+    return with_etag(users[user_id])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for Microsoft Graph")
+    parser.add_argument("--port", type=int, default=5567)
+    parser.add_argument("--fail-every", type=int, default=0, help="answer every Nth request with 429 or 503")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to wait before every response")
+    parser.add_argument("--users", type=int, default=20, help="number of users in the tenant")
+    args = parser.parse_args()
+    settings.update(fail_every=args.fail_every, delay=args.delay)
+    make_users(args.users)
+
+    # HTTP/1.1 keeps the connections open between requests, as Graph does
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    app.run(port=args.port, threaded=True)
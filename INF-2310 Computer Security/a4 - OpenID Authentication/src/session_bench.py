@@ -0,0 +1,194 @@
+# Benchmark of the session stores in sessions.py.
+#
+# Every store is filled with sessions about as large as the app's (the claims of a logged in user), and then
+# measured twice, each time with every number of threads given:
+#   - the store alone: sessions read and written per second.
+#   - through Flask: requests per second to a route that only reads the session, and to one that changes it.
+# The Flask part is also run with Flask-Session's filesystem sessions, which the app used before, if it is
+# installed. The results are printed as JSON.
+#
+# Run <python session_bench.py>, add --redis redis://localhost:6379/0 to include a Redis server.
+
+import argparse
+import json
+import os
+import random
+import secrets
+import sys
+import tempfile
+import threading
+import time
+
+from flask import Flask, session
+
+from sessions import MemoryStore, RedisStore, SQLiteStore, StoreSessionInterface
+
+
+SESSIONS = 10000
+THREADS = [1, 4, 16]
+# Seconds each measurement runs
+DURATION = 2.0
+
+# A session like the app's, the ID token claims of the logged in user
+CLAIMS = {
+    "aud": "228e74e3-85d9-44e1-8fa0-fbc5b96a0c3e",
+    "iss": "https://login.microsoftonline.com/0cff9966-b3c0-4a41-9874-3c22e287ab4c/v2.0",
+    "iat": 1700000000, "nbf": 1700000000, "exp": 1700003600,
+    "name": "Test User", "preferred_username": "test@example.com",
+    "oid": "00000000-0000-0000-0000-000000000001", "tid": "0cff9966-b3c0-4a41-9874-3c22e287ab4c",
+    "nonce": "x" * 64, "rh": "x" * 80, "sub": "x" * 43, "uti": "x" * 22, "ver": "2.0",
+}
+
+
+def run_threads(threads : int, duration : float, work) -> float:
+    """
+    Calls work(rng) in a loop on threads threads for duration seconds, returns calls per second.
+    """
+
+    stop = time.perf_counter() + duration
+    counts = [0] * threads
+
+    def loop(i):
+        rng = random.Random(i)
+        count = 0
+        while time.perf_counter() < stop:
+            work(rng)
+            count += 1
+        counts[i] = count
+
+    workers = [threading.Thread(target=loop, args=(i,)) for i in range(threads)]
+    begin = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(counts) / (time.perf_counter() - begin)
+
+
+def bench_store(store, sids : list, data : str, threads : int, duration : float) -> dict:
+    def read(rng):
+        store.get(rng.choice(sids))
+
+    def write(rng):
+        store.set(rng.choice(sids), data, 3600)
+
+    return {"reads_per_s": run_threads(threads, duration, read), "writes_per_s": run_threads(threads, duration, write)}
+
+
+def make_app(interface=None, config=None) -> Flask:
+    app = Flask(__name__)
+    app.config["SECRET_KEY"] = "bench"
+    app.config.update(config or {})
+    if interface is not None:
+        app.session_interface = interface
+    else:
+        from flask_session import Session
+        Session(app)
+
+    @app.route("/login")
+    def login():
+        session["_logged_in_user"] = CLAIMS
+        return ""
+
+    @app.route("/read")
+    def read():
+        return session["_logged_in_user"]["name"]
+
+    @app.route("/write")
+    def write():
+        session["counter"] = session.get("counter", 0) + 1
+        return ""
+
+    return app
+
+
+def log_in(app : Flask, sessions : int) -> list:
+    """
+    Logs in sessions clients, returns their session cookies.
+    """
+
+    cookies = []
+    client = app.test_client()
+    for _ in range(sessions):
+        client.get("/login")
+        cookies.append(client.get_cookie(app.config.get("SESSION_COOKIE_NAME", "session")).value)
+        client.delete_cookie(app.config.get("SESSION_COOKIE_NAME", "session"))
+    return cookies
+
+
+def bench_app(app : Flask, cookies : list, threads : int, duration : float) -> dict:
+    # Every request uses the session cookie of one of the logged in clients
+    local = threading.local()
+
+    def request(path):
+        def work(rng):
+            client = getattr(local, "client", None)
+            if client is None:
+                client = local.client = app.test_client()
+            client.set_cookie(app.config.get("SESSION_COOKIE_NAME", "session"), rng.choice(cookies))
+            client.get(path)
+        return work
+
+    return {"read_requests_per_s": run_threads(threads, duration, request("/read")),
+            "write_requests_per_s": run_threads(threads, duration, request("/write"))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the session stores")
+    parser.add_argument("--sessions", type=int, default=SESSIONS, help="sessions in every store")
+    parser.add_argument("--threads", nargs="+", type=int, default=THREADS, help="numbers of threads to test with")
+    parser.add_argument("--duration", type=float, default=DURATION, help="seconds each measurement runs")
+    parser.add_argument("--redis", default=None, help="URL of a Redis server to include, e.g. redis://localhost:6379/0")
+    parser.add_argument("--output", default=None, help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    data = StoreSessionInterface.serializer.dumps({"_logged_in_user": CLAIMS})
+    results = []
+
+    with tempfile.TemporaryDirectory(prefix="session-bench-") as tmp:
+        stores = {"memory": lambda: MemoryStore(), "sqlite": lambda: SQLiteStore(os.path.join(tmp, "sessions.db"))}
+        if args.redis:
+            stores["redis"] = lambda: RedisStore(args.redis, prefix="session-bench:")
+
+        for name, make in stores.items():
+            store = make()
+            sids = [secrets.token_urlsafe(32) for _ in range(args.sessions)]
+            for sid in sids:
+                store.set(sid, data, 3600)
+            app = make_app(StoreSessionInterface(make()))
+            # Logging in goes through a whole request, so fewer sessions are used through Flask
+            cookies = log_in(app, min(args.sessions, 1000))
+            for threads in args.threads:
+                result = dict(store=name, threads=threads, **bench_store(store, sids, data, threads, args.duration),
+                              **bench_app(app, cookies, threads, args.duration))
+                results.append(result)
+                print(f"{name:>10} x {threads:>3} threads: {result['reads_per_s']:10.0f} reads/s "
+                      f"{result['writes_per_s']:10.0f} writes/s, requests: {result['read_requests_per_s']:7.0f} "
+                      f"reading/s {result['write_requests_per_s']:7.0f} writing/s", file=sys.stderr)
+
+        try:
+            # The threshold is raised so it does not drop sessions the benchmark still uses
+            app = make_app(config={"SESSION_TYPE": "filesystem", "SESSION_FILE_DIR": os.path.join(tmp, "flask_session"),
+                                   "SESSION_FILE_THRESHOLD": args.sessions * 2})
+        except ImportError:
+            app = None
+        if app is not None:
+            cookies = log_in(app, min(args.sessions, 1000))
+            for threads in args.threads:
+                result = dict(store="flask-session filesystem", threads=threads,
+                              **bench_app(app, cookies, threads, args.duration))
+                results.append(result)
+                print(f"{'filesystem':>10} x {threads:>3} threads: requests: {result['read_requests_per_s']:7.0f} "
+                      f"reading/s {result['write_requests_per_s']:7.0f} writing/s", file=sys.stderr)
+
+    report = {"python": sys.version.split()[0], "cpus": os.cpu_count(), "sessions": args.sessions, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
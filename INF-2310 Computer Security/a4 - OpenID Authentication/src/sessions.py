@@ -0,0 +1,272 @@
+# Server side sessions for the Flask app, with the session data kept in a SessionStore.
+#
+# The browser only gets a random session id in its cookie. Three stores are available:
+#   - MemoryStore: a dictionary in the process, the fastest, for an app that runs as a single process.
+#     It keeps at most max_entries sessions, the least recently active are dropped first.
+#   - SQLiteStore: an SQLite database in WAL mode, shared by every worker process on the machine.
+#   - RedisStore: a Redis server (or anything that speaks its protocol), shared by workers on several machines.
+#     Needs the redis package.
+# make_store picks one from a string like "memory", "sqlite:sessions.db" or "redis://localhost:6379/0",
+# which app.py reads from the SESSION_STORE environment variable.
+#
+# A session is only written to the store when the request changed it. An unchanged session only has its
+# expiry pushed forward, and only once less than half of its lifetime is left, so most requests just read.
+# Expired sessions are deleted by a background thread every SWEEP_INTERVAL seconds (Redis expires them itself).
+
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+
+# Seconds a session lives without being used
+SESSION_LIFETIME = 24 * 60 * 60
+SWEEP_INTERVAL = 60.0
+MEMORY_SIZE = 100000
+SESSION_STORE = os.environ.get("SESSION_STORE", "sqlite:sessions.db")
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryStore:
+    """
+    Sessions in a dictionary of this process. Safe to use from several threads.
+    """
+
+    def __init__(self, max_entries=MEMORY_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # id -> (expiry time, data). All sessions live equally long, so the order they were last
+        # written or touched in is also the order they expire in, the first expires first.
+        self._entries = OrderedDict()
+
+    def get(self, sid):
+        """
+        (data, expiry time) of a session, None if there is no such session or it has expired.
+        """
+
+        entry = self._entries.get(sid)
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1], entry[0]
+
+    def set(self, sid, data, lifetime):
+        with self._lock:
+            self._entries[sid] = (time.time() + lifetime, data)
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def touch(self, sid, lifetime):
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is not None:
+                self._entries[sid] = (time.time() + lifetime, entry[1])
+                self._entries.move_to_end(sid)
+
+    def delete(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+
+    def sweep(self):
+        """
+        Deletes the expired sessions, returns how many.
+        """
+
+        now = time.time()
+        swept = 0
+        with self._lock:
+            while self._entries:
+                sid, (expires, _) = next(iter(self._entries.items()))
+                if expires >= now:
+                    break
+                del self._entries[sid]
+                swept += 1
+        return swept
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteStore:
+    """
+    Sessions in an SQLite database, which any number of processes can share.
+    Every thread has its own connection, so readers do not wait for each other.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            # The sessions say who is logged in, only the owner may read them
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        self._local = threading.local()
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)")
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            # A commit does not wait for the disk, a crash may lose the last few session changes but not corrupt
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def get(self, sid):
+        return self._db().execute("SELECT data, expires FROM sessions WHERE id = ? AND expires >= ?",
+                                  (sid, time.time())).fetchone()
+
+    def set(self, sid, data, lifetime):
+        self._db().execute("INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (?, ?, ?)",
+                           (sid, data, time.time() + lifetime))
+
+    def touch(self, sid, lifetime):
+        self._db().execute("UPDATE sessions SET expires = ? WHERE id = ?", (time.time() + lifetime, sid))
+
+    def delete(self, sid):
+        self._db().execute("DELETE FROM sessions WHERE id = ?", (sid,))
+
+    def sweep(self):
+        return self._db().execute("DELETE FROM sessions WHERE expires < ?", (time.time(),)).rowcount
+
+    def __len__(self):
+        return self._db().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+class RedisStore:
+    """
+    Sessions in Redis, under "session:<id>" keys that Redis expires by itself.
+    """
+
+    def __init__(self, url, prefix="session:"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("The redis package is needed for a Redis session store: pip install redis")
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, sid):
+        # Both in one round trip
+        data, ttl = self._redis.pipeline().get(self.prefix + sid).pttl(self.prefix + sid).execute()
+        if data is None:
+            return None
+        return data.decode(), time.time() + ttl / 1000
+
+    def set(self, sid, data, lifetime):
+        self._redis.set(self.prefix + sid, data, ex=int(lifetime))
+
+    def touch(self, sid, lifetime):
+        self._redis.expire(self.prefix + sid, int(lifetime))
+
+    def delete(self, sid):
+        self._redis.delete(self.prefix + sid)
+
+    def sweep(self):
+        return 0
+
+    def __len__(self):
+        return sum(1 for _ in self._redis.scan_iter(self.prefix + "*"))
+
+
+def make_store(spec=SESSION_STORE):
+    """
+    The store a spec names: "memory", "sqlite:<path>" or a redis:// URL.
+    """
+
+    if spec == "memory":
+        return MemoryStore()
+    if spec.startswith("sqlite:"):
+        return SQLiteStore(spec[len("sqlite:"):])
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStore(spec)
+    raise ValueError(f"Unknown session store: {spec}")
+
+
+class StoredSession(CallbackDict, SessionMixin):
+    """
+    A session whose data is in a store. modified is set as soon as a key is set or removed.
+    """
+
+    def __init__(self, data=None, sid=None, new=False, expires=None):
+        def on_update(session):
+            session.modified = True
+
+        super().__init__(data, on_update)
+        self.sid = sid
+        self.new = new
+        self.expires = expires
+        self.modified = False
+
+
+class StoreSessionInterface(SessionInterface):
+    """
+    Flask session interface that keeps the sessions in a store, see make_store.
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, lifetime=SESSION_LIFETIME, sweep_interval=SWEEP_INTERVAL):
+        self.store = store
+        self.lifetime = lifetime
+        self.sweep_interval = sweep_interval
+        self._sweeper = None
+        self._sweeper_lock = threading.Lock()
+
+    def open_session(self, app, request):
+        self._start_sweeper()
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            stored = self.store.get(sid)
+            if stored is not None:
+                return StoredSession(self.serializer.loads(stored[0]), sid, expires=stored[1])
+        return StoredSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            # Emptied, e.g. by logging out: the session is deleted instead of stored empty
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app), httponly=self.get_cookie_httponly(app))
+            return
+
+        if session.modified:
+            self.store.set(session.sid, self.serializer.dumps(dict(session)), self.lifetime)
+        elif session.expires is None or session.expires - time.time() < self.lifetime / 2:
+            self.store.touch(session.sid, self.lifetime)
+
+        if session.new or self.should_set_cookie(app, session):
+            response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                                secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+    def _start_sweeper(self):
+        if self._sweeper is not None:
+            return
+        with self._sweeper_lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep, name="session-sweeper", daemon=True)
+                self._sweeper.start()
+
+    def _sweep(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.store.sweep()
+            except Exception as e:
+                # A busy database or a lost Redis connection is simply tried again next time
+                logger.warning("Session sweep failed: %s", e)
@@ -0,0 +1,171 @@
+# MSAL token cache shared by every worker process of the app, stored in SQLite with one row per user.
+#
+# identity.web.Auth keeps the token cache in the Flask session, so every request that gets a token
+# deserialises it and writes it back, and a worker process never sees tokens another one fetched.
+# CachedAuth keeps it in a TokenStore instead:
+#   - the cache of a user is read from SQLite once and then kept in memory, so getting a token for a request
+#     is an in-memory lookup. PRAGMA data_version tells whether another process wrote to the database since,
+#     and only then is the user's row read again.
+#   - it is written back only when MSAL changed it, that is when a token was fetched or refreshed.
+# The database holds refresh tokens, so it is only readable by the owner, like a private key.
+
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import identity.web
+import msal
+
+
+TOKEN_CACHE_FILE = os.environ.get("TOKEN_CACHE_FILE", "token_cache.db")
+# Users whose caches are kept in memory at most
+MEMORY_SIZE = 10000
+
+
+def _merge(old, new):
+    """
+    Serialised cache with the entries of both, the ones in new win.
+    """
+
+    merged = json.loads(old)
+    for section, entries in json.loads(new).items():
+        merged.setdefault(section, {}).update(entries)
+    return json.dumps(merged)
+
+
+class TokenStore:
+    """
+    MSAL token caches by user, in an SQLite database shared by processes, and in memory.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, path=TOKEN_CACHE_FILE, memory_size=MEMORY_SIZE):
+        self.path = path
+        self.memory_size = memory_size
+        self.hits = 0
+        self.reads = 0
+        self.writes = 0
+
+        if not os.path.exists(path):
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # WAL lets the processes read while one of them writes
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS token_cache "
+                         "(user TEXT PRIMARY KEY, data TEXT NOT NULL, version INTEGER NOT NULL)")
+
+        self._lock = threading.Lock()
+        # user -> (version of the row, the cache), least recently used first
+        self._memory = OrderedDict()
+        # Users whose memory copy is known to be current since the database last changed
+        self._current = set()
+        self._data_version = self._db.execute("PRAGMA data_version").fetchone()[0]
+
+    def load(self, user):
+        """
+        The token cache of a user, an empty one if there is none.
+        """
+
+        with self._lock:
+            # Changes only when another connection committed, our own writes keep it
+            data_version = self._db.execute("PRAGMA data_version").fetchone()[0]
+            if data_version != self._data_version:
+                self._data_version = data_version
+                self._current.clear()
+
+            entry = self._memory.get(user)
+            if entry is not None and user in self._current:
+                self._memory.move_to_end(user)
+                self.hits += 1
+                return entry[1]
+
+            self.reads += 1
+            row = self._db.execute("SELECT data, version FROM token_cache WHERE user = ?", (user,)).fetchone()
+            if entry is not None and row is not None and row[1] == entry[0]:
+                cache = entry[1]
+            else:
+                cache = msal.SerializableTokenCache()
+                if row is not None:
+                    cache.deserialize(row[0])
+            self._remember(user, row[1] if row is not None else 0, cache)
+            return cache
+
+    def save(self, user, cache):
+        """
+        Writes the user's cache if MSAL changed it. A cache that did not come from load, like the empty one
+        a log-in starts with, or one that another process has written since, is merged with what is stored
+        for the user, so no tokens are lost.
+        """
+
+        if not cache.has_state_changed:
+            return
+
+        with self._lock:
+            data = cache.serialize()
+            entry = self._memory.get(user)
+            row = self._db.execute("SELECT data, version FROM token_cache WHERE user = ?", (user,)).fetchone()
+            if row is not None and (entry is None or entry[1] is not cache or entry[0] != row[1]):
+                data = _merge(row[0], data)
+                cache.deserialize(data)
+
+            version = self._db.execute(
+                "INSERT INTO token_cache (user, data, version) VALUES (?, ?, 1) "
+                "ON CONFLICT (user) DO UPDATE SET data = excluded.data, version = version + 1 "
+                "RETURNING version", (user, data)).fetchone()[0]
+            self.writes += 1
+            self._remember(user, version, cache)
+
+    def forget(self, user):
+        with self._lock:
+            self._db.execute("DELETE FROM token_cache WHERE user = ?", (user,))
+            self._memory.pop(user, None)
+            self._current.discard(user)
+
+    def _remember(self, user, version, cache):
+        self._memory[user] = (version, cache)
+        self._memory.move_to_end(user)
+        self._current.add(user)
+        while len(self._memory) > self.memory_size:
+            evicted, _ = self._memory.popitem(last=False)
+            self._current.discard(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {"users": len(self._memory), "hits": self.hits, "reads": self.reads, "writes": self.writes}
+
+
+class CachedAuth(identity.web.Auth):
+    """
+    identity.web.Auth with the token cache in a TokenStore instead of the session.
+    The session still holds the logged in user, which says whose cache to use.
+    """
+
+    def __init__(self, *, token_store, **kwargs):
+        super().__init__(**kwargs)
+        self._token_store = token_store
+
+    def _user_key(self):
+        user = self._load_user_from_session()
+        if not user:
+            return None
+        # The same account as MSAL's home account id
+        return f"{user.get('oid')}.{user.get('tid')}"
+
+    def _load_cache(self):
+        key = self._user_key()
+        # At log-in there is no user yet, the cache starts empty and is merged into the stored one when saved
+        return self._token_store.load(key) if key else msal.SerializableTokenCache()
+
+    def _save_cache(self, cache):
+        key = self._user_key()
+        if key:
+            self._token_store.save(key, cache)
+
+    def log_out(self, homepage):
+        key = self._user_key()
+        if key:
+            self._token_store.forget(key)
+        return super().log_out(homepage)
@@ -0,0 +1,24 @@
+"""
+CartPole reinforcement learning as an importable library.
+
+Importing the package is cheap: torch is loaded by rl.dqn,
+and matplotlib, IPython and the environments are only loaded when they are used.
+
+    from rl import train, TrainConfig
+    durations = train(TrainConfig(num_episodes=50, seed=0))
+"""
+
+from .config import TrainConfig
+
+_LAZY = {
+    "train": ".dqn",
+    "Trainer": ".dqn",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        import importlib
+        module = importlib.import_module(_LAZY[name], __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,280 @@
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from .config import QLearningConfig, TrainConfig
+
+# Every metric is stored as {"value": ..., "unit": ..., "higher_is_better": ...}
+# so that a comparison does not need to know what the metric measures.
+
+
+def _metric(value : float, unit : str, higher_is_better : bool) -> dict:
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+def _best_rate(fn, n : int, repeats : int) -> float:
+    """
+    Best of `repeats` runs of fn(n), as operations per second.
+    """
+    best = 0.0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(n)
+        elapsed = time.perf_counter() - start
+        best = max(best, n / elapsed)
+    return best
+
+
+def bench_env_single(steps : int, repeats : int, seed : int) -> dict:
+    from .envs import make_env
+
+    env = make_env()
+    env.reset(seed=seed)
+    rng = random.Random(seed)
+
+    def run(n):
+        for _ in range(n):
+            _, _, terminated, truncated, _ = env.step(rng.randrange(4))
+            if terminated or truncated:
+                env.reset()
+
+    return {"env_step_single": _metric(_best_rate(run, steps, repeats), "steps/s", True)}
+
+
+def bench_env_vector(steps : int, repeats : int, seed : int, num_envs : int) -> dict:
+    from .vector_env import VectorCartPole
+
+    env = VectorCartPole(num_envs, dims=2, max_episode_steps=None, seed=seed)
+    env.reset()
+    rng = np.random.default_rng(seed)
+
+    def run(n):
+        for _ in range(n // num_envs):
+            _, _, terminated, truncated = env.step(rng.integers(0, 4, size=num_envs))
+            env.reset_done(terminated | truncated)
+
+    return {f"env_step_vector_{num_envs}": _metric(_best_rate(run, steps, repeats), "steps/s", True)}
+
+
+def _transition(n_observations : int):
+    import torch
+
+    state = torch.rand(1, n_observations)
+    next_state = torch.rand(1, n_observations)
+    return state, torch.tensor([[1]]), next_state, torch.tensor([1.0])
+
+
+def bench_replay(ops : int, repeats : int, seed : int, batch_size : int = 128) -> dict:
+    from .dqn import ReplayMemory
+    from .replay_store import MemmapReplay
+
+    random.seed(seed)
+    n_observations = 8
+    state, action, next_state, reward = _transition(n_observations)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        stores = {
+            "memory": ReplayMemory(10000),
+            "memmap": MemmapReplay(directory, 10000, n_observations, seed=seed),
+        }
+        for name, memory in stores.items():
+            def push(n, memory=memory):
+                for i in range(n):
+                    memory.push(state, action, None if i % 50 == 0 else next_state, reward)
+
+            def sample(n, memory=memory):
+                for _ in range(n):
+                    memory.sample_batch(batch_size, "cpu")
+
+            results[f"replay_{name}_push"] = _metric(_best_rate(push, ops, repeats), "ops/s", True)
+            results[f"replay_{name}_sample_{batch_size}"] = _metric(
+                _best_rate(sample, max(ops // 50, 1), repeats), "batches/s", True)
+    return results
+
+
+def bench_optimize(updates : int, repeats : int, seed : int, batch_sizes : tuple) -> dict:
+    from .dqn import Trainer
+
+    results = {}
+    for batch_size in batch_sizes:
+        trainer = Trainer(TrainConfig(batch_size=batch_size, seed=seed, device="cpu"))
+        state, action, next_state, reward = _transition(trainer.n_observations)
+        for i in range(max(batch_size, 1000)):
+            trainer.memory.push(state, action, None if i % 50 == 0 else next_state, reward)
+
+        def run(n):
+            for _ in range(n):
+                trainer.optimize_model()
+
+        results[f"optimize_model_batch_{batch_size}"] = _metric(_best_rate(run, updates, repeats), "updates/s", True)
+    return results
+
+
+def _time_to_target(train_fn, target : float, seeds : tuple) -> dict:
+    """
+    Wall clock time until the 100 episode mean duration reaches target, median over the seeds.
+    A seed that never reaches the target counts as its full run time and is reported as a miss.
+    """
+    times = []
+    misses = 0
+
+    class Stop(Exception):
+        pass
+
+    for seed in seeds:
+        window = []
+        start = time.perf_counter()
+
+        def callback(trainer, i_episode, duration):
+            window.append(duration)
+            if len(window) > 100:
+                window.pop(0)
+            if len(window) == 100 and sum(window) / 100 >= target:
+                raise Stop
+
+        try:
+            train_fn(seed, callback)
+            misses += 1
+        except Stop:
+            pass
+        times.append(time.perf_counter() - start)
+
+    return {"seconds": float(np.median(times)), "misses": misses}
+
+
+def bench_learning(seeds : tuple, dqn_target : float, dqn_episodes : int, q_target : float,
+                   q_episodes : int) -> dict:
+    from .dqn import Trainer
+    from .tabular import QLearner
+
+    results = {}
+
+    def q_run(seed, callback):
+        QLearner(QLearningConfig(seed=seed)).train(q_episodes, callbacks=(callback,))
+
+    q = _time_to_target(q_run, q_target, seeds)
+    results[f"qlearning_time_to_{q_target:g}"] = _metric(q["seconds"], "s", False)
+    results["qlearning_target_misses"] = _metric(q["misses"], "runs", False)
+
+    if dqn_episodes:
+        def dqn_run(seed, callback):
+            Trainer(TrainConfig(batch_size=128, seed=seed, num_episodes=dqn_episodes)).train(callbacks=(callback,))
+
+        d = _time_to_target(dqn_run, dqn_target, seeds)
+        results[f"dqn_time_to_{dqn_target:g}"] = _metric(d["seconds"], "s", False)
+        results["dqn_target_misses"] = _metric(d["misses"], "runs", False)
+    return results
+
+
+def run_suite(quick : bool = False, seeds : tuple = (0, 1, 2), learning : bool = True) -> dict:
+    """
+    Runs every benchmark and returns {"meta": ..., "metrics": ...}.
+    quick shrinks the iteration counts for a smoke run, the numbers are then noisier.
+    """
+    import torch
+
+    from .importtime import measure_import_time
+
+    torch.set_num_threads(1)
+    scale = 10 if quick else 1
+    repeats = 3
+
+    metrics = {}
+    imported = measure_import_time(repeats=3)
+    metrics["import_rl_dqn"] = _metric(imported["import_ms"], "ms", False)
+    metrics.update(bench_env_single(20000 // scale, repeats, seeds[0]))
+    for num_envs in (64, 1024):
+        metrics.update(bench_env_vector(200000 // scale, repeats, seeds[0], num_envs))
+    metrics.update(bench_replay(10000 // scale, repeats, seeds[0]))
+    metrics.update(bench_optimize(300 // scale, repeats, seeds[0], (32, 128, 512)))
+    if learning:
+        metrics.update(bench_learning(seeds, dqn_target=100, dqn_episodes=0 if quick else 600,
+                                      q_target=195, q_episodes=5000))
+
+    meta = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "quick": quick,
+        "seeds": list(seeds),
+    }
+    return {"meta": meta, "metrics": metrics}
+
+
+def compare(result : dict, baseline : dict, tolerance : float = 0.2) -> list:
+    """
+    Metrics that got worse than the baseline by more than tolerance (a fraction), as
+    (name, baseline value, new value, relative change) with the change signed so that negative is worse.
+    A baseline of 0, like the target misses, has no relative change: the difference itself is compared
+    with tolerance, and the change is None.
+    """
+    regressions = []
+    for name, new in result["metrics"].items():
+        old = baseline["metrics"].get(name)
+        if old is None:
+            continue
+        if old["value"]:
+            change = (new["value"] - old["value"]) / abs(old["value"])
+        else:
+            change = new["value"] - old["value"]
+        if not new["higher_is_better"]:
+            change = -change
+        if change < -tolerance:
+            regressions.append((name, old["value"], new["value"], change if old["value"] else None))
+    return regressions
+
+
+def format_result(result : dict, baseline : dict = None) -> str:
+    lines = []
+    for name, m in result["metrics"].items():
+        line = f"{name:<32}{m['value']:>14.2f} {m['unit']}"
+        if baseline is not None and name in baseline["metrics"] and baseline["metrics"][name]["value"]:
+            old = baseline["metrics"][name]["value"]
+            line += f"   (baseline {old:.2f}, {(m['value'] - old) / abs(old):+.1%})"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main(output : str, baseline_path : str, tolerance : float, quick : bool, seeds : tuple,
+         learning : bool, save_baseline : bool) -> int:
+    """
+    Runs the suite, writes the JSON result and compares it with the baseline.
+    Without a baseline file the result becomes the baseline. Returns 1 if something regressed.
+    """
+    baseline = None
+    if os.path.exists(baseline_path) and not save_baseline:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        # The quick suite runs far fewer iterations, its numbers are not comparable with a full run
+        if baseline["meta"].get("quick", False) != quick:
+            raise ValueError(f"{baseline_path} is a {'quick' if baseline['meta'].get('quick') else 'full'} run, "
+                             f"compare it with a {'quick' if baseline['meta'].get('quick') else 'full'} run "
+                             "or save a new baseline")
+
+    result = run_suite(quick=quick, seeds=seeds, learning=learning)
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+
+    print(format_result(result, baseline))
+    print(f"Results written to {output}")
+
+    if baseline is None:
+        with open(baseline_path, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Saved as the new baseline {baseline_path}")
+        return 0
+
+    regressions = compare(result, baseline, tolerance)
+    for name, old, new, change in regressions:
+        print(f"REGRESSION {name}: {old:.2f} -> {new:.2f}" + (f" ({change:+.1%})" if change is not None else ""))
+    return 1 if regressions else 0
@@ -0,0 +1,73 @@
+import os
+import random
+from dataclasses import asdict
+
+import numpy as np
+import torch
+
+CHECKPOINT = "checkpoint.pt"
+
+
+def save_checkpoint(trainer, directory : str):
+    """
+    Saves everything needed to continue a run: both networks, the optimizer state, steps_done,
+    the episode durations and the random generator states.
+    A memory-mapped replay buffer is flushed and only its position is stored, its data stays in place.
+    The file is written next to the old one and renamed over it, so an interruption never leaves half a checkpoint.
+    """
+    os.makedirs(directory, exist_ok=True)
+    memory = trainer.memory
+    if hasattr(memory, "flush"):
+        memory.flush()
+
+    state = {
+        "config": asdict(trainer.config),
+        "policy_net": trainer.policy_net.state_dict(),
+        "target_net": trainer.target_net.state_dict(),
+        "optimizer": trainer.optimizer.state_dict(),
+        "steps_done": trainer.steps_done,
+        "episode_durations": trainer.episode_durations,
+        "replay": memory.state_dict() if hasattr(memory, "state_dict") else None,
+        "random": random.getstate(),
+        "numpy_random": np.random.get_state(),
+        "torch_random": torch.get_rng_state(),
+    }
+    path = os.path.join(directory, CHECKPOINT)
+    torch.save(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def load_checkpoint(trainer, directory : str) -> bool:
+    """
+    Restores a trainer from a checkpoint directory, returns False if there is no checkpoint yet.
+    """
+    path = os.path.join(directory, CHECKPOINT)
+    if not os.path.exists(path):
+        return False
+
+    state = torch.load(path, map_location=trainer.device, weights_only=False)
+    trainer.policy_net.load_state_dict(state["policy_net"])
+    trainer.target_net.load_state_dict(state["target_net"])
+    trainer.optimizer.load_state_dict(state["optimizer"])
+    trainer.steps_done = state["steps_done"]
+    trainer.episode_durations = list(state["episode_durations"])
+    if state["replay"] is not None and hasattr(trainer.memory, "load_state_dict"):
+        trainer.memory.load_state_dict(state["replay"])
+    random.setstate(state["random"])
+    np.random.set_state(state["numpy_random"])
+    torch.set_rng_state(state["torch_random"])
+    return True
+
+
+class Checkpointer:
+    """
+    Trainer.train callback that saves a checkpoint every `every` episodes.
+    """
+
+    def __init__(self, directory : str, every : int = 50):
+        self.directory = directory
+        self.every = every
+
+    def __call__(self, trainer, i_episode, duration):
+        if self.every and (i_episode + 1) % self.every == 0:
+            save_checkpoint(trainer, self.directory)
@@ -0,0 +1,135 @@
+import argparse
+import json
+
+from .config import QLearningConfig, TrainConfig, config_fields
+
+
+def add_config_options(parser : argparse.ArgumentParser, config_cls=TrainConfig):
+    """
+    Adds one --option per config field, so new fields show up on the command line automatically.
+    """
+    for name, field_type, default in config_fields(config_cls):
+        option = "--" + name.replace("_", "-")
+        if field_type is bool:
+            parser.add_argument(option, dest=name, action=argparse.BooleanOptionalAction, default=default)
+        else:
+            parser.add_argument(option, dest=name, type=field_type, default=default,
+                                help=f"(default: {default})")
+
+
+def config_from_args(args, config_cls=TrainConfig):
+    return config_cls(**{name: getattr(args, name) for name, _, _ in config_fields(config_cls)})
+
+
+def _cmd_train(args):
+    # Imported here so that "import-time" and "--help" do not load torch
+    from .dqn import train
+
+    durations = train(config_from_args(args))
+    print('Complete')
+    print(f"Episodes: {len(durations)}, last 100 mean duration: "
+          f"{sum(durations[-100:]) / max(len(durations[-100:]), 1):.1f}")
+
+
+def _cmd_qlearn(args):
+    from .tabular import train_qlearning
+
+    durations = train_qlearning(config_from_args(args, QLearningConfig))
+    print('Complete')
+    print(f"Episodes: {len(durations)}, last 100 mean duration: "
+          f"{sum(durations[-100:]) / max(len(durations[-100:]), 1):.1f}")
+
+
+def _cmd_import_time(args):
+    from .importtime import measure_import_time
+
+    print(json.dumps(measure_import_time(args.module, args.repeats), indent=2))
+
+
+def _cmd_plot(args):
+    from .plotting import plot_log
+
+    plot_log(args.path, args.output)
+
+
+def _cmd_sweep(args):
+    from .sweep import run_sweep
+
+    ranking = run_sweep(args.space, mode=args.mode, samples=args.samples, sample_seed=args.sample_seed,
+                        trainer=args.trainer, seeds=args.seeds, min_episodes=args.min_episodes,
+                        max_episodes=args.max_episodes, eta=args.eta, workers=args.workers,
+                        results_path=args.results)
+    print("Best configurations:")
+    for r in ranking:
+        print(f"  {r['score']:8.1f}  {r['params']}")
+
+
+def _cmd_bench(args):
+    import sys
+
+    from .bench import main as bench_main
+
+    try:
+        status = bench_main(args.output, args.baseline, args.tolerance, args.quick, tuple(args.seeds),
+                            not args.no_learning, args.save_baseline)
+    except ValueError as e:
+        # A baseline that cannot be compared with this run, e.g. a quick run against a full one
+        sys.exit(f"rl bench: error: {e}")
+    sys.exit(status)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m rl", description="CartPole DQN training")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = commands.add_parser("train", help="train a DQN agent")
+    add_config_options(train_parser)
+    train_parser.set_defaults(func=_cmd_train)
+
+    qlearn_parser = commands.add_parser("qlearn", help="train the tabular Q-learning baseline")
+    add_config_options(qlearn_parser, QLearningConfig)
+    qlearn_parser.set_defaults(func=_cmd_qlearn)
+
+    import_parser = commands.add_parser("import-time", help="measure the cost of importing the trainer")
+    import_parser.add_argument("--module", default="rl.dqn")
+    import_parser.add_argument("--repeats", type=int, default=5)
+    import_parser.set_defaults(func=_cmd_import_time)
+
+    plot_parser = commands.add_parser("plot", help="plot a metrics log written during training")
+    plot_parser.add_argument("path")
+    plot_parser.add_argument("--output", default=None, help="save the figure instead of showing it")
+    plot_parser.set_defaults(func=_cmd_plot)
+
+    sweep_parser = commands.add_parser("sweep", help="parallel hyperparameter sweep with successive halving")
+    sweep_parser.add_argument("space", help="JSON search space file")
+    sweep_parser.add_argument("--mode", choices=("grid", "random"), default="grid")
+    sweep_parser.add_argument("--samples", type=int, default=20, help="configurations to draw in random mode")
+    sweep_parser.add_argument("--sample-seed", type=int, default=0)
+    sweep_parser.add_argument("--trainer", default="dqn")
+    sweep_parser.add_argument("--seeds", type=int, nargs="+", default=[0])
+    sweep_parser.add_argument("--min-episodes", type=int, default=200)
+    sweep_parser.add_argument("--max-episodes", type=int, default=600)
+    sweep_parser.add_argument("--eta", type=int, default=3)
+    sweep_parser.add_argument("--workers", type=int, default=None, help="(default: one per core)")
+    sweep_parser.add_argument("--results", default="sweep.jsonl",
+                              help="results file, an existing one is resumed")
+    sweep_parser.set_defaults(func=_cmd_sweep)
+
+    bench_parser = commands.add_parser("bench", help="throughput and learning speed benchmarks")
+    bench_parser.add_argument("--output", default="bench_result.json")
+    bench_parser.add_argument("--baseline", default="bench_baseline.json",
+                              help="compared against if it exists, otherwise created from this run")
+    bench_parser.add_argument("--save-baseline", action="store_true", help="replace the baseline with this run")
+    bench_parser.add_argument("--tolerance", type=float, default=0.2,
+                              help="allowed relative slowdown before a metric counts as a regression")
+    bench_parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2])
+    bench_parser.add_argument("--quick", action="store_true", help="fewer iterations and no DQN learning run")
+    bench_parser.add_argument("--no-learning", action="store_true", help="skip the time-to-target runs")
+    bench_parser.set_defaults(func=_cmd_bench)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
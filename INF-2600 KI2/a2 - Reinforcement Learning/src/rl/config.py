@@ -0,0 +1,127 @@
+from dataclasses import dataclass, field, fields, replace
+from typing import Optional
+
+
+@dataclass
+class TrainConfig:
+    """
+    Hyperparameters and run settings for a DQN training run.
+    The defaults are the values the task_2.py script used as module constants.
+    """
+
+    # batch_size is the number of transitions sampled from the replay buffer
+    # gamma is the discount factor
+    # eps_start is the starting value of epsilon
+    # eps_end is the final value of epsilon
+    # eps_decay controls the rate of exponential decay of epsilon, higher means a slower decay
+    # tau is the update rate of the target network
+    # lr is the learning rate of the ``AdamW`` optimizer
+    batch_size: int = 1
+    gamma: float = 0.99
+    eps_start: float = 0.9
+    eps_end: float = 0.05
+    eps_decay: float = 1000
+    tau: float = 0.005
+    lr: float = 1e-4
+    # The original task_2.py had its optimize_model() call commented out, so the policy network never learned.
+    # The trainer optimises every step, --no-optimize runs it the way the script did
+    optimize: bool = True
+    memory_capacity: int = 10000
+    # "memory" keeps transitions in RAM, "memmap" in column files under replay_dir
+    # (default <checkpoint_dir>/replay), which allows capacities far beyond RAM
+    replay: str = "memory"
+    replay_dir: Optional[str] = field(default=None, metadata={"type": str})
+
+    # None means 600 episodes on GPU and 400 on CPU, as in the original script
+    num_episodes: Optional[int] = field(default=None, metadata={"type": int})
+    seed: Optional[int] = field(default=None, metadata={"type": int})
+    # "CartPole2D" is the environment from pre_task_2.py, anything else is a gymnasium id
+    env: str = "CartPole2D"
+    # None picks cuda when available
+    device: Optional[str] = field(default=None, metadata={"type": str})
+    # Show the duration plot when training is done
+    plot: bool = False
+    # CSV file every episode is appended to, plot it afterwards with "python -m rl plot"
+    metrics_path: Optional[str] = field(default=None, metadata={"type": str})
+    # Print rolling statistics every log_every episodes, 0 disables it
+    log_every: int = 0
+
+    # Time every phase of the training step and report every profile_every episodes
+    profile: bool = False
+    profile_every: int = 50
+    # JSON lines file the profile reports are appended to, None prints them
+    profile_path: Optional[str] = field(default=None, metadata={"type": str})
+    # "cprofile" or "torch" captures a trace of trace_episodes episodes starting at trace_start
+    trace: Optional[str] = field(default=None, metadata={"type": str})
+    trace_start: int = 0
+    trace_episodes: int = 5
+    trace_path: str = "trace"
+
+    # Save networks, optimizer, steps_done and the replay position every checkpoint_every episodes,
+    # and continue from the last checkpoint in checkpoint_dir when resume is set
+    checkpoint_dir: Optional[str] = field(default=None, metadata={"type": str})
+    checkpoint_every: int = 50
+    resume: bool = False
+
+    def resolved_episodes(self, device) -> int:
+        """
+        Number of episodes to run on the given torch device.
+        """
+        if self.num_episodes is not None:
+            return self.num_episodes
+        return 600 if device.type == "cuda" else 400
+
+    def updated(self, **changes) -> "TrainConfig":
+        """
+        Copy of the config with some fields replaced.
+        """
+        return replace(self, **changes)
+
+
+@dataclass
+class QLearningConfig:
+    """
+    Settings for the tabular Q-learning engine (rl.tabular), used by task_3.py.
+    """
+
+    # learning_rate and discount_factor are the Bellman update parameters,
+    # eps_* is the same exponential epsilon schedule as the DQN, counted in environment steps
+    learning_rate: float = 0.1
+    discount_factor: float = 0.99
+    eps_start: float = 0.9
+    eps_end: float = 0.05
+    eps_decay: float = 5000
+
+    # "CartPole-v1" (4 observations, 2 actions) or "CartPole2D" (8 observations, 4 actions)
+    env: str = "CartPole-v1"
+    # Number of environments stepped and updated as one batch
+    num_envs: int = 64
+    num_episodes: int = 3000
+    seed: Optional[int] = field(default=None, metadata={"type": int})
+
+    # Bins per observation dimension as "3,3,6,6", a single number is used for every dimension.
+    # None uses the defaults of the environment, see rl.tabular.DEFAULT_BINS
+    bins: Optional[str] = field(default=None, metadata={"type": str})
+    # 1 is plain binning, more than 1 overlays that many offset tilings (tile coding)
+    tilings: int = 4
+    # "dense" numpy table or "sparse" hash table that only stores visited states
+    table: str = "dense"
+
+    metrics_path: Optional[str] = field(default=None, metadata={"type": str})
+    log_every: int = 0
+
+    def updated(self, **changes) -> "QLearningConfig":
+        """
+        Copy of the config with some fields replaced.
+        """
+        return replace(self, **changes)
+
+
+def config_fields(config_cls=TrainConfig):
+    """
+    Yields (name, type, default) for every field of a config dataclass.
+    Used by the command line runner to build its options.
+    """
+    for f in fields(config_cls):
+        field_type = f.metadata.get("type", type(f.default))
+        yield f.name, field_type, f.default
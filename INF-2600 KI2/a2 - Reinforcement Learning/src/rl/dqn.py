@@ -0,0 +1,333 @@
+import math
+import os
+import random
+import warnings
+from collections import namedtuple, deque
+from itertools import count
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import torch.nn.functional as F
+
+from .config import TrainConfig
+from .envs import make_env
+from .metrics import MetricsSink, score
+from .profiling import PhaseTimer, TraceWindow
+
+
+Transition = namedtuple('Transition',
+                        ('state', 'action', 'next_state', 'reward'))
+
+class ReplayMemory(object):
+
+    def __init__(self, capacity):
+        self.memory = deque([], maxlen=capacity)
+
+    def push(self, *args):
+        """Save a transition"""
+        self.memory.append(Transition(*args))
+
+    def sample(self, batch_size):
+        return random.sample(self.memory, batch_size)
+
+    def __len__(self):
+        return len(self.memory)
+
+    def filo(self):
+        return self.memory[-1]
+
+    def sample_batch(self, batch_size, device):
+        """
+        Random batch as (states, actions, rewards, non-final mask, non-final next states).
+        """
+        transitions = self.sample(batch_size)
+        # Transpose the batch (see https://stackoverflow.com/a/19343/3343043 for
+        # detailed explanation). This converts batch-array of Transitions
+        # to Transition of batch-arrays.
+        batch = Transition(*zip(*transitions))
+
+        # Compute a mask of non-final states and concatenate the batch elements
+        # (a final state would've been the one after which simulation ended)
+        non_final_mask = torch.tensor(tuple(map(lambda s: s is not None,
+                                              batch.next_state)), device=device, dtype=torch.bool)
+        non_final_next_states = None
+        if non_final_mask.any():
+            non_final_next_states = torch.cat([s for s in batch.next_state
+                                                        if s is not None])
+        state_batch = torch.cat(batch.state)
+        action_batch = torch.cat(batch.action)
+        reward_batch = torch.cat(batch.reward)
+        return state_batch, action_batch, reward_batch, non_final_mask, non_final_next_states
+
+class DQN(nn.Module):
+
+    def __init__(self, n_observations, n_actions):
+        super(DQN, self).__init__()
+        self.layer1 = nn.Linear(n_observations, 128)
+        self.layer2 = nn.Linear(128, 128)
+        self.layer3 = nn.Linear(128, n_actions)
+
+    # Called with either one element to determine next action, or a batch
+    # during optimization. Returns tensor([[left0exp,right0exp]...]).
+    def forward(self, x):
+        x = F.relu(self.layer1(x))
+        x = F.relu(self.layer2(x))
+        return self.layer3(x)
+
+
+def resolve_device(name=None) -> torch.device:
+    """
+    The torch device to train on, cuda if available unless a device is given.
+    """
+    if name is not None:
+        return torch.device(name)
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def seed_everything(seed : int):
+    """
+    Seeds the python, numpy and torch generators.
+    """
+    import numpy as np
+
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+class Trainer:
+    """
+    Holds the state of one DQN training run: environment, networks, optimizer, replay memory and step count.
+    Nothing is created at import time, a run only starts when train() is called.
+    """
+
+    def __init__(self, config : TrainConfig = None, env=None):
+        self.config = config or TrainConfig()
+        self.device = resolve_device(self.config.device)
+
+        if self.config.seed is not None:
+            seed_everything(self.config.seed)
+
+        self.env = env if env is not None else make_env(self.config.env)
+
+        # Get number of actions from gym action space
+        self.n_actions = self.env.action_space.n
+        # Get the number of state observations
+        state, info = self.env.reset(seed=self.config.seed)
+        self.n_observations = len(state)
+        if self.config.seed is not None:
+            self.env.action_space.seed(self.config.seed)
+
+        self.policy_net = DQN(self.n_observations, self.n_actions).to(self.device)
+        self.target_net = DQN(self.n_observations, self.n_actions).to(self.device)
+        self.target_net.load_state_dict(self.policy_net.state_dict())
+
+        self.optimizer = optim.AdamW(self.policy_net.parameters(), lr=self.config.lr, amsgrad=True)
+        self.memory = self._make_memory()
+        self.criterion = nn.SmoothL1Loss()
+
+        self.steps_done = 0
+        self.episode_durations = []
+
+        # Both stay None unless asked for, the hot path only checks them for truth
+        self.profiler = None
+        if self.config.profile:
+            self.profiler = PhaseTimer(self.config.profile_every, self.config.profile_path)
+        self.trace = None
+        if self.config.trace:
+            self.trace = TraceWindow(self.config.trace, self.config.trace_start,
+                                     self.config.trace_episodes, self.config.trace_path)
+
+    def _make_memory(self):
+        config = self.config
+        if config.replay == "memory":
+            return ReplayMemory(config.memory_capacity)
+        if config.replay == "memmap":
+            from .replay_store import MemmapReplay
+
+            from .checkpoint import CHECKPOINT
+
+            directory = config.replay_dir or os.path.join(config.checkpoint_dir or ".", "replay")
+            # Without a checkpoint there is nothing to resume, a buffer left in the directory is stale
+            resume = config.resume and config.checkpoint_dir is not None \
+                and os.path.exists(os.path.join(config.checkpoint_dir, CHECKPOINT))
+            return MemmapReplay(directory, config.memory_capacity, self.n_observations,
+                                device=self.device, seed=config.seed, resume=resume)
+        raise ValueError(f"Unknown replay type {config.replay!r}, expected 'memory' or 'memmap'")
+
+    def select_action(self, state):
+        config = self.config
+        sample = random.random()
+        eps_threshold = config.eps_end + (config.eps_start - config.eps_end) * \
+            math.exp(-1. * self.steps_done / config.eps_decay)
+        self.steps_done += 1
+        if sample > eps_threshold:
+            with torch.no_grad():
+                # t.max(1) will return the largest column value of each row.
+                # second column on max result is index of where max element was
+                # found, so we pick action with the larger expected reward.
+                return self.policy_net(state).max(1).indices.view(1, 1)
+        else:
+            return torch.tensor([[self.env.action_space.sample()]], device=self.device, dtype=torch.long)
+
+    def optimize_model(self):
+        prof = self.profiler
+        batch_size = self.config.batch_size
+        if len(self.memory) < batch_size:
+            if prof: prof.lap("replay_sample")
+            return
+        state_batch, action_batch, reward_batch, non_final_mask, non_final_next_states = \
+            self.memory.sample_batch(batch_size, self.device)
+        if prof: prof.lap("replay_sample")
+
+        # Compute Q(s_t, a) - the model computes Q(s_t), then we select the
+        # columns of actions taken. These are the actions which would've been taken
+        # for each batch state according to policy_net
+        state_action_values = self.policy_net(state_batch).gather(1, action_batch)
+
+        # Compute V(s_{t+1}) for all next states.
+        # Expected values of actions for non_final_next_states are computed based
+        # on the "older" target_net; selecting their best reward with max(1).values
+        # This is merged based on the mask, such that we'll have either the expected
+        # state value or 0 in case the state was final.
+        next_state_values = torch.zeros(batch_size, device=self.device)
+        if non_final_next_states is not None:
+            with torch.no_grad():
+                next_state_values[non_final_mask] = self.target_net(non_final_next_states).max(1).values
+        # Compute the expected Q values
+        expected_state_action_values = (next_state_values * self.config.gamma) + reward_batch
+
+        # Compute Huber loss
+        loss = self.criterion(state_action_values, expected_state_action_values.unsqueeze(1))
+        if prof: prof.lap("forward")
+
+        # Optimize the model
+        self.optimizer.zero_grad()
+        loss.backward()
+        # In-place gradient clipping
+        torch.nn.utils.clip_grad_value_(self.policy_net.parameters(), 100)
+        self.optimizer.step()
+        if prof: prof.lap("backward")
+
+    def soft_update(self):
+        """
+        Soft update of the target network's weights
+        θ′ ← τ θ + (1 −τ )θ′
+        Done in place on the parameters instead of rebuilding and reloading the state dicts every step.
+        """
+        with torch.no_grad():
+            for target_param, policy_param in zip(self.target_net.parameters(), self.policy_net.parameters()):
+                target_param.lerp_(policy_param, self.config.tau)
+
+    def run_episode(self) -> int:
+        """
+        Plays one episode while learning, returns its duration.
+        """
+        device = self.device
+        prof = self.profiler
+        # Initialize the environment and get its state
+        state, info = self.env.reset()
+        state = torch.tensor(state, dtype=torch.float32, device=device).unsqueeze(0)
+        for t in count():
+            if prof: prof.tick()
+            action = self.select_action(state)
+            if prof: prof.lap("select_action")
+            observation, reward, terminated, truncated, _ = self.env.step(action.item())
+            if prof: prof.lap("env_step")
+            reward = torch.tensor([reward], device=device)
+            done = terminated or truncated
+
+            if terminated:
+                next_state = None
+            else:
+                next_state = torch.tensor(observation, dtype=torch.float32, device=device).unsqueeze(0)
+
+            # Store the transition in memory
+            self.memory.push(state, action, next_state, reward)
+            if prof: prof.lap("memory_push")
+
+            # Move to the next state
+            state = next_state
+
+            # Perform one step of the optimization (on the policy network)
+            if self.config.optimize:
+                self.optimize_model()
+
+            self.soft_update()
+            if prof: prof.lap("target_update")
+
+            if done:
+                return t + 1
+
+    def train(self, num_episodes : int = None, callbacks=()) -> list:
+        """
+        Runs the training loop until num_episodes episodes in total have been played
+        (a resumed trainer continues where it stopped) and returns the episode durations.
+        Each callback is called as callback(trainer, i_episode, duration) after every episode,
+        and training stops early if one of them returns True.
+        """
+        if num_episodes is None:
+            num_episodes = self.config.resolved_episodes(self.device)
+
+        trace = self.trace
+        for i_episode in range(len(self.episode_durations), num_episodes):
+            if trace: trace.episode_start(i_episode)
+            duration = self.run_episode()
+            self.episode_durations.append(duration)
+            if trace: trace.episode_end(i_episode)
+            if self.profiler: self.profiler(self, i_episode, duration)
+
+            stop = False
+            for callback in callbacks:
+                stop = bool(callback(self, i_episode, duration)) or stop
+            if stop:
+                break
+
+        if trace:
+            trace.finish()
+        if self.profiler and self.profiler.phases:
+            self.profiler.dump(len(self.episode_durations) - 1)
+        return self.episode_durations
+
+
+def train(config : TrainConfig = None, callbacks=()) -> list:
+    """
+    Entry point for a training run, returns the episode durations.
+    """
+    config = config or TrainConfig()
+    trainer = Trainer(config)
+
+    resumed = False
+    if config.checkpoint_dir is not None:
+        from .checkpoint import Checkpointer, load_checkpoint, save_checkpoint
+
+        if not hasattr(trainer.memory, "state_dict"):
+            warnings.warn(f"The {config.replay!r} replay memory is not saved in checkpoints, a resumed run "
+                          "starts with an empty one; use --replay memmap to keep it", stacklevel=2)
+        resumed = config.resume and load_checkpoint(trainer, config.checkpoint_dir)
+        if resumed:
+            print(f"Resuming from episode {len(trainer.episode_durations)}, "
+                  f"{len(trainer.memory)} transitions in the replay memory")
+        callbacks = (Checkpointer(config.checkpoint_dir, config.checkpoint_every), *callbacks)
+
+    # A resumed run adds its episodes to the log of the run it continues
+    with MetricsSink(config.metrics_path, log_every=config.log_every, append=resumed) as metrics:
+        durations = trainer.train(callbacks=(metrics, *callbacks))
+
+    if config.checkpoint_dir is not None:
+        save_checkpoint(trainer, config.checkpoint_dir)
+
+    if config.plot:
+        from .plotting import show_result
+        show_result(durations)
+
+    return durations
+
+
+def run_trial(params : dict, seed : int, episodes : int) -> float:
+    """
+    Sweep entry point, see rl.sweep.
+    """
+    config = TrainConfig(**params).updated(seed=seed, num_episodes=episodes)
+    return score(Trainer(config).train())
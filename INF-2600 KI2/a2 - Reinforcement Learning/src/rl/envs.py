@@ -0,0 +1,23 @@
+import os
+import sys
+
+# pre_task_2.py lives next to the rl package
+_SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CARTPOLE_2D = "CartPole2D"
+
+
+def make_env(name : str = CARTPOLE_2D, render_mode=None):
+    """
+    Creates an environment by name.
+    "CartPole2D" is the 2D cart-pole from pre_task_2.py, any other name is passed to gymnasium.
+    The environment modules are imported here so that importing the trainer stays cheap.
+    """
+    if name == CARTPOLE_2D:
+        if _SRC_DIR not in sys.path:
+            sys.path.append(_SRC_DIR)
+        from pre_task_2 import CartPole2DEnv
+        return CartPole2DEnv(render_mode=render_mode)
+
+    import gymnasium as gym
+    return gym.make(name, render_mode=render_mode)
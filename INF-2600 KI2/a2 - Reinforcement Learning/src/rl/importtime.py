@@ -0,0 +1,50 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules that must never be loaded just by importing the trainer
+HEAVY_MODULES = ("matplotlib", "IPython", "gym", "gymnasium", "pygame")
+
+_SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_PROBE = (
+    "import sys, json\n"
+    "import {module}\n"
+    "print(json.dumps([m for m in {heavy!r} if m in sys.modules]))\n"
+)
+
+
+def _run(code : str) -> tuple:
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", code], cwd=_SRC_DIR,
+                         capture_output=True, text=True, check=True).stdout
+    return time.perf_counter() - start, out
+
+
+def measure_import_time(module : str = "rl.dqn", repeats : int = 5) -> dict:
+    """
+    Measures the wall clock time of a no-op import of the given module in a fresh interpreter.
+    The interpreter start up time is measured separately and subtracted.
+    Also reports which of the heavy modules the import pulled in, which should be none.
+    """
+    baseline = [_run("pass")[0] for _ in range(repeats)]
+
+    samples = []
+    loaded = []
+    for _ in range(repeats):
+        elapsed, out = _run(_PROBE.format(module=module, heavy=HEAVY_MODULES))
+        samples.append(elapsed)
+        loaded = json.loads(out)
+
+    interpreter_ms = statistics.median(baseline) * 1000
+    total_ms = statistics.median(samples) * 1000
+    return {
+        "module": module,
+        "repeats": repeats,
+        "interpreter_ms": round(interpreter_ms, 2),
+        "import_ms": round(max(total_ms - interpreter_ms, 0.0), 2),
+        "heavy_modules_loaded": loaded,
+    }
@@ -0,0 +1,155 @@
+import csv
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class RollingWindow:
+    """
+    Fixed size ring buffer over the most recent values.
+    push() and mean() are O(1), percentile() is O(window), so none of them grow with the length of the run.
+    """
+
+    def __init__(self, size : int = 100):
+        self.size = size
+        self.values = np.zeros(size, dtype=np.float64)
+        self.count = 0
+        self.total = 0.0
+
+    def push(self, value : float):
+        index = self.count % self.size
+        if self.count >= self.size:
+            self.total -= self.values[index]
+        self.values[index] = value
+        self.total += value
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def full(self) -> bool:
+        return self.count >= self.size
+
+    def mean(self) -> float:
+        n = len(self)
+        return self.total / n if n else 0.0
+
+    def percentile(self, q):
+        n = len(self)
+        if not n:
+            return 0.0
+        return np.percentile(self.values[:n], q)
+
+
+class MetricsSink:
+    """
+    Collects per-episode training metrics without slowing the training loop down.
+
+    Rolling statistics over the last `window` episodes are kept in memory.
+    When a path is given every episode is also appended as a CSV row by a background thread,
+    so the training loop only puts a tuple on a queue. Plotting reads that file afterwards (python -m rl plot).
+    With append set the rows are added to an existing file, otherwise the file is started anew.
+    """
+
+    COLUMNS = ("episode", "duration", "rolling_mean", "elapsed_s")
+
+    def __init__(self, path : str = None, window : int = 100, log_every : int = 0, append : bool = False):
+        self.window = RollingWindow(window)
+        self.log_every = log_every
+        self.episodes = 0
+        self.start = time.perf_counter()
+
+        self._queue = None
+        self._writer = None
+        if path is not None:
+            self._queue = queue.SimpleQueue()
+            self._writer = threading.Thread(target=self._write_rows, args=(path, append), daemon=True)
+            self._writer.start()
+
+    def record(self, episode : int, duration : float):
+        """
+        Records the duration of an episode.
+        """
+        self.window.push(duration)
+        self.episodes += 1
+        if self._queue is not None:
+            self._queue.put((episode, duration, self.window.mean(), time.perf_counter() - self.start))
+        if self.log_every and self.episodes % self.log_every == 0:
+            print(self.format_summary())
+
+    def __call__(self, trainer, i_episode, duration):
+        # Lets the sink be passed directly as a Trainer.train callback
+        self.record(i_episode, duration)
+
+    def summary(self) -> dict:
+        p50, p90 = self.window.percentile([50, 90]) if len(self.window) else (0.0, 0.0)
+        elapsed = time.perf_counter() - self.start
+        return {
+            "episodes": self.episodes,
+            "mean": self.window.mean(),
+            "p50": float(p50),
+            "p90": float(p90),
+            "episodes_per_s": self.episodes / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def format_summary(self) -> str:
+        s = self.summary()
+        return (f"Episode {s['episodes']}: mean {s['mean']:.1f}, p50 {s['p50']:.0f}, "
+                f"p90 {s['p90']:.0f} over the last {len(self.window)} episodes "
+                f"({s['episodes_per_s']:.1f} episodes/s)")
+
+    def _write_rows(self, path : str, append : bool):
+        # The header is only written to an empty file
+        header = not (append and os.path.exists(path) and os.path.getsize(path) > 0)
+        with open(path, "a" if append else "w", newline="") as f:
+            writer = csv.writer(f)
+            if header:
+                writer.writerow(self.COLUMNS)
+            while True:
+                row = self._queue.get()
+                rows = [row]
+                # Drain whatever else is waiting so a burst of episodes is one write
+                while True:
+                    try:
+                        rows.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                done = rows[-1] is None
+                writer.writerows(r for r in rows if r is not None)
+                if done:
+                    return
+                f.flush()
+
+    def close(self):
+        """
+        Flushes the log file and stops the writer thread.
+        """
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def score(durations : list) -> float:
+    """
+    Mean duration of the last 100 episodes, the number the sweep ranks runs by.
+    """
+    last = durations[-100:]
+    return sum(last) / len(last) if last else 0.0
+
+
+def read_log(path : str) -> dict:
+    """
+    Reads a metrics log written by MetricsSink into one numpy array per column.
+    """
+    data = np.genfromtxt(path, delimiter=",", names=True, ndmin=1)
+    return {name: data[name] for name in data.dtype.names}
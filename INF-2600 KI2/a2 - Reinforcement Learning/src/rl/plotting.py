@@ -0,0 +1,66 @@
+def plot_durations(episode_durations : list, show_result : bool = False):
+    """
+    Plots the episode durations together with the 100 episode average.
+    matplotlib and IPython are imported on first use, so training code that never plots does not load them.
+    """
+    import matplotlib
+    import matplotlib.pyplot as plt
+    import numpy as np
+
+    is_ipython = 'inline' in matplotlib.get_backend()
+
+    plt.figure(1)
+    durations = np.asarray(episode_durations, dtype=np.float32)
+    if show_result:
+        plt.title('Result')
+    else:
+        plt.clf()
+        plt.title('Training...')
+    plt.xlabel('Episode')
+    plt.ylabel('Duration')
+    plt.plot(durations)
+    # Take 100 episode averages and plot them too
+    if len(durations) >= 100:
+        means = np.convolve(durations, np.ones(100) / 100, mode='valid')
+        means = np.concatenate((np.zeros(99), means))
+        plt.plot(means)
+
+    plt.pause(0.001)  # pause a bit so that plots are updated
+    if is_ipython:
+        from IPython import display
+        display.display(plt.gcf())
+        if not show_result:
+            display.clear_output(wait=True)
+
+
+def show_result(episode_durations : list):
+    """
+    Draws the final plot and blocks until the window is closed.
+    """
+    import matplotlib.pyplot as plt
+
+    plot_durations(episode_durations, show_result=True)
+    plt.ioff()
+    plt.show()
+
+
+def plot_log(path : str, output : str = None):
+    """
+    Offline plot of a metrics log written during training (see rl.metrics.MetricsSink).
+    Saves the figure when an output path is given, otherwise shows it.
+    """
+    import matplotlib.pyplot as plt
+
+    from .metrics import read_log
+
+    log = read_log(path)
+    plt.figure(1)
+    plt.title('Result')
+    plt.xlabel('Episode')
+    plt.ylabel('Duration')
+    plt.plot(log['episode'], log['duration'])
+    plt.plot(log['episode'], log['rolling_mean'])
+    if output is not None:
+        plt.savefig(output)
+    else:
+        plt.show()
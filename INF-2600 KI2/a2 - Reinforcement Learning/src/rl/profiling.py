@@ -0,0 +1,166 @@
+import json
+import time
+from time import perf_counter_ns
+
+# Histogram bucket b holds durations in [2^(b-1), 2^b) nanoseconds
+N_BUCKETS = 64
+
+
+class PhaseTimer:
+    """
+    Cheap per-phase timer for the training hot path.
+
+    The loop calls tick() once at the start of a step and lap(phase) after each phase,
+    so every phase costs one perf_counter_ns() call and a few integer operations.
+    Durations go into power-of-two histograms, which gives percentiles without storing samples.
+
+    Note that on CUDA the timings are of the kernel launches, not of the kernels themselves.
+    """
+
+    def __init__(self, report_every : int = 50, path : str = None):
+        self.report_every = report_every
+        self.path = path
+        self.phases = {}
+        self._mark = perf_counter_ns()
+        self._window_start = time.perf_counter()
+
+    def tick(self):
+        self._mark = perf_counter_ns()
+
+    def lap(self, phase : str):
+        now = perf_counter_ns()
+        ns = now - self._mark
+        self._mark = now
+
+        stats = self.phases.get(phase)
+        if stats is None:
+            stats = self.phases[phase] = [0, 0, 0, [0] * N_BUCKETS]
+        stats[0] += 1
+        stats[1] += ns
+        if ns > stats[2]:
+            stats[2] = ns
+        stats[3][ns.bit_length()] += 1
+
+    def reset(self):
+        self.phases = {}
+        self._window_start = time.perf_counter()
+
+    @staticmethod
+    def _percentile(buckets : list, count : int, q : float) -> int:
+        # Upper bound of the bucket the q-th sample falls in
+        target = q * count
+        seen = 0
+        for b, n in enumerate(buckets):
+            seen += n
+            if seen >= target:
+                return 1 << b
+        return 1 << (N_BUCKETS - 1)
+
+    def report(self) -> dict:
+        """
+        Aggregated statistics per phase since the last reset.
+        """
+        wall_ns = (time.perf_counter() - self._window_start) * 1e9
+        timed_ns = sum(stats[1] for stats in self.phases.values())
+        phases = {}
+        for phase, (count, total, longest, buckets) in self.phases.items():
+            phases[phase] = {
+                "count": count,
+                "total_ms": total / 1e6,
+                "share": total / timed_ns if timed_ns else 0.0,
+                "mean_us": total / count / 1e3,
+                "p50_us": self._percentile(buckets, count, 0.5) / 1e3,
+                "p99_us": self._percentile(buckets, count, 0.99) / 1e3,
+                "max_us": longest / 1e3,
+                "histogram": {1 << b: n for b, n in enumerate(buckets) if n},
+            }
+        return {
+            "wall_ms": wall_ns / 1e6,
+            "timed_ms": timed_ns / 1e6,
+            "phases": phases,
+        }
+
+    def format_report(self, report : dict = None) -> str:
+        report = report or self.report()
+        lines = [f"{'phase':<16}{'count':>9}{'total ms':>11}{'share':>8}{'mean us':>10}{'p50 us':>10}{'p99 us':>10}"]
+        phases = sorted(report["phases"].items(), key=lambda item: -item[1]["total_ms"])
+        for phase, s in phases:
+            lines.append(f"{phase:<16}{s['count']:>9}{s['total_ms']:>11.1f}{s['share']:>8.1%}"
+                         f"{s['mean_us']:>10.1f}{s['p50_us']:>10.1f}{s['p99_us']:>10.1f}")
+        lines.append(f"timed {report['timed_ms']:.1f} ms of {report['wall_ms']:.1f} ms wall time")
+        return "\n".join(lines)
+
+    def dump(self, episode : int):
+        """
+        Prints the report, or appends it as one JSON line to the dump file, and starts a new window.
+        """
+        report = self.report()
+        if self.path is None:
+            print(f"Profile after episode {episode}:")
+            print(self.format_report(report))
+        else:
+            report["episode"] = episode
+            with open(self.path, "a") as f:
+                f.write(json.dumps(report) + "\n")
+        self.reset()
+
+    def __call__(self, trainer, i_episode, duration):
+        # Used as a Trainer.train callback
+        if self.report_every and (i_episode + 1) % self.report_every == 0:
+            self.dump(i_episode)
+
+
+class TraceWindow:
+    """
+    Captures a cProfile or torch.profiler trace for a window of episodes.
+    kind is "cprofile" (written as <path>.prof, view with snakeviz or pstats)
+    or "torch" (written as <path>.json, open in chrome://tracing or Perfetto).
+    """
+
+    KINDS = ("cprofile", "torch")
+
+    def __init__(self, kind : str, start : int = 0, episodes : int = 5, path : str = "trace"):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown trace kind {kind!r}, expected one of {self.KINDS}")
+        self.kind = kind
+        self.start = start
+        self.stop = start + episodes
+        self.path = path
+        self._profiler = None
+        self.done = False
+
+    def episode_start(self, i_episode : int):
+        if i_episode == self.start and not self.done:
+            if self.kind == "cprofile":
+                import cProfile
+                self._profiler = cProfile.Profile()
+                self._profiler.enable()
+            else:
+                import torch
+                activities = [torch.profiler.ProfilerActivity.CPU]
+                if torch.cuda.is_available():
+                    activities.append(torch.profiler.ProfilerActivity.CUDA)
+                self._profiler = torch.profiler.profile(activities=activities)
+                self._profiler.__enter__()
+
+    def episode_end(self, i_episode : int):
+        if self._profiler is not None and i_episode + 1 >= self.stop:
+            self.finish()
+
+    def finish(self):
+        """
+        Stops the trace and writes it, also called when training ends inside the window.
+        """
+        if self._profiler is None:
+            return
+        if self.kind == "cprofile":
+            self._profiler.disable()
+            output = self.path + ".prof"
+            self._profiler.dump_stats(output)
+        else:
+            self._profiler.__exit__(None, None, None)
+            output = self.path + ".json"
+            self._profiler.export_chrome_trace(output)
+        self._profiler = None
+        self.done = True
+        print(f"Trace of episodes {self.start}-{self.stop - 1} written to {output}")
@@ -0,0 +1,137 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+
+class MemmapReplay:
+    """
+    Replay memory whose columns are np.memmap files in a directory on local disk.
+
+    The capacity is only bounded by disk space, the OS page cache keeps the recently used regions in memory.
+    Transitions are written in place, so the buffer survives the process and a resumed run can
+    sample from it straight away (see rl.checkpoint). Same push()/sample_batch() interface as ReplayMemory.
+    An existing buffer in the directory is reopened when resume is set, otherwise it is overwritten.
+    Resuming with a different capacity or number of observations raises ValueError instead.
+    """
+
+    META = "replay.json"
+
+    def __init__(self, directory : str, capacity : int, n_observations : int, device=None, seed : int = None,
+                 resume : bool = False):
+        self.directory = directory
+        self.capacity = capacity
+        self.n_observations = n_observations
+        self.device = device
+        self.rng = np.random.default_rng(seed)
+        self.position = 0
+        self.size = 0
+
+        os.makedirs(directory, exist_ok=True)
+        meta = self._read_meta()
+        if resume and meta is not None and (meta["capacity"], meta["n_observations"]) != (capacity, n_observations):
+            # Checked before the files are opened, "w+" would wipe the transitions of the run being resumed
+            raise ValueError(f"The replay memory in {directory} has capacity {meta['capacity']} with "
+                             f"{meta['n_observations']} observations, this run has {capacity} with {n_observations}; "
+                             "resume with the same --memory-capacity or use another --replay-dir")
+        reuse = resume and meta is not None
+        self.reused = reuse
+        if reuse:
+            self.position, self.size = meta["position"], meta["size"]
+
+        mode = "r+" if reuse else "w+"
+        self.columns = {
+            "state": self._open("state", np.float32, (capacity, n_observations), mode),
+            "action": self._open("action", np.int64, (capacity,), mode),
+            "reward": self._open("reward", np.float32, (capacity,), mode),
+            "next_state": self._open("next_state", np.float32, (capacity, n_observations), mode),
+            "done": self._open("done", np.bool_, (capacity,), mode),
+        }
+        if not reuse:
+            self._write_meta()
+
+    def _open(self, name, dtype, shape, mode):
+        return np.memmap(os.path.join(self.directory, name + ".bin"), dtype=dtype, mode=mode, shape=shape)
+
+    def _read_meta(self):
+        path = os.path.join(self.directory, self.META)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def _write_meta(self):
+        meta = {"capacity": self.capacity, "n_observations": self.n_observations,
+                "position": self.position, "size": self.size}
+        tmp = os.path.join(self.directory, self.META + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(self.directory, self.META))
+
+    def push(self, state, action, next_state, reward):
+        """Save a transition, next_state is None for terminal states"""
+        i = self.position
+        c = self.columns
+        c["state"][i] = state.reshape(-1).cpu().numpy()
+        c["action"][i] = int(action)
+        c["reward"][i] = float(reward)
+        if next_state is None:
+            c["done"][i] = True
+        else:
+            c["done"][i] = False
+            c["next_state"][i] = next_state.reshape(-1).cpu().numpy()
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample_batch(self, batch_size : int, device=None) -> tuple:
+        """
+        Random batch as (states, actions, rewards, non-final mask, non-final next states).
+        Indices are sorted so the reads walk each column file front to back.
+        """
+        device = device or self.device
+        idx = np.sort(self.rng.choice(self.size, batch_size, replace=False))
+        c = self.columns
+        done = c["done"][idx]
+        non_final = ~done
+        state_batch = torch.from_numpy(c["state"][idx]).to(device)
+        action_batch = torch.from_numpy(c["action"][idx]).to(device).unsqueeze(1)
+        reward_batch = torch.from_numpy(c["reward"][idx]).to(device)
+        non_final_mask = torch.from_numpy(non_final).to(device)
+        non_final_next_states = None
+        if non_final.any():
+            non_final_next_states = torch.from_numpy(c["next_state"][idx[non_final]]).to(device)
+        return state_batch, action_batch, reward_batch, non_final_mask, non_final_next_states
+
+    def __len__(self):
+        return self.size
+
+    def state_dict(self) -> dict:
+        return {"capacity": self.capacity, "n_observations": self.n_observations,
+                "position": self.position, "size": self.size, "rng": self.rng.bit_generator.state}
+
+    def load_state_dict(self, state : dict):
+        """
+        Restores the position saved with a checkpoint. Raises ValueError if the files do not hold the
+        transitions it describes: a different shape, or files that were not reopened but created anew.
+        """
+        capacity = state.get("capacity", self.capacity)
+        n_observations = state.get("n_observations", self.n_observations)
+        if (capacity, n_observations) != (self.capacity, self.n_observations) or state["size"] > self.capacity:
+            raise ValueError(f"The checkpoint's replay memory has capacity {capacity} with {n_observations} "
+                             f"observations, this run has {self.capacity} with {self.n_observations}; "
+                             "resume with the same --memory-capacity")
+        if state["size"] and not self.reused:
+            raise ValueError(f"The checkpoint has {state['size']} transitions in the replay memory, but "
+                             f"{self.directory} holds none of them; resume with the --replay-dir of that run")
+        self.position = state["position"]
+        self.size = state["size"]
+        self.rng.bit_generator.state = state["rng"]
+
+    def flush(self):
+        """
+        Writes the dirty pages of every column and the buffer position to disk.
+        """
+        for column in self.columns.values():
+            column.flush()
+        self._write_meta()
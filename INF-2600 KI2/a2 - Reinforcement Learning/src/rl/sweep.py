@@ -0,0 +1,186 @@
+import hashlib
+import importlib
+import itertools
+import json
+import math
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Trainers the sweep can run, as "module:function".
+# The function is called as fn(params, seed, episodes) in a worker process and returns a score, higher is better.
+TRAINERS = {
+    "dqn": "rl.dqn:run_trial",
+    "qlearning": "rl.tabular:run_trial",
+}
+
+
+def grid_space(space : dict) -> list:
+    """
+    Every combination of the listed values, e.g. {"lr": [1e-4, 1e-3], "gamma": [0.95, 0.99]}.
+    """
+    names = sorted(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[n] for n in names))]
+
+
+def _sample(spec, rng : random.Random):
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    if "choice" in spec:
+        return rng.choice(spec["choice"])
+    if "uniform" in spec:
+        return rng.uniform(*spec["uniform"])
+    if "loguniform" in spec:
+        low, high = spec["loguniform"]
+        return math.exp(rng.uniform(math.log(low), math.log(high)))
+    if "int" in spec:
+        return rng.randint(*spec["int"])
+    raise ValueError(f"Unknown search space entry {spec!r}")
+
+
+def random_space(space : dict, samples : int, seed : int = 0) -> list:
+    """
+    Random configurations. A list means pick one of the values,
+    otherwise {"uniform": [a, b]}, {"loguniform": [a, b]}, {"int": [a, b]} or {"choice": [...]}.
+    """
+    rng = random.Random(seed)
+    names = sorted(space)
+    return [{n: _sample(space[n], rng) for n in names} for _ in range(samples)]
+
+
+def trial_id(params : dict) -> str:
+    """
+    Stable id of a configuration, used to match results when a sweep is resumed.
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def rung_budgets(min_episodes : int, max_episodes : int, eta : int) -> list:
+    """
+    Episode budgets of the successive halving rungs: min, min*eta, min*eta^2, ... capped at max.
+    """
+    budgets = [min_episodes]
+    while budgets[-1] < max_episodes:
+        budgets.append(min(budgets[-1] * eta, max_episodes))
+    return budgets
+
+
+def _init_worker():
+    # One intra-op thread per worker, otherwise N workers each start a thread per core
+    os.environ["OMP_NUM_THREADS"] = "1"
+    os.environ["MKL_NUM_THREADS"] = "1"
+    try:
+        import torch
+        torch.set_num_threads(1)
+    except ImportError:
+        pass
+
+
+def _run_job(trainer : str, params : dict, seed : int, episodes : int) -> tuple:
+    module_name, fn_name = TRAINERS[trainer].split(":")
+    fn = getattr(importlib.import_module(module_name), fn_name)
+    start = time.perf_counter()
+    score = fn(params, seed, episodes)
+    return float(score), time.perf_counter() - start
+
+
+class ResultsFile:
+    """
+    Append-only JSON lines file of finished (trial, seed, rung) jobs.
+    Every result is written as soon as it arrives, so an interrupted sweep loses at most the running jobs.
+    """
+
+    def __init__(self, path : str):
+        self.path = path
+        self.done = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A line cut short by the interruption
+                        continue
+                    self.done[(record["trial"], record["seed"], record["episodes"])] = record
+
+    def get(self, trial : str, seed : int, episodes : int):
+        return self.done.get((trial, seed, episodes))
+
+    def add(self, record : dict):
+        self.done[(record["trial"], record["seed"], record["episodes"])] = record
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def successive_halving(configs : list, trainer : str = "dqn", seeds=(0,), min_episodes : int = 200,
+                       max_episodes : int = 600, eta : int = 3, workers : int = None,
+                       results_path : str = "sweep.jsonl") -> list:
+    """
+    Runs every configuration for min_episodes, keeps the best 1/eta, runs those for eta times longer, and so on
+    until max_episodes. A configuration's score at a rung is its mean score over the seeds.
+
+    Trials restart from scratch at every rung with the same seed, so a rung's result does not depend on
+    which worker or in which order it ran, and a resumed sweep makes the same promotions.
+    Returns the final rung's configurations sorted best first.
+    """
+    results = ResultsFile(results_path)
+    survivors = [(trial_id(params), params) for params in configs]
+    ranking = []
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        for rung, episodes in enumerate(rung_budgets(min_episodes, max_episodes, eta)):
+            futures = {}
+            for tid, params in survivors:
+                for seed in seeds:
+                    if results.get(tid, seed, episodes) is None:
+                        future = pool.submit(_run_job, trainer, params, seed, episodes)
+                        futures[future] = (tid, params, seed)
+
+            skipped = len(survivors) * len(seeds) - len(futures)
+            print(f"Rung {rung}: {len(survivors)} configurations x {len(seeds)} seeds, "
+                  f"{episodes} episodes ({skipped} jobs already in {results_path})")
+
+            for future in as_completed(futures):
+                tid, params, seed = futures[future]
+                score, elapsed = future.result()
+                results.add({"trial": tid, "params": params, "seed": seed, "rung": rung,
+                             "episodes": episodes, "score": score, "time_s": round(elapsed, 3)})
+                print(f"  {tid} seed {seed}: {score:.1f} ({elapsed:.1f}s) {params}")
+
+            ranking = []
+            for tid, params in survivors:
+                scores = [results.get(tid, seed, episodes)["score"] for seed in seeds]
+                ranking.append({"trial": tid, "params": params, "episodes": episodes,
+                                "score": sum(scores) / len(scores)})
+            ranking.sort(key=lambda r: r["score"], reverse=True)
+
+            keep = max(1, len(ranking) // eta)
+            survivors = [(r["trial"], r["params"]) for r in ranking[:keep]]
+
+    return ranking
+
+
+def load_space(path : str) -> tuple:
+    """
+    Reads a search space file, either just the space or {"space": {...}, "base": {...}}
+    where base holds fixed settings applied to every configuration.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    if "space" in data:
+        return data["space"], data.get("base", {})
+    return data, {}
+
+
+def run_sweep(space_path : str, mode : str = "grid", samples : int = 20, sample_seed : int = 0, **kwargs) -> list:
+    space, base = load_space(space_path)
+    if mode == "grid":
+        configs = grid_space(space)
+    else:
+        configs = random_space(space, samples, sample_seed)
+    configs = [{**base, **params} for params in configs]
+    return successive_halving(configs, **kwargs)
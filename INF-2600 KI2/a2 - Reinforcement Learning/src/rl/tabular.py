@@ -0,0 +1,229 @@
+import math
+
+import numpy as np
+
+from .config import QLearningConfig
+from .metrics import MetricsSink, score
+from .vector_env import VectorCartPole
+
+# Per environment: number of dimensions of the vectorised cart-pole,
+# the clipping range of every observation and the default number of bins.
+# Velocities are unbounded, values outside the range fall in the outermost bins.
+ENV_SPECS = {
+    "CartPole-v1": (1, (2.4, 3.0, 0.2095, 3.5)),
+    "CartPole2D": (2, (2.4, 3.0, 2.4, 3.0, 0.2095, 3.5, 0.2095, 3.5)),
+}
+
+DEFAULT_BINS = {
+    "CartPole-v1": (3, 3, 6, 6),
+    "CartPole2D": (3, 3, 3, 3, 6, 6, 6, 6),
+}
+
+
+def parse_bins(bins, n_dims : int) -> tuple:
+    """
+    Bins per dimension from "3,3,6,6", a single number, or a sequence.
+    """
+    if isinstance(bins, str):
+        bins = [int(b) for b in bins.split(",")]
+    elif isinstance(bins, int):
+        bins = [bins]
+    bins = tuple(bins)
+    if len(bins) == 1:
+        bins = bins * n_dims
+    if len(bins) != n_dims:
+        raise ValueError(f"Expected {n_dims} bin counts, got {len(bins)}")
+    return bins
+
+
+class Discretizer:
+    """
+    Maps a batch of continuous observations to integer state indices.
+
+    Each dimension is split into equally wide bins between -bound and +bound, computed with arithmetic
+    instead of a search. Explicit, unevenly spaced bin edges can be given per dimension instead,
+    those dimensions use np.digitize. The per-dimension bins are combined into one index (row-major).
+    """
+
+    def __init__(self, bins : tuple, bounds : tuple, edges : dict = None, offset : float = 0.0):
+        self.bins = np.asarray(bins, dtype=np.int64)
+        bounds = np.asarray(bounds, dtype=np.float64)
+        self.width = 2 * bounds / self.bins
+        # A fractional offset shifts every bin, used by the tilings of TileCoder
+        self.low = -bounds - offset * self.width
+        self.edges = edges or {}
+        self.strides = np.ones(len(self.bins), dtype=np.int64)
+        for i in range(len(self.bins) - 2, -1, -1):
+            self.strides[i] = self.strides[i + 1] * self.bins[i + 1]
+        self.n_states = int(np.prod(self.bins))
+
+    def __call__(self, obs : np.ndarray) -> np.ndarray:
+        idx = np.floor((obs - self.low) / self.width).astype(np.int64)
+        for dim, dim_edges in self.edges.items():
+            idx[:, dim] = np.digitize(obs[:, dim], dim_edges)
+        np.clip(idx, 0, self.bins - 1, out=idx)
+        # Returns shape (batch, 1), one active feature per observation
+        return (idx @ self.strides)[:, None]
+
+
+class TileCoder:
+    """
+    n_tilings discretizers, each shifted by a fraction of a bin.
+    An observation activates one tile per tiling, its value is the sum over the active tiles.
+    """
+
+    def __init__(self, bins : tuple, bounds : tuple, n_tilings : int):
+        self.tilings = [Discretizer(bins, bounds, offset=t / n_tilings) for t in range(n_tilings)]
+        per_tiling = self.tilings[0].n_states
+        self.offsets = np.arange(n_tilings, dtype=np.int64) * per_tiling
+        self.n_states = per_tiling * n_tilings
+
+    def __call__(self, obs : np.ndarray) -> np.ndarray:
+        return np.hstack([tiling(obs) for tiling in self.tilings]) + self.offsets
+
+
+class DenseQTable:
+    """
+    Q values for every (feature, action) in one numpy array.
+    """
+
+    def __init__(self, n_states : int, n_actions : int):
+        self.values = np.zeros((n_states, n_actions))
+
+    def q(self, features : np.ndarray) -> np.ndarray:
+        # features (batch, k) -> Q values (batch, n_actions), summed over the k active features
+        return self.values[features].sum(axis=1)
+
+    def add(self, features : np.ndarray, actions : np.ndarray, deltas : np.ndarray):
+        k = features.shape[1]
+        # np.add.at so that envs in the same state and action all contribute
+        np.add.at(self.values, (features.ravel(), np.repeat(actions, k)), np.repeat(deltas, k))
+
+
+class SparseQTable:
+    """
+    Hash-backed Q table that only stores features that have been updated.
+    For fine discretisations of the 2D cart-pole, most of the dense table would never be visited.
+    """
+
+    def __init__(self, n_states : int, n_actions : int):
+        self.n_actions = n_actions
+        self.rows = {}
+        self._zeros = np.zeros(n_actions)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def q(self, features : np.ndarray) -> np.ndarray:
+        rows = self.rows
+        zeros = self._zeros
+        out = np.empty((features.shape[0], self.n_actions))
+        for i, feats in enumerate(features.tolist()):
+            out[i] = sum(rows.get(f, zeros) for f in feats)
+        return out
+
+    def add(self, features : np.ndarray, actions : np.ndarray, deltas : np.ndarray):
+        rows = self.rows
+        for feats, action, delta in zip(features.tolist(), actions.tolist(), deltas.tolist()):
+            for f in feats:
+                row = rows.get(f)
+                if row is None:
+                    row = rows[f] = np.zeros(self.n_actions)
+                row[action] += delta
+
+
+class QLearner:
+    """
+    Tabular Q-learning over num_envs vectorised cart-poles.
+    Every step selects actions for all environments at once and applies all of their Q updates as one batch.
+    """
+
+    def __init__(self, config : QLearningConfig = None):
+        self.config = config or QLearningConfig()
+        config = self.config
+        if config.env not in ENV_SPECS:
+            raise ValueError(f"Unknown environment {config.env!r}, expected one of {list(ENV_SPECS)}")
+        dims, bounds = ENV_SPECS[config.env]
+
+        # CartPole2DEnv never truncates, CartPole-v1 stops after 500 steps
+        max_steps = 500 if config.env == "CartPole-v1" else None
+        self.env = VectorCartPole(config.num_envs, dims, max_steps, seed=config.seed)
+        self.rng = np.random.default_rng(config.seed)
+
+        bins = parse_bins(config.bins if config.bins is not None else DEFAULT_BINS[config.env], len(bounds))
+        if config.tilings > 1:
+            self.features = TileCoder(bins, bounds, config.tilings)
+        else:
+            self.features = Discretizer(bins, bounds)
+
+        table_cls = {"dense": DenseQTable, "sparse": SparseQTable}[config.table]
+        self.table = table_cls(self.features.n_states, self.env.n_actions)
+        # With tile coding the step size is shared between the active tiles
+        self.alpha = config.learning_rate / config.tilings
+
+        self.steps_done = 0
+        self.episode_durations = []
+
+    def epsilon(self) -> float:
+        config = self.config
+        return config.eps_end + (config.eps_start - config.eps_end) * \
+            math.exp(-1. * self.steps_done / config.eps_decay)
+
+    def select_actions(self, q : np.ndarray) -> np.ndarray:
+        n = q.shape[0]
+        explore = self.rng.random(n) < self.epsilon()
+        self.steps_done += n
+        random_actions = self.rng.integers(0, self.env.n_actions, size=n)
+        return np.where(explore, random_actions, q.argmax(axis=1))
+
+    def train(self, num_episodes : int = None, callbacks=()) -> list:
+        """
+        Runs until num_episodes episodes have finished across all environments.
+        Callbacks are called as callback(learner, i_episode, duration) for every finished episode.
+        """
+        if num_episodes is None:
+            num_episodes = self.config.num_episodes
+        gamma = self.config.discount_factor
+
+        obs = self.env.reset()
+        features = self.features(obs)
+        while len(self.episode_durations) < num_episodes:
+            q = self.table.q(features)
+            actions = self.select_actions(q)
+            next_obs, rewards, terminated, truncated = self.env.step(actions)
+            next_features = self.features(next_obs)
+
+            # Q(s,a) += alpha * (r + gamma * max_a' Q(s',a') - Q(s,a)), no bootstrap from terminal states
+            targets = rewards + gamma * self.table.q(next_features).max(axis=1) * ~terminated
+            deltas = targets - q[np.arange(len(actions)), actions]
+            self.table.add(features, actions, self.alpha * deltas)
+
+            done = terminated | truncated
+            obs, lengths = self.env.reset_done(done)
+            features = self.features(obs) if done.any() else next_features
+
+            for duration in lengths.tolist():
+                i_episode = len(self.episode_durations)
+                self.episode_durations.append(duration)
+                for callback in callbacks:
+                    callback(self, i_episode, duration)
+
+        return self.episode_durations[:num_episodes]
+
+
+def train_qlearning(config : QLearningConfig = None, callbacks=()) -> list:
+    """
+    Entry point for a tabular Q-learning run, returns the episode durations.
+    """
+    config = config or QLearningConfig()
+    learner = QLearner(config)
+    with MetricsSink(config.metrics_path, log_every=config.log_every) as metrics:
+        return learner.train(callbacks=(metrics, *callbacks))
+
+
+def run_trial(params : dict, seed : int, episodes : int) -> float:
+    """
+    Sweep entry point, see rl.sweep.
+    """
+    config = QLearningConfig(**params).updated(seed=seed, num_episodes=episodes)
+    return score(QLearner(config).train())
@@ -0,0 +1,120 @@
+import math
+
+import numpy as np
+
+
+class VectorCartPole:
+    """
+    num_envs cart-poles stepped together with numpy, without a python loop over the environments.
+
+    dims=1 follows gymnasium's CartPole-v1: observation (x, x_dot, theta, theta_dot), actions 0 left / 1 right.
+    dims=2 follows CartPole2DEnv in pre_task_2.py: observation
+    (x, x_dot, y, y_dot, theta_x, theta_x_dot, theta_y, theta_y_dot), actions 0/1 push along x, 2/3 along y.
+
+    Episodes are truncated after max_episode_steps (None never truncates, like CartPole2DEnv).
+    """
+
+    # Observation layout of each dimension as (axis, variable) where the variables of an axis are
+    # 0 cart position, 1 cart velocity, 2 pole angle, 3 pole angular velocity
+    _LAYOUT = {
+        1: [(0, 0), (0, 1), (0, 2), (0, 3)],
+        2: [(0, 0), (0, 1), (1, 0), (1, 1), (0, 2), (0, 3), (1, 2), (1, 3)],
+    }
+
+    def __init__(self, num_envs : int = 1, dims : int = 1, max_episode_steps : int = 500, seed : int = None):
+        if dims not in self._LAYOUT:
+            raise ValueError(f"dims must be 1 or 2, got {dims}")
+        self.num_envs = num_envs
+        self.dims = dims
+        self.max_episode_steps = max_episode_steps
+
+        self.gravity = 9.8
+        self.masscart = 1.0
+        self.masspole = 0.1
+        self.total_mass = self.masspole + self.masscart
+        self.length = 0.5  # actually half the pole's length
+        self.polemass_length = self.masspole * self.length
+        self.force_mag = 10.0
+        self.tau = 0.02  # seconds between state updates
+
+        # Angle at which to fail the episode
+        self.theta_threshold_radians = 12 * 2 * math.pi / 360
+        self.x_threshold = 2.4
+
+        self.n_actions = 2 * dims
+        self.n_observations = 4 * dims
+        layout = self._LAYOUT[dims]
+        self._obs_axis = np.array([a for a, _ in layout])
+        self._obs_var = np.array([v for _, v in layout])
+
+        self.rng = np.random.default_rng(seed)
+        # state[env, axis] = (position, velocity, angle, angular velocity)
+        self.state = np.zeros((num_envs, dims, 4))
+        self.elapsed = np.zeros(num_envs, dtype=np.int64)
+        self._rows = np.arange(num_envs)
+
+    def _observe(self) -> np.ndarray:
+        return self.state[:, self._obs_axis, self._obs_var].astype(np.float32)
+
+    def reset(self) -> np.ndarray:
+        self.state = self.rng.uniform(-0.05, 0.05, size=self.state.shape)
+        self.elapsed[:] = 0
+        return self._observe()
+
+    def step(self, actions : np.ndarray) -> tuple:
+        """
+        Steps every environment with its action.
+        Returns (next observations, rewards, terminated, truncated). Finished environments are not reset
+        here, so the next observations are the true successors, call reset_done() afterwards.
+        """
+        actions = np.asarray(actions)
+        # Actions 0 and 1 push along x, 2 and 3 along y; 1 and 2 are the positive directions
+        axis = actions // 2
+        force = np.where((actions == 1) | (actions == 2), self.force_mag, -self.force_mag)
+
+        s = self.state[self._rows, axis]
+        x, x_dot, theta, theta_dot = s[:, 0], s[:, 1], s[:, 2], s[:, 3]
+
+        costheta = np.cos(theta)
+        sintheta = np.sin(theta)
+        # For the interested reader:
+        # https://coneural.org/florian/papers/05_cart_pole.pdf
+        temp = (force + self.polemass_length * theta_dot**2 * sintheta) / self.total_mass
+        thetaacc = (self.gravity * sintheta - costheta * temp) / (
+            self.length * (4.0 / 3.0 - self.masspole * costheta**2 / self.total_mass)
+        )
+        xacc = temp - self.polemass_length * thetaacc * costheta / self.total_mass
+
+        # Euler integration, the new values are computed from the old ones
+        s_new = np.stack((
+            x + self.tau * x_dot,
+            x_dot + self.tau * xacc,
+            theta + self.tau * theta_dot,
+            theta_dot + self.tau * thetaacc,
+        ), axis=1)
+        self.state[self._rows, axis] = s_new
+        self.elapsed += 1
+
+        terminated = (
+            (np.abs(self.state[:, :, 0]) > self.x_threshold).any(axis=1)
+            | (np.abs(self.state[:, :, 2]) > self.theta_threshold_radians).any(axis=1)
+        )
+        if self.max_episode_steps is None:
+            truncated = np.zeros(self.num_envs, dtype=bool)
+        else:
+            truncated = ~terminated & (self.elapsed >= self.max_episode_steps)
+
+        rewards = np.ones(self.num_envs, dtype=np.float32)
+        return self._observe(), rewards, terminated, truncated
+
+    def reset_done(self, done : np.ndarray) -> tuple:
+        """
+        Resets the environments where done is set.
+        Returns (observations for the next step, lengths of the episodes that just ended).
+        """
+        lengths = self.elapsed[done].copy()
+        n = int(done.sum())
+        if n:
+            self.state[done] = self.rng.uniform(-0.05, 0.05, size=(n, self.dims, 4))
+            self.elapsed[done] = 0
+        return self._observe(), lengths